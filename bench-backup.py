@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+#
+#  Benchmark the backup pipeline of virt-backup.py on synthetic disk images,
+#  without a hypervisor. The domains are stand-ins that take configurable
+#  time to pause, snapshot and commit, everything else is the real code.
+
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from xml.etree import ElementTree
+from subprocess import check_output, DEVNULL, CalledProcessError
+import importlib.machinery
+import importlib.util
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+import random
+import heapq
+import shutil
+import time
+import json
+import uuid
+import os
+
+def load_virt_backup():
+  # virt-backup.py is a script rather than a module and is loaded by path
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "virt-backup.py")
+  loader = importlib.machinery.SourceFileLoader("virt_backup", path)
+  spec = importlib.util.spec_from_loader("virt_backup", loader)
+  module = importlib.util.module_from_spec(spec)
+  loader.exec_module(module)
+  return module
+
+vb = load_virt_backup()
+libvirt = vb.libvirt
+
+# Images are written in extents of this size, half random and half text so
+# that the data compresses about as well as a typical guest filesystem
+EXTENT = 1024 * 1024
+ZERO = bytes(EXTENT)
+
+class MockDomain:
+  # Stands in for a running libvirt domain with raw disk images. Pausing,
+  # snapshotting, freezing and committing take the configured latencies,
+  # and snapshots and commits switch disks between image and overlay as
+  # qemu would.
+  def __init__(self, name, images, latency):
+    self.domain_name = name
+    self.uuid = str(uuid.uuid4())
+    self.images = images
+    self.active = dict(images)
+    self.latency = latency
+    self.current = libvirt.VIR_DOMAIN_RUNNING
+    self.jobs = {}
+
+  def delay(self, operation):
+    time.sleep(self.latency.get(operation, 0.0))
+
+  def UUIDString(self):
+    return self.uuid
+
+  def name(self):
+    return self.domain_name
+
+  def XMLDesc(self, flags = 0):
+    disks = ""
+    for device, image in sorted(self.images.items()):
+      backing = ""
+      fmt = "raw"
+      if self.active[device] != image:
+        fmt = "qcow2"
+        backing = ("<backingStore type='file'><format type='raw'/><source file='{image}'/>"
+                   "</backingStore>".format(image=image))
+      disks += ("<disk type='file' device='disk'><driver name='qemu' type='{fmt}'/>"
+                "<source file='{file}'/>{backing}<target dev='{device}'/></disk>".format(
+                fmt=fmt, file=self.active[device], backing=backing, device=device))
+    return ("<domain type='kvm'><name>{name}</name><uuid>{uuid}</uuid><devices>{disks}"
+            "</devices></domain>".format(name=self.domain_name, uuid=self.uuid, disks=disks))
+
+  def state(self):
+    return [self.current, 0]
+
+  def isActive(self):
+    return self.current != libvirt.VIR_DOMAIN_SHUTOFF
+
+  def suspend(self):
+    self.delay("pause")
+    self.current = libvirt.VIR_DOMAIN_PAUSED
+
+  def resume(self):
+    self.delay("pause")
+    self.current = libvirt.VIR_DOMAIN_RUNNING
+
+  def shutdown(self):
+    self.delay("shutdown")
+    self.current = libvirt.VIR_DOMAIN_SHUTOFF
+
+  def create(self):
+    self.delay("boot")
+    self.current = libvirt.VIR_DOMAIN_RUNNING
+
+  def agentSetResponseTimeout(self, timeout, flags):
+    return 0
+
+  def fsFreeze(self):
+    self.delay("freeze")
+    return len(self.images)
+
+  def fsThaw(self):
+    self.delay("freeze")
+    return len(self.images)
+
+  def snapshotCreateXML(self, xml, flags):
+    self.delay("snapshot")
+    for disk in ElementTree.fromstring(xml).findall("disks/disk"):
+      overlay = disk.find("source").attrib['file']
+      open(overlay, "w").close()
+      self.active[disk.attrib['name']] = overlay
+
+  def blockInfo(self, device, flags = 0):
+    allocation = os.stat(self.images[device]).st_blocks * 512
+    return [os.path.getsize(self.images[device]), allocation, allocation]
+
+  def blockCommit(self, device, base, top, bandwidth, flags):
+    self.jobs[device] = time.monotonic() + self.latency.get("commit", 0.0)
+    # Tell the backup the job is ready through the event libvirt would send
+    timer = threading.Timer(self.latency.get("commit", 0.0), vb.block_job_callback,
+                            (None, self, device, libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_ACTIVE_COMMIT,
+                             libvirt.VIR_DOMAIN_BLOCK_JOB_READY, None))
+    timer.daemon = True
+    timer.start()
+
+  def blockJobInfo(self, device, flags):
+    if device not in self.jobs:
+      return {}
+    done = time.monotonic() >= self.jobs[device]
+    return { "type" : libvirt.VIR_DOMAIN_BLOCK_JOB_TYPE_ACTIVE_COMMIT, "bandwidth" : 0,
+             "cur" : done and 100 or 0, "end" : 100 }
+
+  def blockJobAbort(self, device, flags):
+    del self.jobs[device]
+    if flags & libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT:
+      self.active[device] = self.images[device]
+
+class MockConnection:
+  def __init__(self, domains):
+    self.domains = dict((dom.name(), dom) for dom in domains)
+
+  def lookupByName(self, name):
+    if name not in self.domains:
+      raise libvirt.libvirtError("Domain not found: {name}".format(name=name))
+    return self.domains[name]
+
+  def isAlive(self):
+    return 1
+
+  def close(self):
+    pass
+
+def make_image(path, size, dirty, layout, seed):
+  # Write a raw image of size bytes where the dirty fraction holds data,
+  # in extents spread at random over it. Sparse images leave the rest as
+  # holes, dense ones fill it with zeroes. Returns the bytes of data.
+  rng = random.Random(seed)
+  count = max(1, size // EXTENT)
+  chosen = set(rng.sample(range(count), int(count * dirty)))
+  line = b"virt-backup benchmark %d " % seed
+  text = line * (EXTENT // len(line) + 1)
+  with open(path, "wb") as f:
+    for index in range(count):
+      if index in chosen:
+        f.seek(index * EXTENT)
+        f.write(os.urandom(EXTENT // 2) + text[:EXTENT - EXTENT // 2])
+      elif layout == "dense":
+        f.seek(index * EXTENT)
+        f.write(ZERO)
+    f.truncate(size)
+  return len(chosen) * EXTENT
+
+def write_config(path, workdir, sections, options = {}):
+  # Write a configfile for virt-backup.py with the given VM sections, each
+  # a dictionary of its options
+  settings = { "start_at" : "0100",
+               "delay" : 0,
+               "backup_dir" : os.path.join(workdir, "backup"),
+               "logfile" : os.path.join(workdir, "bench.log"),
+               "summary_file" : os.path.join(workdir, "summary.json"),
+               "api" : "libvirt",
+               "method" : "suspend",
+               "retention" : 2 }
+  settings.update(options)
+  lines = ["[global]"]
+  lines += ["{key}={value}".format(key=key, value=value) for key, value in settings.items()]
+  for name, section in sections:
+    lines.append("[{name}]".format(name=name))
+    lines += ["{key}={value}".format(key=key, value=value) for key, value in section.items()]
+  os.makedirs(os.path.join(workdir, "backup"), exist_ok=True)
+  with open(path, "w") as f:
+    f.write("\n".join(lines) + "\n")
+
+def distribution(values):
+  if len(values) == 0:
+    return None
+  return { "min" : min(values), "median" : statistics.median(values), "max" : max(values) }
+
+def bench_copy(args, workdir):
+  # Time copy_disk() with each storage format on sparse and dense images
+  conf = os.path.join(workdir, "copy.conf")
+  write_config(conf, workdir, [])
+  global_config, backups = vb.parse_config(conf)
+  engines = [("native", { "backup_format" : "files", "compress" : False }),
+             ("chunkstore", { "backup_format" : "chunkstore", "compress" : False }),
+             ("gzip", { "backup_format" : "files", "compress" : True,
+                        "compress_format" : "gzip" })]
+  if vb.zstandard != None:
+    engines.insert(2, ("zstd", { "backup_format" : "files", "compress" : True,
+                                 "compress_format" : "zstd" }))
+
+  results = []
+  for layout in args.layout:
+    image = os.path.join(workdir, "copy-{layout}.img".format(layout=layout))
+    data = make_image(image, args.size, args.dirty, layout, 0)
+    for engine, settings in engines:
+      config = dict(global_config, checksum=args.checksum, **settings)
+      runs = []
+      for run in range(args.repeat):
+        outdir = os.path.join(workdir, "copy-out")
+        os.makedirs(outdir)
+        stats = vb.copy_disk(config, image, os.path.join(outdir, "disk.img"),
+                             config['logfile'], "raw", False)
+        runs.append(stats)
+        shutil.rmtree(outdir)
+        shutil.rmtree(vb.chunkstore_dir(config['backup_dir']), ignore_errors=True)
+      seconds = [stats['seconds'] for stats in runs]
+      results.append({ "layout" : layout,
+                       "engine" : engine,
+                       "size" : args.size,
+                       "data" : data,
+                       "bytes" : runs[0]['bytes'],
+                       "written" : runs[0]['written'],
+                       "seconds" : distribution(seconds),
+                       "cpu_seconds" : runs[0].get("cpu_seconds"),
+                       "mib_per_s" : args.size / 1048576. / max(min(seconds), 0.000001) })
+    os.remove(image)
+  return results
+
+def bench_restore(args, workdir):
+  # Time restore_disk() from each storage format on sparse and dense images,
+  # against copying the plain image with cp and qemu-img convert
+  conf = os.path.join(workdir, "restore.conf")
+  write_config(conf, workdir, [])
+  global_config, backups = vb.parse_config(conf)
+  engines = [("native", { "backup_format" : "files", "compress" : False }),
+             ("chunkstore", { "backup_format" : "chunkstore", "compress" : False }),
+             ("gzip", { "backup_format" : "files", "compress" : True,
+                        "compress_format" : "gzip" })]
+  if vb.zstandard != None:
+    engines.insert(2, ("zstd", { "backup_format" : "files", "compress" : True,
+                                 "compress_format" : "zstd" }))
+  tools = [("cp", ["cp", "--sparse=always"]),
+           ("qemu-img", ["qemu-img", "convert", "-f", "raw", "-O", "raw"])]
+
+  results = []
+  for layout in args.layout:
+    image = os.path.join(workdir, "restore-{layout}.img".format(layout=layout))
+    data = make_image(image, args.size, args.dirty, layout, 0)
+    candidates = []
+    for engine, settings in engines:
+      config = dict(global_config, checksum="none", **settings)
+      setdir = os.path.join(workdir, "set-{engine}".format(engine=engine))
+      os.makedirs(setdir)
+      stats = vb.copy_disk(config, image, os.path.join(setdir, "disk.img"),
+                           config['logfile'], "raw", False)
+      # Describe the image as set_disks() does
+      disk = { "file" : stats['output'] }
+      if stats['output'].endswith(".manifest"):
+        disk = { "manifest" : stats['output'] }
+      elif vb.compressed_image(os.path.join(setdir, "disk.img")) != None:
+        disk = { "compressed" : stats['output'] }
+      candidates.append((engine, lambda outf, config=config, disk=disk:
+                         vb.restore_disk(config, disk, outf)))
+    for tool, command in tools:
+      if shutil.which(command[0]) != None:
+        candidates.append((tool, lambda outf, command=command:
+                           check_output(command + [image, outf], stderr=DEVNULL)))
+
+    for name, restore in candidates:
+      seconds = []
+      for run in range(args.repeat):
+        outf = os.path.join(workdir, "restored.img")
+        started = time.monotonic()
+        restore(outf)
+        seconds.append(time.monotonic() - started)
+        written = os.stat(outf).st_blocks * 512
+        os.remove(outf)
+      results.append({ "layout" : layout,
+                       "engine" : name,
+                       "size" : args.size,
+                       "data" : data,
+                       "written" : written,
+                       "seconds" : distribution(seconds),
+                       "mib_per_s" : args.size / 1048576. / max(min(seconds), 0.000001) })
+    for engine, settings in engines:
+      shutil.rmtree(os.path.join(workdir, "set-{engine}".format(engine=engine)))
+    shutil.rmtree(vb.chunkstore_dir(global_config['backup_dir']), ignore_errors=True)
+    os.remove(image)
+  return results
+
+def bench_backup(args, workdir):
+  # Run do_backup() of a number of stand-in domains and collect downtime
+  # and phase latencies from the summary of each run
+  latency = { "pause" : args.pause_ms / 1000., "snapshot" : args.snapshot_ms / 1000.,
+              "freeze" : args.freeze_ms / 1000., "commit" : args.commit_ms / 1000.,
+              "shutdown" : args.boot_ms / 1000., "boot" : args.boot_ms / 1000. }
+  imagedir = os.path.join(workdir, "images")
+  os.makedirs(imagedir)
+  domains = []
+  for vm in range(args.vms):
+    images = {}
+    for disk in range(args.disks):
+      device = "vd" + chr(ord("a") + disk)
+      images[device] = os.path.join(imagedir, "bench{vm}-{device}.img".format(vm=vm,
+                                                                            device=device))
+      make_image(images[device], args.size, args.dirty, args.layout[0], vm * 26 + disk)
+    domains.append(MockDomain("bench{vm}".format(vm=vm), images, latency))
+  conn = MockConnection(domains)
+  vb.get_connection = lambda uri = None: conn
+
+  conf = os.path.join(workdir, "backup.conf")
+  write_config(conf, workdir, [(dom.name(), {}) for dom in domains],
+               { "method" : args.method, "max_jobs" : args.max_jobs,
+                 "max_disk_jobs" : args.max_disk_jobs, "checksum" : args.checksum,
+                 "compress" : args.compress != "none" and "true" or "false",
+                 "compress_format" : args.compress != "none" and args.compress or "zstd" })
+  global_config, backups = vb.parse_config(conf)
+  vb.apply_limits(global_config, backups)
+
+  walls = []
+  failed = 0
+  downtimes = []
+  phases = {}
+  moved = 0
+  copied = 0.0
+  for run in range(args.repeat):
+    started = time.monotonic()
+    vb.do_backup(global_config, backups, sorted(backups.keys()))
+    walls.append(time.monotonic() - started)
+    with open(global_config['summary_file']) as f:
+      summary = json.load(f)
+    for backup in summary['backups']:
+      if backup['outcome'] != "success":
+        failed += 1
+      if backup['downtime_seconds'] != None:
+        downtimes.append(backup['downtime_seconds'])
+      for phase, seconds in backup['phases'].items():
+        phases.setdefault(phase, []).append(seconds)
+      moved += backup['bytes']
+      copied += backup['phases'].get("copy", 0.0)
+  vb.reaper.wait()
+
+  return { "method" : args.method,
+           "vms" : args.vms,
+           "disks" : args.disks,
+           "size" : args.size,
+           "dirty" : args.dirty,
+           "layout" : args.layout[0],
+           "compress" : args.compress,
+           "failed" : failed,
+           "wall_seconds" : distribution(walls),
+           "downtime_seconds" : distribution(downtimes),
+           "phases" : dict((phase, distribution(seconds)) for phase, seconds in phases.items()),
+           "copy_mib_per_s" : moved / 1048576. / max(copied, 0.000001) }
+
+def bench_scheduler(args, workdir):
+  # Time parsing, queueing and dispatching thousands of VM sections. Jobs
+  # are dispatched through a Dispatcher with a backup that does nothing.
+  rng = random.Random(1)
+  sections = []
+  for vm in range(args.sections):
+    section = { "time" : "{hour:02d}{minute:02d}".format(hour=rng.randrange(24),
+                                                        minute=rng.randrange(60)),
+                "priority" : rng.randrange(1, 100) }
+    kind = rng.randrange(3)
+    if kind == 1:
+      section['weekday'] = ",".join(sorted(rng.sample(vb.WEEKDAYS, rng.randrange(1, 4))))
+    elif kind == 2:
+      section['dom'] = ",".join(str(day) for day in sorted(rng.sample(range(1, 29), 2)))
+    sections.append(("sched{vm}".format(vm=vm), section))
+  conf = os.path.join(workdir, "sched.conf")
+  write_config(conf, workdir, sections, { "max_jobs" : args.max_jobs })
+
+  started = time.monotonic()
+  global_config, backups = vb.parse_config(conf)
+  parse = time.monotonic() - started
+
+  now = datetime.now()
+  started = time.monotonic()
+  queue = vb.schedule_queue(backups, now)
+  build = time.monotonic() - started
+
+  # Pop and reschedule a week worth of runs, as the daemon would
+  started = time.monotonic()
+  runs = 0
+  while len(queue) > 0 and queue[0][0] <= now + timedelta(days=7):
+    due, priority, k = heapq.heappop(queue)
+    following = vb.next_run(backups[k]['schedule'], due + timedelta(minutes=1))
+    if following != None:
+      heapq.heappush(queue, (following, priority, k))
+    runs += 1
+  reschedule = time.monotonic() - started
+
+  conn = MockConnection([])
+  vb.get_connection = lambda uri = None: conn
+  backup_vm = vb.backup_vm
+  vb.backup_vm = lambda global_config, conn, k, v, scheduled = False: None
+  try:
+    started = time.monotonic()
+    vb.do_backup(global_config, backups, list(backups.keys()))
+    dispatch = time.monotonic() - started
+  finally:
+    vb.backup_vm = backup_vm
+
+  return { "sections" : args.sections,
+           "parse_seconds" : parse,
+           "queue_seconds" : build,
+           "runs_per_week" : runs,
+           "next_run_us" : reschedule * 1000000. / max(runs, 1),
+           "dispatch_seconds" : dispatch,
+           "dispatch_us_per_job" : dispatch * 1000000. / max(args.sections, 1) }
+
+def commit_id():
+  try:
+    return check_output(["git", "rev-parse", "--short", "HEAD"], stderr=DEVNULL,
+                        cwd=os.path.dirname(os.path.abspath(__file__)),
+                        universal_newlines=True).strip()
+  except (OSError, CalledProcessError):
+    return None
+
+def print_results(results):
+  for copy in results.get("copy", []):
+    print("{layout:>6} {engine:>10}: {rate:8.1f} MiB/s, {data:.0f} of {size:.0f} MiB data, "
+          "{written:.0f} MiB written".format(layout=copy['layout'], engine=copy['engine'],
+          rate=copy['mib_per_s'], data=copy['data'] / 1048576., size=copy['size'] / 1048576.,
+          written=copy['written'] / 1048576.))
+  for restore in results.get("restore", []):
+    print("{layout:>6} {engine:>10}: {rate:8.1f} MiB/s restored, {written:.0f} MiB "
+          "written".format(layout=restore['layout'], engine=restore['engine'],
+          rate=restore['mib_per_s'], written=restore['written'] / 1048576.))
+  backup = results.get("backup")
+  if backup != None:
+    print("{method:>17}: {vms} vm(s) in {wall:.2f}s, copy {rate:.1f} MiB/s, downtime "
+          "{down:.1f} ms median, {failed} backup(s) failed".format(method=backup['method'],
+          vms=backup['vms'], wall=backup['wall_seconds']['median'],
+          rate=backup['copy_mib_per_s'], failed=backup['failed'],
+          down=(backup['downtime_seconds'] or { "median" : 0 })['median'] * 1000.))
+    for phase, seconds in sorted(backup['phases'].items()):
+      print("{phase:>17}: {median:.4f}s median, {max:.4f}s max".format(phase=phase,
+            median=seconds['median'], max=seconds['max']))
+  scheduler = results.get("scheduler")
+  if scheduler != None:
+    print("{title:>17}: {sections} sections parsed in {parse:.2f}s, queued in {queue:.3f}s, "
+          "{next:.1f} us per reschedule, {dispatch:.0f} us per dispatched job".format(
+          title="scheduler", sections=scheduler['sections'], parse=scheduler['parse_seconds'],
+          queue=scheduler['queue_seconds'], next=scheduler['next_run_us'],
+          dispatch=scheduler['dispatch_us_per_job']))
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the backup pipeline of virt-backup.py')
+  parser.add_argument('--suite', nargs='+', choices=['copy', 'restore', 'backup', 'scheduler'],
+                      default=['copy', 'restore', 'backup', 'scheduler'],
+                      help='Benchmarks to run (default: all)')
+  parser.add_argument('--size', type=vb.parse_size, default=vb.parse_size('256M'),
+                      help='Size of each disk image, with a K, M or G suffix (default: 256M)')
+  parser.add_argument('--dirty', type=float, default=0.25,
+                      help='Fraction of each image holding data (default: %(default)s)')
+  parser.add_argument('--layout', nargs='+', choices=['sparse', 'dense'],
+                      default=['sparse', 'dense'],
+                      help='Image layouts, the backup benchmark uses the first (default: both)')
+  parser.add_argument('--vms', type=int, default=4, help='Domains to back up (default: %(default)s)')
+  parser.add_argument('--disks', type=int, default=2, help='Disks per domain (default: %(default)s)')
+  parser.add_argument('--method', choices=['suspend', 'shutdown', 'quiesce'], default='suspend',
+                      help='Backup method (default: %(default)s)')
+  parser.add_argument('--compress', choices=['none', 'zstd', 'gzip'], default='none',
+                      help='Compression of the backup benchmark (default: %(default)s)')
+  parser.add_argument('--checksum', choices=['blake2b', 'none'], default='blake2b',
+                      help='Checksum of backed up images (default: %(default)s)')
+  parser.add_argument('--max-jobs', type=int, default=2,
+                      help='Backups running at the same time (default: %(default)s)')
+  parser.add_argument('--max-disk-jobs', type=int, default=2,
+                      help='Disks copied at the same time per backup (default: %(default)s)')
+  parser.add_argument('--pause-ms', type=float, default=5, help='Time to suspend or resume (default: %(default)s)')
+  parser.add_argument('--snapshot-ms', type=float, default=20, help='Time to snapshot (default: %(default)s)')
+  parser.add_argument('--freeze-ms', type=float, default=2, help='Time to freeze or thaw (default: %(default)s)')
+  parser.add_argument('--commit-ms', type=float, default=10, help='Time to block commit (default: %(default)s)')
+  parser.add_argument('--boot-ms', type=float, default=500, help='Time to shut down or boot (default: %(default)s)')
+  parser.add_argument('--sections', type=int, default=5000,
+                      help='VM sections of the scheduler benchmark (default: %(default)s)')
+  parser.add_argument('--repeat', type=int, default=3, help='Runs of each benchmark (default: %(default)s)')
+  parser.add_argument('--dir', help='Directory for images and backups (default: a temporary one)')
+  parser.add_argument('--output', default=datetime.now().strftime("bench-%Y%m%d-%H%M%S.json"),
+                      help='JSON file to write the results to (default: bench-<time>.json)')
+  results = parser.parse_args()
+
+  workdir = tempfile.mkdtemp(prefix="bench-backup-", dir=results.dir)
+  report = { "version" : 1,
+             "started" : datetime.now().isoformat(),
+             "commit" : commit_id(),
+             "host" : { "node" : platform.node(), "kernel" : platform.release(),
+                        "python" : platform.python_version(), "cpus" : os.cpu_count() },
+             "parameters" : vars(results) }
+  try:
+    # Everything virt-backup.py logs goes to bench.log in the workdir only
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+      for suite, bench in [("copy", bench_copy), ("restore", bench_restore),
+                           ("backup", bench_backup), ("scheduler", bench_scheduler)]:
+        if suite in results.suite:
+          suitedir = os.path.join(workdir, suite)
+          os.makedirs(suitedir)
+          report[suite] = bench(results, suitedir)
+      vb.log_writer.close()
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+
+  with open(results.output, "w") as f:
+    json.dump(report, f, indent=2)
+  print_results(report)
+  print("Results written to {output}".format(output=results.output))
+
+if __name__ == "__main__":
+  main()
@@ -3,8 +3,13 @@
 # Magnus Strahlert @ 211028
 #   Parses virt-backup.conf and shows it as a compact list
 
+from datetime import datetime, timedelta
 import configparser
+import statistics
 import argparse
+import sqlite3
+import heapq
+import time
 import os
 
 def read_config(configfile):
@@ -34,10 +39,281 @@ def query_node(config, node):
 def query_global(config):
     return config['global']
 
+def catalog_path(configfile):
+    # The catalog lives in backup_dir unless set explicitly
+    configuration = read_config(configfile)
+    if 'catalog' in query_global(configuration):
+        return query_global(configuration)['catalog']
+    return os.path.join(query_global(configuration).get('backup_dir', '.'), 'catalog.db')
+
+def open_catalog(path):
+    return sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+
+def format_size(size):
+    return "{:.1f}G".format((size or 0) / 1024. / 1024. / 1024.)
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "-"
+    return "{:.0f}s".format(seconds)
+
+def format_time(timestamp):
+    return time.strftime("%F %H:%M", time.localtime(timestamp))
+
+def query_latest(catalog, limit):
+    print("{vm:<20} {name:<20} {type:<12} {size:>8} {seconds:>8}".format(vm="VM",
+        name="Latest backup", type="Type", size="Size", seconds="Time"))
+    for vm, name, type_, size, seconds in catalog.execute(
+            "SELECT vm, MAX(name), type, size, seconds FROM backup_sets "
+            "WHERE outcome = 'success' GROUP BY vm ORDER BY vm"):
+        print("{vm:<20} {name:<20} {type:<12} {size:>8} {seconds:>8}".format(vm=vm, name=name,
+            type=type_ or "full", size=format_size(size), seconds=format_seconds(seconds)))
+
+def query_sizes(catalog, limit):
+    print("{vm:<20} {sets:>4} {size:>10}".format(vm="VM", sets="Sets", size="Total"))
+    total = 0
+    for vm, sets, size in catalog.execute(
+            "SELECT vm, COUNT(*), SUM(size) FROM backup_sets WHERE outcome = 'success' "
+            "GROUP BY vm ORDER BY SUM(size) DESC"):
+        print("{vm:<20} {sets:>4} {size:>10}".format(vm=vm, sets=sets, size=format_size(size)))
+        total += size or 0
+    print("{vm:<20} {sets:>4} {size:>10}".format(vm="** Total **", sets="", size=format_size(total)))
+
+def query_failures(catalog, limit):
+    print("{vm:<20} {started:<16} {seconds:>8}".format(vm="VM", started="Started", seconds="Time"))
+    for vm, started, seconds in catalog.execute(
+            "SELECT vm, started, seconds FROM backup_sets WHERE outcome = 'failed' "
+            "ORDER BY started DESC LIMIT ?", (limit,)):
+        print("{vm:<20} {started:<16} {seconds:>8}".format(vm=vm, started=format_time(started),
+            seconds=format_seconds(seconds)))
+
+def query_slowest(catalog, limit):
+    print("{vm:<20} {name:<20} {seconds:>8} {size:>8}".format(vm="VM", name="Backup",
+        seconds="Time", size="Size"))
+    for vm, name, seconds, size in catalog.execute(
+            "SELECT vm, name, seconds, size FROM backup_sets WHERE seconds IS NOT NULL "
+            "AND outcome IN ('success', 'deleted') ORDER BY seconds DESC LIMIT ?", (limit,)):
+        print("{vm:<20} {name:<20} {seconds:>8} {size:>8}".format(vm=vm, name=name,
+            seconds=format_seconds(seconds), size=format_size(size)))
+
+QUERIES = { 'latest' : query_latest,
+            'sizes' : query_sizes,
+            'failures' : query_failures,
+            'slowest' : query_slowest }
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+# How many of the latest backups of a vm its duration is the median of
+HISTORY = 5
+
+def parse_hhmm(text):
+    # Minutes after midnight of a time given as HHMM
+    if len(text) != 4 or not text.isdigit() or int(text[0:2]) > 23 or int(text[2:4]) > 59:
+        raise ValueError("time must be given as HHMM")
+    return int(text[0:2]) * 60 + int(text[2:4])
+
+def node_option(configuration, node, option, default):
+    return query_node(configuration, node).get(option, query_global(configuration).get(option, default))
+
+def node_schedule(configuration, node):
+    # The time, weekdays and days of the month a node is backed up, the same
+    # way virt-backup.py reads them. None means any day.
+    section = query_node(configuration, node)
+    weekdays = None
+    doms = None
+    if 'weekday' in section:
+        weekdays = frozenset(WEEKDAYS.index(day.strip().lower()[0:3]) for day in section['weekday'].split(","))
+    if 'dom' in section:
+        doms = frozenset(int(day) for day in section['dom'].split(","))
+    return parse_hhmm(section.get('time', query_global(configuration).get('start_at', '0100'))), weekdays, doms
+
+def recorded_durations(catalog):
+    # The durations and bytes read of the successful backups of every vm,
+    # latest first, and the throughput of all of them together
+    history = {}
+    if catalog is None:
+        return history, None
+    for vm, method, seconds, read in catalog.execute(
+            "SELECT vm, method, seconds, bytes FROM backup_sets WHERE outcome IN ('success', 'deleted') "
+            "AND seconds > 0 ORDER BY started DESC"):
+        history.setdefault(vm, []).append((method, seconds, read))
+    read, seconds = catalog.execute("SELECT SUM(bytes), SUM(seconds) FROM backup_sets WHERE "
+                                    "outcome IN ('success', 'deleted') AND seconds > 0 AND bytes > 0").fetchone()
+    return history, seconds and read / seconds or None
+
+def estimate_duration(history, rate, fallback, vm, method):
+    # How long a backup of vm takes and at how many bytes per second it reads,
+    # along with what the estimate is based on. Goes by the latest backups made
+    # with the same method, else by the size of the latest backup and the
+    # measured throughput, else by the median of all vms.
+    runs = history.get(vm, [])
+    same = [run for run in runs if run[0] == method][:HISTORY]
+    if same:
+        seconds = statistics.median(run[1] for run in same)
+        return seconds, same[0][2] / seconds, "history"
+    if runs and rate and runs[0][2] > 0:
+        return runs[0][2] / rate, rate, "size"
+    if runs:
+        seconds = statistics.median(run[1] for run in runs[:HISTORY])
+        return seconds, runs[0][2] / seconds, "history"
+    return fallback, None, "default"
+
+def format_duration(seconds):
+    return "{:d}:{:02d}".format(int(seconds // 3600), int(seconds % 3600 // 60))
+
+def simulate(runs, max_jobs, max_jobs_per_host, delay):
+    # Run the due backups as the daemon does: a backup is started once it
+    # is due and a job slot is free, a slot being held for delay seconds
+    # after its backup. The hosts take turns, the least busy host going
+    # next, and the backups of a host go in order of due time and priority.
+    # A backup falling due while the previous one of its vm has not
+    # finished is skipped and removed from runs. Each run is a dict and
+    # gets its start and end filled in.
+    runs.sort(key=lambda run: (run['due'], run['priority'], run['vm']))
+    pending = []
+    slots = []
+    busy = {}
+    ends = {}
+    clock = runs and runs[0]['due']
+    i = 0
+    while i < len(runs) or pending:
+        while slots and slots[0] <= clock:
+            heapq.heappop(slots)
+        for host in busy.values():
+            while host and host[0] <= clock:
+                heapq.heappop(host)
+        while i < len(runs) and runs[i]['due'] <= clock:
+            run = runs[i]
+            i += 1
+            if run['vm'] in ends and ends[run['vm']] > clock:
+                run['skipped'] = True
+                continue
+            ends[run['vm']] = datetime.max
+            pending.append(run)
+
+        run = None
+        if len(slots) < max_jobs:
+            candidates = [run for run in pending
+                          if max_jobs_per_host == 0 or len(busy.get(run['uri'], [])) < max_jobs_per_host]
+            if candidates:
+                run = min(candidates, key=lambda run: (len(busy.get(run['uri'], [])), run['due'],
+                                                       run['priority'], run['vm']))
+
+        if run is None:
+            # Move on to the next backup falling due or slot freeing up
+            events = slots[:1] + [host[0] for host in busy.values() if host]
+            if i < len(runs):
+                events.append(runs[i]['due'])
+            clock = min(events)
+            continue
+
+        pending.remove(run)
+        run['start'] = clock
+        run['end'] = clock + timedelta(seconds=run['seconds'])
+        ends[run['vm']] = run['end']
+        heapq.heappush(slots, run['end'] + timedelta(seconds=delay))
+        heapq.heappush(busy.setdefault(run['uri'], []), run['end'])
+
+    runs[:] = [run for run in runs if not run.get('skipped')]
+
+def peak_load(runs):
+    # Highest number of backups running at once and the highest read rate
+    # of the backups running at once, in bytes per second
+    events = []
+    for run in runs:
+        events.append((run['start'], 1, run['rate'] or 0))
+        events.append((run['end'], -1, -(run['rate'] or 0)))
+    events.sort(key=lambda event: (event[0], event[1]))
+    jobs = peak_jobs = 0
+    rate = peak_rate = 0
+    for when, count, bps in events:
+        jobs += count
+        rate += bps
+        peak_jobs = max(peak_jobs, jobs)
+        peak_rate = max(peak_rate, rate)
+    return peak_jobs, peak_rate
+
+def plan(configfile, catalog, first, days, window):
+    configuration = read_config(configfile)
+    history, rate = recorded_durations(catalog)
+    durations = [run[1] for runs in history.values() for run in runs[:HISTORY]]
+    fallback = durations and statistics.median(durations) or 3600
+
+    start_at = query_global(configuration).get('start_at', '0100')
+    window_start, window_end = [parse_hhmm(hhmm) for hhmm in (window or start_at + "-0700").split("-")]
+    if window_end <= window_start:
+        window_end += 24 * 60
+
+    # Expand the schedule of every node over the days to plan
+    runs = []
+    for node in list_nodes(configuration):
+        try:
+            minute, weekdays, doms = node_schedule(configuration, node)
+        except ValueError as err:
+            print("Warning: Invalid schedule given for {node}: {err}".format(node=node, err=err))
+            continue
+        method = node_option(configuration, node, 'method', 'suspend')
+        seconds, bps, source = estimate_duration(history, rate, fallback, node, method)
+        priority = max(1, min(99, int(query_node(configuration, node).get('priority', 99))))
+        uri = node_option(configuration, node, 'uri', 'qemu:///system')
+        for day in range(days):
+            date = first + timedelta(day)
+            if (weekdays is None or date.weekday() in weekdays) and (doms is None or date.day in doms):
+                runs.append({ 'vm' : node, 'priority' : priority, 'uri' : uri, 'date' : date,
+                              'due' : date + timedelta(minutes=minute), 'seconds' : seconds,
+                              'rate' : bps, 'source' : source })
+
+    simulate(runs, max(1, int(query_global(configuration).get('max_jobs', 1))),
+             max(0, int(query_global(configuration).get('max_jobs_per_host', 0))),
+             int(query_global(configuration).get('delay', 30)))
+
+    # The window a backup should finish in is the one of the day it is due
+    print("{start:<16} {end:<16} {node:<20} {priority:>4} {duration:>6} {source:<8}".format(start="Start",
+        end="End", node="VM", priority="Prio", duration="Time", source="Basis"))
+    for run in sorted(runs, key=lambda run: (run['start'], run['vm'])):
+        run['overrun'] = run['end'] > run['date'] + timedelta(minutes=window_end)
+        print("{start:<16} {end:<16} {node:<20} {priority:>4} {duration:>6} {source:<8} {overrun}".format(
+            start=run['start'].strftime("%F %H:%M"), end=run['end'].strftime("%F %H:%M"), node=run['vm'],
+            priority=run['priority'], duration=format_duration(run['seconds']), source=run['source'],
+            overrun=run['overrun'] and "OVERRUN" or "").rstrip())
+    print()
+
+    print("{date:<10} {window:<11} {jobs:>5} {end:<16} {overruns:>8} {peak:>5} {rate:>10}".format(date="Date",
+        window="Window", jobs="Jobs", end="Last end", overruns="Overruns", peak="Peak", rate="Peak MiB/s"))
+    for day in range(days):
+        date = first + timedelta(day)
+        daily = [run for run in runs if run['date'] == date]
+        if not daily:
+            continue
+        peak_jobs, peak_rate = peak_load(daily)
+        print("{date:<10} {window:<11} {jobs:>5} {end:<16} {overruns:>8} {peak:>5} {rate:>10.1f}".format(
+            date=date.strftime("%F"), window="{:02d}:{:02d}-{:02d}:{:02d}".format(window_start // 60,
+            window_start % 60, window_end // 60 % 24, window_end % 60), jobs=len(daily),
+            end=max(run['end'] for run in daily).strftime("%F %H:%M"),
+            overruns=sum(run['overrun'] for run in daily), peak=peak_jobs, rate=peak_rate / 1048576.))
+
 def main():
     parser = argparse.ArgumentParser(description='Query information from virt-backup')
     parser.add_argument('--config', action='store', default='virt-backup.conf', nargs='*', metavar='FILE',
                         help='Input several files for comparision (default: %(default)s)')
+    parser.add_argument('--query', choices=sorted(QUERIES.keys()),
+                        help='Query the backup catalog: latest backup per VM, total size per VM, '
+                             'failed backups or slowest backups')
+    parser.add_argument('--catalog', metavar='FILE',
+                        help='Backup catalog to query (default: catalog.db in backup_dir of the first config)')
+    parser.add_argument('--limit', type=int, default=20,
+                        help='Number of rows shown by failures and slowest (default: %(default)s)')
+    parser.add_argument('--plan', action='store_true',
+                        help='Project when the backups of each config start and end, going by '
+                             'the durations recorded in the catalog')
+    parser.add_argument('--from', dest='first', metavar='YYYY-MM-DD',
+                        type=lambda date: datetime.strptime(date, "%Y-%m-%d"),
+                        default=datetime.now().replace(hour=0, minute=0, second=0, microsecond=0),
+                        help='First day to plan (default: today)')
+    parser.add_argument('--days', type=int, default=7,
+                        help='Number of days to plan (default: %(default)s)')
+    parser.add_argument('--window', metavar='HHMM-HHMM',
+                        help='Backup window backups should finish within (default: start_at to 0700)')
 
     results = parser.parse_args()
 
@@ -45,6 +321,38 @@ def main():
     if (type(results.config) != type([])):
         results.config = results.config.split()
 
+    if results.query:
+        if not results.catalog:
+            if os.path.exists(results.config[0]) == False:
+                print("Error: Configfile {} does not exist".format(results.config[0]))
+                return
+            results.catalog = catalog_path(results.config[0])
+        if os.path.exists(results.catalog) == False:
+            print("Error: Catalog {} does not exist".format(results.catalog))
+            return
+        QUERIES[results.query](open_catalog(results.catalog), results.limit)
+        return
+
+    if results.plan:
+        for configfile in results.config:
+            if os.path.exists(configfile) == False:
+                print("Error: Configfile {} does not exist".format(configfile))
+                continue
+            catalog = results.catalog or catalog_path(configfile)
+            if os.path.exists(catalog) == False:
+                print("Warning: Catalog {} does not exist, durations are guessed".format(catalog))
+                catalog = None
+            else:
+                catalog = open_catalog(catalog)
+            print("Plan of {configfile} for {days} day(s) from {first}".format(configfile=configfile,
+                days=results.days, first=results.first.strftime("%F")))
+            try:
+                plan(configfile, catalog, results.first, results.days, results.window)
+            except ValueError as err:
+                print("Error: {}".format(err))
+            print()
+        return
+
     nodes = {}
 
     # Read each configfile given as argument
@@ -1,15 +1,28 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Magnus Strahlert @ 180305
 #  List memory & cpu of all KVM VMs along with the grand total
 
-from subprocess import PIPE, Popen
-import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import csv
+import sys
+import libvirt
 
-def cmdline(command):
-  process = Popen(args = command, stdout = PIPE, shell = True,
-                  universal_newlines = True)
-  return process.communicate()[0]
+STATES = { libvirt.VIR_DOMAIN_NOSTATE : "no state",
+           libvirt.VIR_DOMAIN_RUNNING : "running",
+           libvirt.VIR_DOMAIN_BLOCKED : "idle",
+           libvirt.VIR_DOMAIN_PAUSED : "paused",
+           libvirt.VIR_DOMAIN_SHUTDOWN : "in shutdown",
+           libvirt.VIR_DOMAIN_SHUTOFF : "shut off",
+           libvirt.VIR_DOMAIN_CRASHED : "crashed",
+           libvirt.VIR_DOMAIN_PMSUSPENDED : "pmsuspended" }
+
+# Fields of a domain in the order they are written as csv
+FIELDS = [ "host", "name", "title", "state", "memory", "memory_current", "vcpu",
+           "vcpu_current", "disk_capacity", "disk_allocation", "disk_read",
+           "disk_written", "net_rx", "net_tx" ]
 
 def truncate(text, maxlen):
   if not text:
@@ -19,37 +32,100 @@ def truncate(text, maxlen):
 
   return text
 
+def get_title(dom):
+  # The title is not part of the domain stats and has to be asked for
+  try:
+    return dom.metadata(libvirt.VIR_DOMAIN_METADATA_TITLE, None)
+  except libvirt.libvirtError:
+    return None
+
+def sum_stats(record, prefix, field):
+  return sum(record.get("{prefix}.{i}.{field}".format(prefix=prefix, i=i, field=field), 0)
+             for i in range(record.get("{prefix}.count".format(prefix=prefix), 0)))
+
+def query_host(uri):
+  # Collect the stats of every domain on a host in a single call. Memory is
+  # in KiB, disk and network in bytes.
+  conn = libvirt.openReadOnly(uri)
+  try:
+    records = conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE |
+                                     libvirt.VIR_DOMAIN_STATS_BALLOON |
+                                     libvirt.VIR_DOMAIN_STATS_VCPU |
+                                     libvirt.VIR_DOMAIN_STATS_BLOCK |
+                                     libvirt.VIR_DOMAIN_STATS_INTERFACE)
+    domains = []
+    for dom, record in records:
+      domains.append({ "host" : uri,
+                       "name" : dom.name(),
+                       "title" : get_title(dom),
+                       "state" : STATES.get(record.get("state.state"), "unknown"),
+                       "memory" : record.get("balloon.maximum", 0),
+                       "memory_current" : record.get("balloon.current", 0),
+                       "vcpu" : record.get("vcpu.maximum", 0),
+                       "vcpu_current" : record.get("vcpu.current", 0),
+                       "disk_capacity" : sum_stats(record, "block", "capacity"),
+                       "disk_allocation" : sum_stats(record, "block", "allocation"),
+                       "disk_read" : sum_stats(record, "block", "rd.bytes"),
+                       "disk_written" : sum_stats(record, "block", "wr.bytes"),
+                       "net_rx" : sum_stats(record, "net", "rx.bytes"),
+                       "net_tx" : sum_stats(record, "net", "tx.bytes") })
+  finally:
+    conn.close()
+
+  return sorted(domains, key=lambda dom: dom['name'])
+
+def totals(domains):
+  return { "memory" : sum(dom['memory'] for dom in domains),
+           "memory_active" : sum(dom['memory'] for dom in domains
+                                 if dom['state'] == "running"),
+           "vcpu" : sum(dom['vcpu'] for dom in domains),
+           "domains" : len(domains) }
+
+def print_total(title, total):
+  print("{title:>35}: {mem:.2f}Gb ({memact:.2f}Gb active), {vcpu} "
+        "vcpu".format(title=title, mem=total['memory'] / 1024 / 1024.,
+        memact=total['memory_active'] / 1024 / 1024., vcpu=total['vcpu']))
+
 def main():
-  guest_vms = cmdline("virsh list --all --table")
-
-  _memtot=0
-  _memacttot=0
-  _cputot=0
-
-  arr = {}
-  for (i, vm) in enumerate(guest_vms.splitlines()):
-    if len(vm.split()) == False or len(vm.split()) < 3 or vm.split()[0] == "Id":
-      continue
-
-    arr[i] = vm.split()
-
-  for vm in sorted(arr.items(), key=lambda item: item[1][1]):
-    xmlroot = ET.fromstring(cmdline("virsh dumpxml %s" % vm[1][1]))
-    _mem = xmlroot.findtext("memory")
-    _cpu = xmlroot.findtext("vcpu")
-    _title = xmlroot.findtext("title")
-    _memtot += int(_mem)
-    _cputot += int(_cpu)
-    if " ".join(vm[1][2:]) == "running":
-      _memacttot += int(_mem)
-
-    print(u"{title:>35}: {mem:.2f}Gb, {vcpu} vcpu, {state}".format(
-          title=truncate(_title, 34) or vm[1][1], mem=int(_mem) / 1024 / 1024.,
-          vcpu=_cpu, state=" ".join(vm[1][2:])).encode('utf-8'))
-
-  print(u"{title:>35}: {mem:.2f}Gb ({memact:.2f}Gb active), {vcpu} "
-         "vcpu".format(title="** Total **", mem=int(_memtot) / 1024 / 1024.,
-         memact=int(_memacttot) / 1024 / 1024., vcpu=_cputot).encode('utf-8'))
+  parser = argparse.ArgumentParser(description='List memory & cpu of all KVM VMs')
+  parser.add_argument('--hosts', nargs='+', default=['qemu:///system'], metavar='URI',
+                      help='Connection URIs to query concurrently (default: %(default)s)')
+  parser.add_argument('--format', choices=['text', 'json', 'csv'], default='text',
+                      help='Output format (default: %(default)s)')
+  results = parser.parse_args()
+
+  hosts = {}
+  with ThreadPoolExecutor(max_workers=len(results.hosts)) as executor:
+    for uri, future in [(uri, executor.submit(query_host, uri)) for uri in results.hosts]:
+      try:
+        hosts[uri] = future.result()
+      except libvirt.libvirtError as err:
+        print("Error: Cannot query {uri}: {err}".format(uri=uri, err=err), file=sys.stderr)
+
+  domains = [dom for uri in results.hosts if uri in hosts for dom in hosts[uri]]
+
+  if results.format == "json":
+    print(json.dumps({ "hosts" : [{ "uri" : uri, "domains" : hosts[uri],
+                                    "totals" : totals(hosts[uri]) }
+                                  for uri in results.hosts if uri in hosts],
+                       "totals" : totals(domains) }, indent=2))
+  elif results.format == "csv":
+    writer = csv.DictWriter(sys.stdout, fieldnames=FIELDS)
+    writer.writeheader()
+    writer.writerows(domains)
+  else:
+    for uri in results.hosts:
+      if uri not in hosts:
+        continue
+      if len(results.hosts) > 1:
+        print("{title:>35}".format(title="** {uri} **".format(uri=uri)))
+      for dom in hosts[uri]:
+        print("{title:>35}: {mem:.2f}Gb, {vcpu} vcpu, {state}".format(
+              title=truncate(dom['title'], 34) or dom['name'],
+              mem=dom['memory'] / 1024 / 1024., vcpu=dom['vcpu'], state=dom['state']))
+      if len(results.hosts) > 1:
+        print_total("** Host total **", totals(hosts[uri]))
+    print_total("** Total **", totals(domains))
 
 if __name__ == "__main__":
   main()
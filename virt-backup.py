@@ -15,47 +15,205 @@ import configparser
 from datetime import datetime
 from datetime import timedelta
 from glob import glob
-from subprocess import PIPE, Popen
+from subprocess import PIPE, Popen, call
+from queue import SimpleQueue, Empty
 import getopt
 import time
 import sys
 import os
 import shutil
 import fnmatch
+import threading
+import errno
+import json
+import mmap
+import zlib
+import fcntl
+import hashlib
+import heapq
+import sqlite3
+import gzip
+import atexit
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+from collections import namedtuple, deque
 import libvirt
 
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+try:
+  import boto3
+except ImportError:
+  boto3 = None
+
 def cmdline(command):
   process = Popen(args = command, stdout = PIPE, shell = True,
                   universal_newlines = True)
   return process.communicate()[0]
 
+class LogWriter:
+  # Writes the messages of tprint() from a thread of its own, so that
+  # logging never waits for the disk. Messages are queued with the time
+  # they were logged and written in batches, with one flush per batch.
+  # Log files are kept open and only reopened when the name they expand
+  # to through strftime(3) changes. Messages are written either as text or,
+  # with format json, as JSON lines along with the vm and phase they were
+  # logged in.
+  BATCH = 1000
+
+  def __init__(self):
+    self.queue = SimpleQueue()
+    self.format = "text"
+    self.files = {}
+    self.lock = threading.Lock()
+    self.thread = None
+    self.context = threading.local()
+
+  def configure(self, format):
+    self.format = format
+
+  def write(self, msg, logfile):
+    if self.thread == None:
+      with self.lock:
+        if self.thread == None:
+          self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+          self.thread.start()
+    self.queue.put((time.time(), msg, logfile, self.format,
+                    getattr(self.context, "vm", None), getattr(self.context, "phase", None)))
+
+  def open(self, logfile, stamp):
+    # Return the open file of a logfile pattern at the given time. The name
+    # is only expanded again once a second has passed.
+    second = int(stamp)
+    current = self.files.get(logfile)
+    if current != None and current['second'] == second:
+      return current['file']
+    name = time.strftime(logfile, time.localtime(stamp))
+    if current != None and current['name'] == name:
+      current['second'] = second
+      return current['file']
+    if current != None:
+      current['file'].close()
+    self.files[logfile] = { "name" : name, "second" : second,
+                            "file" : open(name, "a") }
+    return self.files[logfile]['file']
+
+  def run(self):
+    while True:
+      batch = [self.queue.get()]
+      while len(batch) < self.BATCH:
+        try:
+          batch.append(self.queue.get_nowait())
+        except Empty:
+          break
+
+      written = set()
+      for record in batch:
+        if record == None:
+          self.flush(written)
+          return
+        stamp, msg, logfile, format, vm, phase = record
+        line = "{datetime}: {msg}".format(datetime=time.ctime(stamp), msg=msg)
+        print(line)
+        if logfile == False:
+          continue
+        try:
+          log = self.open(logfile, stamp)
+          if format == "json":
+            log.write(json.dumps({ "time" : datetime.fromtimestamp(stamp).isoformat(),
+                                   "vm" : vm, "phase" : phase, "msg" : msg }) + "\n")
+          else:
+            log.write(line + "\n")
+          written.add(logfile)
+        except OSError as err:
+          print("Error: Cannot write to {logfile}: {err}".format(logfile=logfile, err=err))
+      self.flush(written)
+
+  def flush(self, written):
+    # Files rotated within the batch were flushed as they were closed
+    sys.stdout.flush()
+    for logfile in written:
+      try:
+        self.files[logfile]['file'].flush()
+      except OSError:
+        pass
+
+  def close(self):
+    # Write what is queued and stop the writer
+    if self.thread != None:
+      self.queue.put(None)
+      self.thread.join(10)
+
+log_writer = LogWriter()
+atexit.register(log_writer.close)
+
+@contextmanager
+def log_context(**context):
+  # Tag messages logged by this thread within the block with the given vm
+  # and phase
+  saved = dict((key, getattr(log_writer.context, key, None)) for key in context)
+  for key, value in context.items():
+    setattr(log_writer.context, key, value)
+  try:
+    yield
+  finally:
+    for key, value in saved.items():
+      setattr(log_writer.context, key, value)
+
 # Print function to get a timestamp infront of the string
 def tprint(msg, logfile = False):
-  print("{datetime}: {msg}".format(datetime=datetime.today().ctime(), msg=msg))
+  log_writer.write(msg, logfile)
 
-  if logfile != False:
-    now = datetime.now()
-    logfile = now.strftime(logfile)
-    with open(logfile, "a") as log:
-      log.write("{datetime}: {msg}\n".format(datetime=datetime.today().ctime(), msg=msg))
-
-def conffile_mtime():
+def parse_cmdline():
   try:
-    opts, remainder = getopt.getopt(sys.argv[1:], "c:")
+    opts, remainder = getopt.getopt(sys.argv[1:], "c:", ["rebuild=", "set=",
+                                                         "next-runs", "verify",
+                                                         "restore", "to=", "dry-run"])
   except getopt.GetoptError:
-    print("Syntax: {cmd} [ -c <configfile ]".format(cmd=sys.argv[0]))
+    print("Syntax: {cmd} [ -c <configfile> ] [ --rebuild=<dir> [ --set=<name> ] | "
+          "--restore [ --set=<name> ] [ --to=<dir> ] [ --dry-run ] | "
+          "--verify [ --set=<name>|all ] | --next-runs ] [ vm ... ]".format(cmd=sys.argv[0]))
     sys.exit(2)
 
   # Defaults
   ####################################
-  configfile = "/etc/virt-backup.conf"
+  options = { "configfile" : "/etc/virt-backup.conf",
+              "rebuild" : None,
+              "set" : None,
+              "verify" : False,
+              "restore" : False,
+              "to" : None,
+              "dry_run" : False,
+              "next_runs" : False }
   ####################################
 
   for opt, arg in opts:
     if opt == '-c':
-      configfile = arg
-    else:
-      assertFalse("unknown option \"{opt}\"".format(opt=opt))
+      options['configfile'] = arg
+    elif opt == '--rebuild':
+      options['rebuild'] = arg
+    elif opt == '--set':
+      options['set'] = arg
+    elif opt == '--next-runs':
+      options['next_runs'] = True
+    elif opt == '--verify':
+      options['verify'] = True
+    elif opt == '--restore':
+      options['restore'] = True
+    elif opt == '--to':
+      options['to'] = arg
+    elif opt == '--dry-run':
+      options['dry_run'] = True
+
+  return options, remainder
+
+def conffile_mtime():
+  options, remainder = parse_cmdline()
+  configfile = options['configfile']
 
   if os.path.exists(configfile) == False:
     print("Error: Configfile \"{configfile}\" does not exist".format(configfile=configfile))
@@ -63,6 +221,80 @@ def conffile_mtime():
 
   return configfile, os.stat(configfile).st_mtime
 
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+def compile_schedule(time, weekday, dom):
+  # Turn the time, weekday and dom options of a client into a schedule
+  # that next_run() can evaluate without any further parsing. Raises
+  # ValueError on malformed options.
+  if len(time) != 4 or not time.isdigit():
+    raise ValueError("time must be given as HHMM")
+  schedule = { "hour" : int(time[0:2]),
+               "minute" : int(time[2:4]),
+               "weekdays" : None,
+               "doms" : None }
+  if schedule['hour'] > 23 or schedule['minute'] > 59:
+    raise ValueError("time must be given as HHMM")
+
+  if weekday != False:
+    schedule['weekdays'] = frozenset(WEEKDAYS.index(day.strip()[0:3])
+                                     for day in weekday.split(","))
+  if dom != False:
+    schedule['doms'] = frozenset(int(day) for day in dom.split(","))
+    if min(schedule['doms']) < 1 or max(schedule['doms']) > 31:
+      raise ValueError("dom must be between 1 and 31")
+
+  return schedule
+
+def next_run(schedule, after):
+  # Find the first time at or after the given datetime, truncated to the
+  # minute, that the schedule says a backup should run. Returns None if the
+  # schedule never matches.
+  after = after.replace(second=0, microsecond=0)
+  day = after.replace(hour=schedule['hour'], minute=schedule['minute'])
+  if day < after:
+    day += timedelta(1)
+
+  # Weekday and dom combined repeat within 28 years
+  for i in range(28 * 366):
+    if ((schedule['weekdays'] == None or day.weekday() in schedule['weekdays']) and
+        (schedule['doms'] == None or day.day in schedule['doms'])):
+      return day
+    day += timedelta(1)
+  return None
+
+def schedule_queue(backups, now):
+  # Build a priority queue of the next due backup of every client, ordered
+  # by time, then priority and then name
+  queue = []
+  for k, v in backups.items():
+    due = next_run(v['schedule'], now)
+    backups[k]['next_backup'] = due
+    if due != None:
+      queue.append((due, v['priority'], k))
+  heapq.heapify(queue)
+  return queue
+
+LIMITS = ["read_bps", "write_bps", "read_iops", "write_iops"]
+
+def parse_size(size):
+  # Turn a size like 100M into bytes. Suffixes are powers of 1024.
+  size = size.strip().upper()
+  for power, suffix in enumerate(["K", "M", "G", "T"], 1):
+    if size.endswith(suffix):
+      return int(float(size[:-1]) * 1024 ** power)
+  return int(size)
+
+def parse_limits(config, section):
+  # Read the I/O limits of a section. Missing or zero means unlimited.
+  limits = {}
+  for limit in LIMITS:
+    if config.has_option(section, limit):
+      limits[limit] = max(0, parse_size(config.get(section, limit)))
+    else:
+      limits[limit] = 0
+  return limits
+
 def parse_config(configfile):
   config = configparser.RawConfigParser()
   config.read(configfile)
@@ -76,6 +308,12 @@ def parse_config(configfile):
   api = config.get("global", "api")
   if api not in ["libvirt", "virt-backup"]:
     tprint("Error: Unknown api", logfile)
+  # Connection URI of the hypervisor the clients run on, unless they say
+  # otherwise. Only used with api libvirt.
+  if config.has_option("global", "uri"):
+    default_uri = config.get("global", "uri")
+  else:
+    default_uri = "qemu:///system"
 
   # Parse and check client specific configuration
   for f in clients:
@@ -101,24 +339,58 @@ def parse_config(configfile):
     # Verify method. Default method is set by global config if not entered.
     if config.has_option(f, "method"):
       method = config.get(f, "method")
-      if method not in ["suspend", "shutdown"]:
+      if method not in ["suspend", "shutdown", "quiesce", "incremental"]:
         tprint("Error: Unknown method given for {client}".format(client=f), logfile)
         continue
     else:
       method = config.get("global", "method")
 
+    if config.has_option(f, "uri"):
+      uri = config.get(f, "uri")
+    else:
+      uri = default_uri
+
     if config.has_option(f, "retention"):
       retention = int(config.get(f, "retention"))
     else:
       retention = int(config.get("global", "retention"))
 
+    # How many backups make up a chain of one full and its incrementals
+    if config.has_option(f, "full_interval"):
+      full_interval = max(1, int(config.get(f, "full_interval")))
+    elif config.has_option("global", "full_interval"):
+      full_interval = max(1, int(config.get("global", "full_interval")))
+    else:
+      full_interval = 7
+
+    # Compression level of the backups made with api libvirt. Default is the
+    # default level of compress_format.
+    if config.has_option(f, "compress_level"):
+      compress_level = int(config.get(f, "compress_level"))
+    elif config.has_option("global", "compress_level"):
+      compress_level = int(config.get("global", "compress_level"))
+    else:
+      compress_level = None
+
+    try:
+      schedule = compile_schedule(time, weekday, dom)
+    except ValueError as err:
+      tprint("Error: Invalid schedule given for {client}: {err}".format(client=f,
+             err=err), logfile)
+      continue
+
     # Populate our dictionary of configurations per client
     backups[f] = { "priority" : priority,
+                   "uri" : uri,
+                   "limits" : parse_limits(config, f),
                    "method" : method,
                    "retention" : retention,
+                   "full_interval" : full_interval,
+                   "compress_level" : compress_level,
                    "weekday" : weekday,
                    "time" : time,
                    "dom" : dom,
+                   "schedule" : schedule,
                    "last_backup" : datetime(1970, 1, 1),
                    "next_backup" : False }
 
@@ -131,6 +403,20 @@ def parse_config(configfile):
     delay=config.get("global", "delay")
   else:
     delay="30"
+  if config.has_option("global", "copy_engine"):
+    copy_engine = config.get("global", "copy_engine")
+    if copy_engine not in ["native", "qemu-img"]:
+      tprint("Error: Unknown copy_engine, using native", logfile)
+      copy_engine = "native"
+  else:
+    copy_engine = "native"
+  if config.has_option("global", "backup_format"):
+    backup_format = config.get("global", "backup_format")
+    if backup_format not in ["files", "chunkstore"]:
+      tprint("Error: Unknown backup_format, using files", logfile)
+      backup_format = "files"
+  else:
+    backup_format = "files"
   if config.has_option("global", "snapsize"):
     snapsize=config.get("global", "snapsize")
   else:
@@ -140,48 +426,381 @@ def parse_config(configfile):
   else:
     shutdown_timeout = "90"
 
+  # Concurrency limits. A value of 0 means unlimited for the per storage
+  # limits. The default of a single job keeps the old serialized behaviour.
+  if config.has_option("global", "max_jobs"):
+    max_jobs = max(1, int(config.get("global", "max_jobs")))
+  else:
+    max_jobs = 1
+  if config.has_option("global", "max_jobs_per_storage"):
+    max_jobs_per_storage = max(0, int(config.get("global", "max_jobs_per_storage")))
+  else:
+    max_jobs_per_storage = 0
+  if config.has_option("global", "max_jobs_per_backup_dir"):
+    max_jobs_per_backup_dir = max(0, int(config.get("global", "max_jobs_per_backup_dir")))
+  else:
+    max_jobs_per_backup_dir = 0
+  if config.has_option("global", "max_jobs_per_host"):
+    max_jobs_per_host = max(0, int(config.get("global", "max_jobs_per_host")))
+  else:
+    max_jobs_per_host = 0
+  if config.has_option("global", "checksum"):
+    checksum = config.get("global", "checksum")
+  else:
+    checksum = "blake2b"
+  if checksum not in ["blake2b", "none"]:
+    sys.exit("checksum must be either of blake2b or none")
+  if config.has_option("global", "verify_threads"):
+    verify_threads = max(1, int(config.get("global", "verify_threads")))
+  else:
+    verify_threads = os.cpu_count() or 1
+  if config.has_option("global", "max_disk_jobs"):
+    max_disk_jobs = max(1, int(config.get("global", "max_disk_jobs")))
+  else:
+    max_disk_jobs = 1
+  if config.has_option("global", "min_free_space"):
+    min_free_space = parse_size(config.get("global", "min_free_space"))
+  else:
+    min_free_space = 0
+
   if api != "libvirt":
     backup_prg = config.get("global", "backup_prg")
   else:
     backup_prg = None
   backup_dir = config.get("global", "backup_dir")
+  if config.has_option("global", "catalog"):
+    catalog = config.get("global", "catalog")
+  else:
+    catalog = os.path.join(backup_dir, "catalog.db")
 
   backup_command = ("{cmd} --action=convert --snapsize={snapsize} "
                     "--backupdir={backup_dir}".format(cmd=backup_prg,
                      snapsize=snapsize, backup_dir=backup_dir))
   backup_command += " --debug"
   if config.has_option("global", "compress"):
+    compress = config.getboolean("global", "compress")
+  else:
+    compress = False
+  if compress:
     backup_command += " --compress"
+  if config.has_option("global", "compress_format"):
+    compress_format = config.get("global", "compress_format")
+    if compress_format not in COMPRESSORS:
+      tprint("Error: Unknown compress_format, using zstd", logfile)
+      compress_format = "zstd"
+  else:
+    compress_format = "zstd"
+  if compress and compress_format == "zstd" and zstandard == None:
+    tprint("Python module zstandard is missing, compressing with gzip", logfile)
+    compress_format = "gzip"
+  if config.has_option("global", "compress_threads"):
+    compress_threads = max(1, int(config.get("global", "compress_threads")))
+  else:
+    compress_threads = os.cpu_count() or 1
+
+  if config.has_option("global", "ionice"):
+    ionice = config.get("global", "ionice")
+  else:
+    ionice = None
+  if config.has_option("global", "io_cgroup"):
+    io_cgroup = config.get("global", "io_cgroup")
+  else:
+    io_cgroup = None
+
+  if config.has_option("global", "log_format"):
+    log_format = config.get("global", "log_format")
+    if log_format not in ["text", "json"]:
+      tprint("Error: Unknown log_format, using text", logfile)
+      log_format = "text"
+  else:
+    log_format = "text"
+
+  # Where backup sets are kept. backup_dir always holds the catalog,
+  # journals and the files of running backups.
+  if config.has_option("global", "sink"):
+    sink_url = config.get("global", "sink")
+  else:
+    sink_url = "local"
+  if sink_url.startswith("s3://"):
+    if boto3 == None:
+      sys.exit("Python module boto3 is needed for sink {url}".format(url=sink_url))
+    if api != "libvirt":
+      sys.exit("Sink {url} requires api libvirt".format(url=sink_url))
+    if backup_format == "chunkstore":
+      tprint("Error: backup_format chunkstore requires sink local, using files", logfile)
+      backup_format = "files"
+    s3 = {}
+    for option in ["s3_endpoint", "s3_region", "s3_access_key", "s3_secret_key"]:
+      if config.has_option("global", option):
+        s3[option] = config.get("global", option)
+      else:
+        s3[option] = None
+    if config.has_option("global", "s3_part_size"):
+      s3_part_size = max(5 * 1024 * 1024, parse_size(config.get("global", "s3_part_size")))
+    else:
+      s3_part_size = 64 * 1024 * 1024
+    if config.has_option("global", "s3_upload_threads"):
+      s3_upload_threads = max(1, int(config.get("global", "s3_upload_threads")))
+    else:
+      s3_upload_threads = 4
+    sink = S3Sink(sink_url, backup_dir, s3['s3_endpoint'], s3['s3_region'],
+                  s3['s3_access_key'], s3['s3_secret_key'], s3_part_size, s3_upload_threads)
+  elif sink_url == "local":
+    sink = LocalSink(backup_dir)
+  else:
+    sys.exit("Unknown sink {url}".format(url=sink_url))
+
+  if config.has_option("global", "metrics_file"):
+    metrics_file = config.get("global", "metrics_file")
+  else:
+    metrics_file = None
+  if config.has_option("global", "summary_file"):
+    summary_file = config.get("global", "summary_file")
+  else:
+    summary_file = None
 
   global_config = { "delay" : delay,
+                    "metrics_file" : metrics_file,
+                    "summary_file" : summary_file,
+                    "configfile" : configfile,
+                    "limits" : parse_limits(config, "global"),
+                    "limits_mtime" : os.stat(configfile).st_mtime,
+                    "ionice" : ionice,
+                    "io_cgroup" : io_cgroup,
                     "snapsize" : snapsize,
                     "backup_prg" : backup_prg,
                     "backup_dir" : backup_dir,
+                    "copy_engine" : copy_engine,
+                    "backup_format" : backup_format,
+                    "catalog" : catalog,
                     "backup_command" : backup_command,
                     "shutdown_timeout" : shutdown_timeout,
+                    "max_jobs" : max_jobs,
+                    "max_jobs_per_storage" : max_jobs_per_storage,
+                    "max_jobs_per_backup_dir" : max_jobs_per_backup_dir,
+                    "max_jobs_per_host" : max_jobs_per_host,
+                    "max_disk_jobs" : max_disk_jobs,
+                    "min_free_space" : min_free_space,
+                    "checksum" : checksum,
+                    "compress" : compress,
+                    "compress_format" : compress_format,
+                    "compress_threads" : compress_threads,
+                    "verify_threads" : verify_threads,
                     "logfile" : logfile,
+                    "log_format" : log_format,
+                    "uri" : default_uri,
+                    "sink" : sink,
                     "api" : api }
 
   return global_config, backups
 
+# Threads waiting for a domain to reach a state, keyed by domain UUID. Filled
+# by wait_for_state() and woken by lifecycle events from libvirt.
+lifecycle_waiters = {}
+lifecycle_lock = threading.Lock()
+event_loop_started = threading.Event()
+
+# Which state a domain is in after a lifecycle event. A shutdown event only
+# means the guest has begun shutting down, it is shut off once stopped.
+LIFECYCLE_STATES = { libvirt.VIR_DOMAIN_EVENT_STOPPED : libvirt.VIR_DOMAIN_SHUTOFF,
+                     libvirt.VIR_DOMAIN_EVENT_SUSPENDED : libvirt.VIR_DOMAIN_PAUSED,
+                     libvirt.VIR_DOMAIN_EVENT_RESUMED : libvirt.VIR_DOMAIN_RUNNING,
+                     libvirt.VIR_DOMAIN_EVENT_STARTED : libvirt.VIR_DOMAIN_RUNNING }
+
+def start_event_loop():
+  # Run the default libvirt event loop in a thread of its own. Has to be
+  # done before the first connection is opened for events to be delivered.
+  if event_loop_started.is_set():
+    return
+  libvirt.virEventRegisterDefaultImpl()
+
+  def run():
+    while True:
+      libvirt.virEventRunDefaultImpl()
+
+  threading.Thread(target=run, name="libvirt-events", daemon=True).start()
+  event_loop_started.set()
+
+def lifecycle_callback(conn, dom, event, detail, opaque):
+  if event in [libvirt.VIR_DOMAIN_EVENT_DEFINED, libvirt.VIR_DOMAIN_EVENT_UNDEFINED]:
+    forget_domain(conn, dom.UUIDString())
+  state = LIFECYCLE_STATES.get(event)
+  if state == None:
+    return
+  with lifecycle_lock:
+    for waiter in lifecycle_waiters.get(dom.UUIDString(), []):
+      if waiter['state'] == state:
+        waiter['event'].set()
+
+def register_lifecycle_events(conn):
+  # Returns the callback id, or None if the connection cannot deliver events
+  try:
+    return conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                       lifecycle_callback, None)
+  except libvirt.libvirtError:
+    return None
+
+def wait_for_state(dom, state, action, timeout):
+  # Carry out action and wait at most timeout seconds for the domain to
+  # reach state. The waiter is registered before the action so that the
+  # event cannot be missed. The state is also checked every few seconds in
+  # case events are not delivered. Returns True if the state was reached.
+  waiter = { "state" : state, "event" : threading.Event() }
+  uuid = dom.UUIDString()
+  with lifecycle_lock:
+    lifecycle_waiters.setdefault(uuid, []).append(waiter)
+
+  try:
+    action()
+    deadline = time.monotonic() + timeout
+    while dom.state()[0] != state:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return False
+      waiter['event'].wait(min(remaining, 10))
+      waiter['event'].clear()
+    return True
+  finally:
+    with lifecycle_lock:
+      lifecycle_waiters[uuid].remove(waiter)
+      if len(lifecycle_waiters[uuid]) == 0:
+        del lifecycle_waiters[uuid]
+
+# Waiters for block jobs, keyed by (domain UUID, disk target)
+block_job_waiters = {}
+
+def block_job_callback(conn, dom, disk, type, status, opaque):
+  with lifecycle_lock:
+    waiter = block_job_waiters.get((dom.UUIDString(), disk))
+    if waiter != None:
+      waiter['status'] = status
+      waiter['event'].set()
+
+# Long lived libvirt connections, keyed by URI. Each connection carries a
+# cache of the domains looked up through it, keyed by UUID, along with a
+# map from domain name to UUID.
+connections = {}
+connections_lock = threading.RLock()
+
+DiskInfo = namedtuple('DiskInfo', ['device', 'file', 'format', 'backing'])
+
+def connection_entry(conn):
+  with connections_lock:
+    for entry in connections.values():
+      if entry['conn'] is conn:
+        return entry
+  return None
+
+def forget_domain(conn, uuid = None, name = None):
+  # Drop a domain, given by UUID or name, from the cache so that it is
+  # looked up anew
+  entry = connection_entry(conn)
+  if entry == None:
+    return
+  with connections_lock:
+    if uuid == None:
+      uuid = entry['names'].get(name)
+    cached = entry['domains'].pop(uuid, None)
+    if cached != None:
+      entry['names'].pop(cached['name'], None)
+
+def device_callback(conn, dom, dev, opaque):
+  forget_domain(conn, dom.UUIDString())
+
+def close_callback(conn, reason, opaque):
+  # The connection is gone, get_connection() opens a new one when needed
+  with connections_lock:
+    if opaque in connections and connections[opaque]['conn'] is conn:
+      del connections[opaque]
+
+def get_connection(uri = "qemu:///system"):
+  # Return an open connection to uri, reusing the previous one as long as
+  # it is alive. Keepalives detect a dead libvirtd, upon which the domain
+  # cache of the connection is thrown away with it.
+  with connections_lock:
+    entry = connections.get(uri)
+    if entry != None:
+      try:
+        if entry['conn'].isAlive() == 1:
+          return entry['conn']
+      except libvirt.libvirtError:
+        pass
+      del connections[uri]
+      try:
+        entry['conn'].close()
+      except libvirt.libvirtError:
+        pass
+
+    start_event_loop()
+    conn = libvirt.open(uri)
+    try:
+      conn.setKeepAlive(5, 3)
+    except libvirt.libvirtError:
+      # Not supported by local drivers such as test:///
+      pass
+    conn.registerCloseCallback(close_callback, uri)
+    register_lifecycle_events(conn)
+    for event, callback in [(libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED, device_callback),
+                            (libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED, device_callback),
+                            (libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2, block_job_callback)]:
+      try:
+        conn.domainEventRegisterAny(None, event, callback, None)
+      except libvirt.libvirtError:
+        pass
+    connections[uri] = { "conn" : conn, "domains" : {}, "names" : {} }
+    return conn
+
+def parse_disks(xml):
+  # Return a list of all file backed disks in a domain XML
+  root = ElementTree.fromstring(xml)
+
+  disks_info = []
+  for disk in root.findall("./devices/disk[@device='disk']"):
+    driver = disk.find("driver")
+    source = disk.find("source")
+    target = disk.find("target")
+    if driver == None or source == None or target == None or "file" not in source.attrib:
+      continue
+    disks_info.append(DiskInfo(target.attrib["dev"], source.attrib["file"],
+                               driver.attrib.get("type", "raw"),
+                               disk.find("backingStore/source") != None))
+  return disks_info
+
+def get_domain(conn, vm):
+  # Look up a domain along with its XML and disks, fetching and parsing the
+  # XML only when the domain is not already cached. Raises libvirtError if
+  # the domain does not exist.
+  entry = connection_entry(conn)
+  with connections_lock:
+    if entry != None and vm in entry['names']:
+      return entry['domains'][entry['names'][vm]]
+
+  dom = conn.lookupByName(vm)
+  xml = dom.XMLDesc()
+  cached = { "dom" : dom,
+             "name" : vm,
+             "uuid" : dom.UUIDString(),
+             "xml" : xml,
+             "disks" : parse_disks(xml) }
+  if entry != None:
+    with connections_lock:
+      entry['domains'][cached['uuid']] = cached
+      entry['names'][vm] = cached['uuid']
+  return cached
+
 def shutdown_vm(conn, vm, logfile, shutdown_timeout):
   try:
-    dom = conn.lookupByName(vm)
-  except:
+    dom = get_domain(conn, vm)['dom']
+  except libvirt.libvirtError:
     tprint("{vm} does not exist".format(vm=vm), logfile)
     return False
 
   if dom.state()[0] == libvirt.VIR_DOMAIN_RUNNING:
     tprint("{vm} is running, shutting down".format(vm=vm), logfile)
-    dom.shutdown()
-    shutdown_counter = 0
-    while (dom.state()[0] != libvirt.VIR_DOMAIN_SHUTOFF):
-      if (shutdown_counter >= int(shutdown_timeout)):
-        tprint("Timed out waiting for {vm} to shutdown".format(vm=vm), logfile)
-        return False
-
-      shutdown_counter += 1
-      time.sleep(1)
+    if not wait_for_state(dom, libvirt.VIR_DOMAIN_SHUTOFF, dom.shutdown,
+                          int(shutdown_timeout)):
+      tprint("Timed out waiting for {vm} to shutdown".format(vm=vm), logfile)
+      return False
     tprint("{vm} has now shutdown".format(vm=vm), logfile)
     return True
   else:
@@ -190,14 +809,17 @@ def shutdown_vm(conn, vm, logfile, shutdown_timeout):
 
 def suspend_vm(conn, vm, logfile):
   try:
-    dom = conn.lookupByName(vm)
-  except:
+    dom = get_domain(conn, vm)['dom']
+  except libvirt.libvirtError:
     tprint("{vm} does not exist".format(vm=vm), logfile)
     return False
 
   if dom.state()[0] == libvirt.VIR_DOMAIN_RUNNING:
     tprint("{vm} is running, suspending".format(vm=vm), logfile)
-    dom.suspend()
+    # Suspending is near instant, the timeout only guards against a hung qemu
+    if not wait_for_state(dom, libvirt.VIR_DOMAIN_PAUSED, dom.suspend, 30):
+      tprint("Timed out waiting for {vm} to suspend".format(vm=vm), logfile)
+      return False
     tprint("{vm} is now suspended".format(vm=vm), logfile)
     return True
   else:
@@ -206,8 +828,8 @@ def suspend_vm(conn, vm, logfile):
 
 def start_vm(conn, vm, logfile):
   try:
-    dom = conn.lookupByName(vm)
-  except:
+    dom = get_domain(conn, vm)['dom']
+  except libvirt.libvirtError:
     tprint("{vm} does not exist".format(vm=vm), logfile)
     return False
 
@@ -222,8 +844,8 @@ def start_vm(conn, vm, logfile):
 
 def resume_vm(conn, vm, logfile):
   try:
-    dom = conn.lookupByName(vm)
-  except:
+    dom = get_domain(conn, vm)['dom']
+  except libvirt.libvirtError:
     tprint("{vm} does not exist".format(vm=vm), logfile)
     return False
 
@@ -236,214 +858,3393 @@ def resume_vm(conn, vm, logfile):
     tprint("{vm} is not suspended, nothing to do".format(vm=vm), logfile)
     return False
 
+# Seconds to wait for the guest agent to answer
+AGENT_TIMEOUT = 10
+
+def freeze_vm(conn, vm, logfile):
+  # Freeze the filesystems of a running guest through its guest agent.
+  # Returns True if frozen, None if the agent could not be reached and
+  # False if there is nothing to freeze.
+  try:
+    dom = get_domain(conn, vm)['dom']
+  except libvirt.libvirtError:
+    tprint("{vm} does not exist".format(vm=vm), logfile)
+    return False
+
+  if dom.state()[0] != libvirt.VIR_DOMAIN_RUNNING:
+    tprint("{vm} is not running, nothing to do".format(vm=vm), logfile)
+    return False
+
+  # Do not let a hung agent keep the guest frozen for long
+  try:
+    dom.agentSetResponseTimeout(AGENT_TIMEOUT, 0)
+  except (AttributeError, libvirt.libvirtError):
+    pass
+  try:
+    count = dom.fsFreeze()
+  except libvirt.libvirtError as err:
+    tprint("Cannot freeze {vm} through its guest agent: {err}".format(vm=vm, err=err),
+           logfile)
+    return None
+  tprint("{vm} is now frozen, {count} filesystem(s)".format(vm=vm, count=count), logfile)
+  return True
+
+def thaw_vm(conn, vm, logfile):
+  # Thaw the filesystems of a guest, retrying a few times since the guest
+  # cannot write until it succeeds
+  dom = get_domain(conn, vm)['dom']
+  for attempt in range(3):
+    try:
+      dom.fsThaw()
+      tprint("{vm} is now thawed".format(vm=vm), logfile)
+      return True
+    except libvirt.libvirtError as err:
+      tprint("Error: Thawing {vm} failed: {err}".format(vm=vm, err=err), logfile)
+      time.sleep(1)
+  return False
+
 def save_xml(conn, vm, logfile, path):
-  dom = conn.lookupByName(vm)
   with open(path, "w") as xml:
-    xml.write(dom.XMLDesc())
+    xml.write(get_domain(conn, vm)['xml'])
 
-# Return a tuple of all disks that the VM has
+# Return a list of all disks that the VM has
 def get_disks(conn, vm):
-  from xml.etree import ElementTree
-  from collections import namedtuple
+  return get_domain(conn, vm)['disks']
 
-  dom = conn.lookupByName(vm)
-  root = ElementTree.fromstring(dom.XMLDesc())
+def qemu_img_info(file):
+  # Return the information qemu-img has about an image as a dictionary
+  disk_info = cmdline("qemu-img info --force-share --output=json {file}".format(file=file))
+  try:
+    return json.loads(disk_info)
+  except ValueError:
+    return {}
 
-  disks = root.findall("./devices/disk[@device='disk']")
+def get_backing_file(file):
+  # Find out the backing file of a snapshot
+  return qemu_img_info(file).get("backing-filename", False)
 
-  drivers = [disk.find("driver").attrib for disk in disks]
-  sources = [disk.find("source").attrib for disk in disks]
-  targets = [disk.find("target").attrib for disk in disks]
+# Size of the buffer used when the copy has to pass through userspace.
+# A multiple of the page size so that it can be used for O_DIRECT alike
+# aligned I/O.
+COPY_BUFSIZE = 8 * 1024 * 1024
+# How much data is copied between syncs that allow a copy to be resumed
+COPY_SYNC_INTERVAL = 1024 * 1024 * 1024
 
-  if len(drivers) != len(sources) != len(targets):
-    return False
+class TokenBucket:
+  # Rate limiter shared between threads. Consumers may take more tokens than
+  # are available and then sleep off the debt, which keeps large requests
+  # from starving. A rate of 0 means unlimited.
+  def __init__(self, rate = 0):
+    self.lock = threading.Lock()
+    self.rate = rate
+    self.tokens = rate
+    self.stamp = time.monotonic()
 
-  disk_info = namedtuple('DiskInfo', ['device', 'file', 'format'])
-  disks_info = []
-  for i in range(len(sources)):
-    disks_info.append(disk_info(targets[i]["dev"], sources[i]["file"], drivers[i]["type"]))
-  return disks_info
+  def set_rate(self, rate):
+    with self.lock:
+      self.rate = rate
+      self.tokens = min(self.tokens, rate)
 
-def get_backing_file(file):
-  # Find out the backing file of a snapshot
-  disk_info = cmdline("qemu-img info --force-share {file}".format(file=file))
-  for line in disk_info.splitlines():
-    key, value = line.split(": ")
-    if key == "backing file":
-      return value
+  def consume(self, amount):
+    with self.lock:
+      if self.rate <= 0:
+        return
+      now = time.monotonic()
+      # At most one second worth of tokens is saved up
+      self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+      self.stamp = now
+      self.tokens -= amount
+      wait = -self.tokens / self.rate
+    if wait > 0:
+      time.sleep(wait)
 
-  return False
+# Token buckets keyed by (scope, limit), where scope is "global" for the
+# limits shared by all backups or the name of a client
+buckets = {}
+buckets_lock = threading.Lock()
 
-def libvirt_snapshot(conn, vm, logfile):
-  disks = []
-  # For every disk of the VM, create an external snapshot
-  for disk in get_disks(conn, vm):
-    tprint("Snapshotting {disk}".format(disk=disk.file), logfile)
-    disks += ["--diskspec {device},snapshot=external".format(device=disk.device)]
-  os.system("virsh snapshot-create-as --domain {vm} --name {snapshot} "
-            "--no-metadata --atomic --disk-only {disks}".format(vm=vm,
-            snapshot=datetime.now().strftime("%F_%H-%M-%S"), disks=" ".join(disks)))
+def get_bucket(scope, limit):
+  with buckets_lock:
+    if (scope, limit) not in buckets:
+      buckets[(scope, limit)] = TokenBucket()
+    return buckets[(scope, limit)]
 
-def libvirt_backup(conn, vm, logfile, backup_dir):
-  if not os.path.isdir("{dir}/{name}".format(dir=backup_dir, name=vm)):
-    os.mkdir("{dir}/{name}".format(dir=backup_dir, name=vm))
-  save_xml(conn, vm, logfile, "{dir}/{vm}/{vm}.xml".format(dir=backup_dir, vm=vm))
+def apply_limits(global_config, backups):
+  # Set the rates of all token buckets from the configuration. Copies in
+  # progress pick up the new rates right away.
+  for limit in LIMITS:
+    get_bucket("global", limit).set_rate(global_config['limits'][limit])
+    for k, v in backups.items():
+      get_bucket(k, limit).set_rate(v['limits'][limit])
 
-  disks = []
-  # Copy the backing qcow2 file(s) away as the backup, merge the
-  # snapshots of all disks and then delete the snapshot itself.
-  for disk in get_disks(conn, vm):
-    inf = get_backing_file(disk.file)
-    outf = "{dir}/{vm}/{basename}".format(dir=backup_dir, vm=vm, basename=os.path.basename(inf))
- 
-    tprint("Copying {inf}".format(inf=inf), logfile)
-    os.system("qemu-img convert -q -f qcow2 -O qcow2 {inf} {outf}".format(inf=inf, outf=outf))
-    #shutil.copy2(get_backing_file(disk.file), "%s/%s" % (backup_dir, vm))
-    os.system("virsh blockcommit {vm} {device} --active --pivot".format(vm=vm, device=disk.device))
-    tprint("Removing snapshot {file}".format(file=disk.file), logfile)
-    os.remove(disk.file)
-
-def do_backup(global_config, backups, vms = None):
-  # Loop through the clients sorted in order of priority
-  for k, v in sorted(backups.items(), key=lambda item: (item[1]['priority'],
-                     item[0])):
-    # If true this is run in daemon mode and should backup all
-    if vms == None:
-      # First check if now is a good time to run backup for this client
-      now = datetime.now()
+class Throttle:
+  # The I/O limits a copy is held to, both the global and the client ones
+  def __init__(self, global_config, vm):
+    self.scopes = ["global", vm]
+    self.global_config = global_config
 
-      if (v['weekday'] != False and now.strftime('%A').lower()[0:3] not in
-          v['weekday'].split(",")):
-        # Wrong weekday
-        continue
-      if (v['dom'] != False and int(now.strftime('%-d')) not in
-          map(int, v['dom'].split(","))):
-        # Wrong day of month
-        continue
+  def read(self, nbytes):
+    for scope in self.scopes:
+      get_bucket(scope, "read_iops").consume(1)
+      get_bucket(scope, "read_bps").consume(nbytes)
 
-      # Check if we have done a prior backup. If not, work out when it's due
-      if v['next_backup'] == False:
-        next_backup = datetime(now.year, now.month, now.day,
-                               int(v['time'][0:2]), int(v['time'][2:4]))
-        # Find out if the backup window has passed already for today
-        now_mins = now.hour * 60 + now.minute
-        next_mins = int(v['time'][0:2]) * 60 + int(v['time'][2:4])
-        if (now_mins > next_mins):
-          # The initial backup windows has passed, do the backup the next day
-          next_backup += timedelta(1)
-
-        backups[k]['next_backup'] = next_backup
-      else:
-        next_backup = v['next_backup']
+  def write(self, nbytes):
+    for scope in self.scopes:
+      get_bucket(scope, "write_iops").consume(1)
+      get_bucket(scope, "write_bps").consume(nbytes)
 
-      if now < next_backup:
-        # Still not time to do the backup
-        continue
-      else:
-        # The time has come to do the backup. Set the next scheduled
-        # backup at the given time for the backup a day from now.
-        backups[k]['next_backup'] = (datetime(now.year, now.month, now.day,
-                                              int(v['time'][0:2]),
-                                              int(v['time'][2:4])) +
-                                     timedelta(1))
-    # vms have been specified on command line. Turn on manual mode for
-    # existing vms
-    elif k not in vms:
-      continue
+  def limit(self, limit):
+    # The effective limit, 0 if unlimited
+    rates = [get_bucket(scope, limit).rate for scope in self.scopes
+             if get_bucket(scope, limit).rate > 0]
+    return min(rates or [0])
 
-    # Then handle retention
-    if os.path.isdir("{dir}/{vm}".format(dir=global_config['backup_dir'], vm=k)):
-      matches = sorted(fnmatch.filter(os.listdir("{dir}/{vm}".format(
-                       dir=global_config['backup_dir'], vm=k)),
-                       "[0-9]*-[0-9]*-[0-9]*_[0-9]*-[0-9]*-[0-9]*"))
-      # As long as there are more than set number of backups, remove the
-      # oldest. Since this will create an additional set (the backup that
-      # this run will create), we need to check for greater or equality.
-      # Thus we will momentarily while this run be one under the set
-      # retention.
-      while len(matches) >= v['retention']:
-        tprint("Removing {dir}/{vm}/{name} due to retention".format(
-               dir=global_config['backup_dir'], vm=k, name=matches[0]),
-               global_config['logfile'])
-        shutil.rmtree("{dir}/{vm}/{name}".format(dir=global_config['backup_dir'], vm=k,
-                                    name=matches[0]))
-        matches.pop(0)
-
-    # Then do the backup
-    tprint("Running backup for {vm}".format(vm=k), global_config['logfile'])
-
-    backups[k]['last_backup'] = datetime.now()
-    conn = None
-    if v['method'] == "shutdown":
-      if global_config['api'] == "virt-backup":
-        os.system("{cmd} --vm={vm} --shutdown --shutdown-timeout={timeout}".format(
-                  cmd=global_config['backup_command'], vm=k,
-                  timeout=global_config['shutdown_timeout']))
-      elif global_config['api'] == "libvirt":
-        if not conn:
-          conn = libvirt.open("qemu:///system")
-        if shutdown_vm(conn, k, global_config['logfile'],
-                       global_config['shutdown_timeout']):
-          libvirt_snapshot(conn, k, global_config['logfile'])
-          start_vm(conn, k, global_config['logfile'])
-          libvirt_backup(conn, k, global_config['logfile'],
-                         global_config['backup_dir'])
-    elif v['method'] == "suspend":
-      if global_config['api'] == "virt-backup":
-        os.system("{cmd} --vm={vm}".format(cmd=global_config['backup_command'], vm=k))
-      elif global_config['api'] == "libvirt":
-        if not conn:
-          conn = libvirt.open("qemu:///system")
-        if suspend_vm(conn, k, global_config['logfile']):
-          libvirt_snapshot(conn, k, global_config['logfile'])
-          resume_vm(conn, k, global_config['logfile'])
-          libvirt_backup(conn, k, global_config['logfile'],
-                         global_config['backup_dir'])
-
-    # Move the resulting xml and qcow2 file(s) to retention dir
-    src_dir = "{dir}/{vm}".format(dir=global_config['backup_dir'], vm=k)
-    dest_dir = "{dir}/{vm}/{datetime}".format(dir=global_config['backup_dir'], vm=k,
-                             datetime=datetime.now().strftime("%F_%H-%M-%S"))
-
-    # Check if xml dumpfile exists. This is a status indicator.
-    if os.path.exists("{dir}/{vm}.xml".format(dir=src_dir, vm=k)):
-      os.mkdir(dest_dir)
-      shutil.move("{dir}/{vm}.xml".format(dir=src_dir, vm=k), dest_dir)
-      for vmdisk in glob("{dir}/*.qcow2".format(dir=src_dir)):
-        shutil.move("{disk}".format(disk=vmdisk), dest_dir)
-
-      # Next scheduled backup only exists when running in daemon mode
-      if vms == None:
-        tprint("Backup finished for {vm}. Scheduling next for {datetime}".format(vm=k,
-               datetime=backups[k]['next_backup'].ctime()), global_config['logfile'])
+  def describe(self):
+    limits = []
+    for limit in ["read_bps", "write_bps"]:
+      if self.limit(limit) > 0:
+        limits.append("{limit} {rate:.1f} MiB/s".format(limit=limit,
+                      rate=self.limit(limit) / 1048576.))
+    for limit in ["read_iops", "write_iops"]:
+      if self.limit(limit) > 0:
+        limits.append("{limit} {rate}".format(limit=limit, rate=self.limit(limit)))
+    return ", ".join(limits)
+
+def reload_limits(global_config, backups):
+  # Pick up changed limits from the configfile while backups are running
+  configfile = global_config['configfile']
+  try:
+    mtime = os.stat(configfile).st_mtime
+  except OSError:
+    return
+  if mtime == global_config['limits_mtime']:
+    return
+  global_config['limits_mtime'] = mtime
+
+  config = configparser.RawConfigParser()
+  config.read(configfile)
+  global_config['limits'] = parse_limits(config, "global")
+  for k in backups:
+    if config.has_section(k):
+      backups[k]['limits'] = parse_limits(config, k)
+  apply_limits(global_config, backups)
+  tprint("Reloaded I/O limits from {configfile}".format(configfile=configfile),
+         global_config['logfile'])
+
+def whole_disk(device):
+  # cgroup io limits apply to whole disks, find the disk of a partition
+  sysfs = "/sys/dev/block/{device}".format(device=device)
+  if os.path.exists(os.path.join(sysfs, "partition")):
+    with open(os.path.join(os.path.realpath(sysfs), "..", "dev")) as f:
+      return f.read().strip()
+  return device
+
+def run_helper(global_config, command, throttle = None, read_paths = [], write_paths = []):
+  # Run an external program, optionally with an io scheduling class and in
+  # a cgroup of its own limiting its I/O to the limits of the throttle.
+  # Returns the exit code.
+  if global_config['ionice'] != None:
+    if global_config['ionice'] == "idle":
+      command = "ionice -c 3 " + command
+    else:
+      level = global_config['ionice'].split(":")
+      command = "ionice -c 2 -n {level} {command}".format(level=level[-1],
+                command=command)
+
+  # The cgroup of the helper gets the limits of the throttle while the
+  # common parent cgroup gets the global limits shared by all helpers
+  cgroup = None
+  if global_config['io_cgroup'] != None and throttle != None:
+    lines = { "parent" : [], "helper" : [] }
+    for paths, keys in [(read_paths, [("rbps", "read_bps"), ("riops", "read_iops")]),
+                        (write_paths, [("wbps", "write_bps"), ("wiops", "write_iops")])]:
+      for device in sorted(set(filter(None, map(storage_device, paths)))):
+        device = whole_disk(device)
+        lines['helper'].append("{device} {values}".format(device=device,
+          values=" ".join("{key}={value}".format(key=key, value=throttle.limit(limit) or "max")
+                          for key, limit in keys)))
+        lines['parent'].append("{device} {values}".format(device=device,
+          values=" ".join("{key}={value}".format(key=key,
+                          value=get_bucket("global", limit).rate or "max")
+                          for key, limit in keys)))
+    try:
+      parent = global_config['io_cgroup']
+      if not os.path.isdir(parent):
+        os.mkdir(parent)
+      with open(os.path.join(parent, "cgroup.subtree_control"), "w") as f:
+        f.write("+io")
+      cgroup = os.path.join(parent, "helper-{pid}-{tid}".format(pid=os.getpid(),
+                            tid=threading.get_ident()))
+      if not os.path.isdir(cgroup):
+        os.mkdir(cgroup)
+      for path, group in [(parent, "parent"), (cgroup, "helper")]:
+        for line in lines[group]:
+          with open(os.path.join(path, "io.max"), "w") as f:
+            f.write(line)
+    except OSError as err:
+      tprint("Error: Cannot set up cgroup {cgroup}: {err}".format(
+             cgroup=global_config['io_cgroup'], err=err), global_config['logfile'])
+      cgroup = None
+
+  def enter_cgroup():
+    with open(os.path.join(cgroup, "cgroup.procs"), "w") as f:
+      f.write("0")
+
+  try:
+    return call(command, shell = True, preexec_fn = cgroup and enter_cgroup or None)
+  finally:
+    if cgroup != None:
+      try:
+        os.rmdir(cgroup)
+      except OSError:
+        pass
+
+# Checksums of disk images are BLAKE2b hash trees. The image is cut into
+# segments of CHECKSUM_SEGMENT bytes that are hashed on their own, and the
+# checksum is the hash of the size and the digests of the segments. This
+# lets segments be hashed in parallel, pins corruption down to a segment,
+# and segments that are all holes are known without reading them.
+CHECKSUM_SEGMENT = 64 * 1024 * 1024
+CHECKSUM_ZERO = bytes(COPY_BUFSIZE)
+
+zero_digests = {}
+
+def zero_digest(length):
+  # Digest of a segment of length zeroes
+  if length not in zero_digests:
+    segment = hashlib.blake2b(digest_size=32)
+    view = memoryview(CHECKSUM_ZERO)
+    for offset in range(0, length, len(CHECKSUM_ZERO)):
+      segment.update(view[:min(len(CHECKSUM_ZERO), length - offset)])
+    zero_digests[length] = segment.hexdigest()
+  return zero_digests[length]
+
+def tree_digest(size, segments):
+  tree = hashlib.blake2b(size.to_bytes(8, "little"), digest_size=32)
+  for segment in segments:
+    tree.update(bytes.fromhex(segment))
+  return tree.hexdigest()
+
+class TreeHash:
+  # Hash tree of an image fed in order of offset. Gaps between the pieces
+  # fed are holes, and count as zeroes.
+  def __init__(self):
+    self.segments = []
+    self.current = None
+    self.filled = 0
+    self.pos = 0
+
+  def feed(self, data):
+    view = memoryview(data)
+    while len(view) > 0:
+      if self.current == None:
+        self.current = hashlib.blake2b(digest_size=32)
+        self.filled = 0
+      count = min(len(view), CHECKSUM_SEGMENT - self.filled)
+      self.current.update(view[:count])
+      self.filled += count
+      self.pos += count
+      view = view[count:]
+      if self.filled == CHECKSUM_SEGMENT:
+        self.segments.append(self.current.hexdigest())
+        self.current = None
+        self.filled = 0
+
+  def skip(self, length):
+    while length > 0:
+      if self.current == None and length >= CHECKSUM_SEGMENT:
+        self.segments.append(zero_digest(CHECKSUM_SEGMENT))
+        self.pos += CHECKSUM_SEGMENT
+        length -= CHECKSUM_SEGMENT
       else:
-        tprint("Backup finished for {vm}.".format(vm=k), global_config['logfile'])
+        count = min(length, len(CHECKSUM_ZERO), CHECKSUM_SEGMENT - self.filled)
+        self.feed(memoryview(CHECKSUM_ZERO)[:count])
+        length -= count
+
+  def update(self, offset, data):
+    if offset < self.pos:
+      raise ValueError("Data must be hashed in order")
+    self.skip(offset - self.pos)
+    self.feed(data)
+
+  def digest(self, size):
+    # Finish the hash of an image of size bytes
+    self.skip(size - self.pos)
+    if self.current != None:
+      self.segments.append(self.current.hexdigest())
+      self.current = None
+    return tree_digest(size, self.segments)
+
+def hash_segment(fd, size, index):
+  # Hash a segment of an open file through a memory map of it
+  start = index * CHECKSUM_SEGMENT
+  length = min(CHECKSUM_SEGMENT, size - start)
+  try:
+    data = os.lseek(fd, start, os.SEEK_DATA)
+  except OSError as err:
+    data = err.errno == errno.ENXIO and size or start
+  if data >= start + length:
+    return zero_digest(length)
+
+  mapping = mmap.mmap(fd, length, mmap.MAP_SHARED, mmap.PROT_READ, offset=start)
+  try:
+    if hasattr(mapping, "madvise"):
+      mapping.madvise(mmap.MADV_SEQUENTIAL)
+    return hashlib.blake2b(mapping, digest_size=32).hexdigest()
+  finally:
+    mapping.close()
+
+def hash_file(path, executor):
+  # Hash a file with its segments spread over the threads of executor.
+  # Returns a function that waits for the result, (size, segments).
+  fd = os.open(path, os.O_RDONLY)
+  size = os.fstat(fd).st_size
+  futures = [executor.submit(hash_segment, fd, size, index)
+             for index in range((size + CHECKSUM_SEGMENT - 1) // CHECKSUM_SEGMENT)]
+
+  def result():
+    try:
+      return size, [future.result() for future in futures]
+    finally:
+      os.close(fd)
+  return result
+
+def hash_manifest(manifest, store):
+  # Hash the image a chunkstore manifest describes, checking every chunk
+  # against its name on the way. Returns (size, segments, damaged chunks).
+  with open(manifest) as f:
+    info = json.load(f)
+  tree = TreeHash()
+  damaged = []
+  for offset, length, digest in sorted(info['chunks']):
+    try:
+      with open(os.path.join(store, digest[:2], digest), "rb") as chunk:
+        data = chunk.read()
+    except OSError:
+      data = b""
+    if len(data) != length or \
+       hashlib.blake2b(data, digest_size=32).hexdigest() != digest:
+      damaged.append(digest)
+    tree.update(offset, data)
+  tree.digest(info['size'])
+  return info['size'], tree.segments, damaged
+
+def write_checksum(path, size, segments):
+  # Store the checksum of an image next to it. Returns the checksum.
+  digest = tree_digest(size, segments)
+  with open(path + ".checksum", "w") as f:
+    json.dump({ "algorithm" : "blake2b-tree",
+                "segment_size" : CHECKSUM_SEGMENT,
+                "size" : size,
+                "checksum" : digest,
+                "segments" : segments }, f)
+  return digest
+
+def checksum_file(global_config, path):
+  # Hash an image written by someone else than the native copy engine and
+  # store its checksum. Returns the checksum, or None if disabled.
+  if global_config['checksum'] == "none":
+    return None
+  with ThreadPoolExecutor(max_workers=global_config['verify_threads']) as executor:
+    size, segments = hash_file(path, executor)()
+  return write_checksum(path, size, segments)
+
+def data_extents(fd, size, offset = 0):
+  # Yield (offset, length) of every region holding data in the file, skipping
+  # holes. Filesystems without SEEK_DATA support are treated as all data.
+  while offset < size:
+    try:
+      start = os.lseek(fd, offset, os.SEEK_DATA)
+    except OSError as err:
+      if err.errno == errno.ENXIO:
+        # Only a hole remains
+        return
+      if err.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+        yield (offset, size - offset)
+        return
+      raise
+    end = min(size, os.lseek(fd, start, os.SEEK_HOLE))
+    yield (start, end - start)
+    offset = end
+
+# Data written through a buffer is looked at a page at a time, pages of
+# zeroes are left as holes in the file written
+SPARSE_PAGE = 4096
+SPARSE_ZERO = bytes(SPARSE_PAGE)
+
+def write_sparse(fd, data, offset):
+  # Write data to a file at offset, skipping every page of it that is all
+  # zeroes. The file has to be a hole there already. Returns the number of
+  # bytes written.
+  view = memoryview(data)
+  runs = []
+  start = 0
+  for pos in range(0, len(view), SPARSE_PAGE):
+    page = view[pos:pos + SPARSE_PAGE]
+    if page[0] == 0 and page.tobytes() == SPARSE_ZERO[:len(page)]:
+      if start < pos:
+        runs.append((start, pos))
+      start = pos + len(page)
+  if start < len(view):
+    runs.append((start, len(view)))
+
+  written = 0
+  for start, end in runs:
+    while start < end:
+      count = os.pwrite(fd, view[start:end], offset + start)
+      written += count
+      start += count
+  return written
+
+def copy_range(fdin, fdout, offset, length, methods, buf, throttle = None, tree = None):
+  # Copy a byte range between the same offsets in two files. Methods are
+  # tried in order of preference and dropped from the list when the kernel
+  # does not support them for this pair of files. When throttled, the copy
+  # is done in pieces the size of the buffer. Data read through the buffer
+  # is added to the hash tree, if given, and its pages of zeroes are not
+  # written. Returns the number of bytes written.
+  end = offset + length
+  written = 0
+  while offset < end:
+    if throttle != None:
+      count = min(end - offset, len(buf))
+      throttle.read(count)
+      throttle.write(count)
     else:
-      tprint("Backup failed for {vm}. Cannot find an xml dumpfile".format(vm=k),
-             global_config['logfile'])
+      count = min(end - offset, 1024 * 1024 * 1024)
+    try:
+      if methods[0] == "copy_file_range":
+        copied = os.copy_file_range(fdin, fdout, count, offset, offset)
+        written += copied
+      elif methods[0] == "sendfile":
+        os.lseek(fdout, offset, os.SEEK_SET)
+        copied = os.sendfile(fdout, fdin, offset, count)
+        written += copied
+      else:
+        view = memoryview(buf)[:min(count, len(buf))]
+        copied = os.preadv(fdin, [view], offset)
+        if tree != None:
+          tree.update(offset, view[:copied])
+        written += write_sparse(fdout, view[:copied], offset)
+    except OSError as err:
+      if methods[0] != "read" and err.errno in (errno.EXDEV, errno.ENOSYS,
+                                                errno.EINVAL, errno.EOPNOTSUPP):
+        methods.pop(0)
+        continue
+      raise
+    if copied == 0:
+      # The source shrunk underneath us
+      break
+    offset += copied
+  return written
 
-    time.sleep(int(global_config['delay']))
+def copy_file(inf, outf, offset = 0, throttle = None, progress = None, checksum = False,
+              sparse = False):
+  # Copy a disk image verbatim, keeping it sparse. Data is moved by the
+  # kernel where possible and through a large page aligned buffer otherwise,
+  # in which case pages of zeroes become holes too. With sparse the data
+  # always goes through the buffer, so that no zeroes are written.
+  # Copying starts at offset, which allows resuming a partial copy. Every
+  # COPY_SYNC_INTERVAL bytes the copy is synced and progress called with
+  # the offset up to which it can be resumed. With checksum the data is
+  # hashed on its way through the buffer, which rules out letting the
+  # kernel move it, and the part copied before resuming is hashed from
+  # the copy.
+  # Returns a dictionary of statistics for the copy.
+  started = time.monotonic()
+  stats = { "bytes" : 0, "written" : 0, "skipped" : 0, "seconds" : 0.0, "method" : None }
 
-  return backups
+  fdin = os.open(inf, os.O_RDONLY)
+  try:
+    flags = os.O_RDWR | os.O_CREAT
+    if offset == 0:
+      flags |= os.O_TRUNC
+    fdout = os.open(outf, flags, 0o600)
+    try:
+      size = os.fstat(fdin).st_size
+      methods = ["read"]
+      tree = None
+      if checksum:
+        tree = TreeHash()
+      elif not sparse:
+        if hasattr(os, "sendfile"):
+          methods.insert(0, "sendfile")
+        if (hasattr(os, "copy_file_range") and
+            os.fstat(fdin).st_dev == os.fstat(fdout).st_dev):
+          methods.insert(0, "copy_file_range")
+      buf = mmap.mmap(-1, COPY_BUFSIZE)
 
-def main():
-  configfile, configfile_mtime = conffile_mtime()
-  global_config, backups = parse_config(configfile)
+      if tree != None and offset > 0:
+        for start, length in data_extents(fdout, offset):
+          for pos in range(start, start + length, COPY_BUFSIZE):
+            tree.update(pos, os.pread(fdout, min(COPY_BUFSIZE, start + length - pos), pos))
 
-  # Allow for manual backups of specified vms on command line
-  if len(sys.argv) > 1:
-    backups = do_backup(global_config, backups, sys.argv[1:])
+      unsynced = 0
+      for start, length in data_extents(fdin, size, offset):
+        end = start + length
+        while start < end:
+          count = min(end - start, COPY_SYNC_INTERVAL - unsynced)
+          stats['written'] += copy_range(fdin, fdout, start, count, methods, buf,
+                                         throttle, tree)
+          stats['bytes'] += count
+          unsynced += count
+          start += count
+          if unsynced >= COPY_SYNC_INTERVAL:
+            if progress != None:
+              os.fdatasync(fdout)
+              progress(start)
+            unsynced = 0
+
+      buf.close()
+      # Extend the file over a trailing hole and flush it to stable storage
+      os.ftruncate(fdout, size)
+      os.fsync(fdout)
+      stats['skipped'] = size - offset - stats['bytes']
+      stats['method'] = methods[0]
+      if tree != None:
+        stats['checksum'] = tree.digest(size)
+        stats['segments'] = tree.segments
+    finally:
+      os.close(fdout)
+  finally:
+    os.close(fdin)
+
+  stats['seconds'] = time.monotonic() - started
+  return stats
+
+# Compressed backups are written as a series of frames, one per
+# COMPRESS_BLOCK of the image, each compressed on its own. This lets the
+# blocks be compressed in parallel while the result still decompresses as
+# a single stream with the standard tools. Holes are written as the frame
+# of a block of zeroes, which is compressed only once.
+COMPRESS_BLOCK = 4 * 1024 * 1024
+COMPRESS_ZERO = bytes(COMPRESS_BLOCK)
+
+# zstd contexts cannot be shared between threads, each thread keeps its own
+compress_local = threading.local()
+
+def zstd_compress(data, level):
+  compressors = compress_local.__dict__.setdefault("zstd", {})
+  if level not in compressors:
+    compressors[level] = zstandard.ZstdCompressor(level=level)
+  return compressors[level].compress(data)
+
+def gzip_compress(data, level):
+  return gzip.compress(data, compresslevel=level, mtime=0)
+
+# Supported formats with the suffix of their files and default level
+COMPRESSORS = { "zstd" : { "suffix" : ".zst", "level" : 3, "compress" : zstd_compress },
+                "gzip" : { "suffix" : ".gz", "level" : 6, "compress" : gzip_compress } }
+
+zero_frames = {}
+
+def zero_frame(fmt, level, length):
+  if (fmt, level, length) not in zero_frames:
+    zero_frames[(fmt, level, length)] = COMPRESSORS[fmt]['compress'](COMPRESS_ZERO[:length],
+                                                                     level)
+  return zero_frames[(fmt, level, length)]
+
+def compressed_image(path):
+  # The compressed file of an image in a backup set, or None if there is none
+  for compressor in COMPRESSORS.values():
+    if os.path.isfile(path + compressor['suffix']):
+      return path + compressor['suffix']
+  return None
+
+def compress_file(inf, outf, fmt, level = None, threads = 1, throttle = None,
+                  checksum = False):
+  # Compress a disk image into a file. Compressed copies always start over.
+  # Returns a dictionary of statistics, including the CPU time spent
+  # compressing.
+  started = time.monotonic()
+  with open(outf, "wb") as out:
+    stats = compress_stream(inf, out, fmt, level, threads, throttle, checksum)
+    out.flush()
+    os.fsync(out.fileno())
+  stats['output'] = outf
+  stats['seconds'] = time.monotonic() - started
+  return stats
+
+def compress_stream(inf, out, fmt, level = None, threads = 1, throttle = None,
+                    checksum = False):
+  # Compress a disk image block by block and write it to out, which only
+  # has to have a write method. Blocks are read and compressed by the given
+  # number of threads and written in order by the calling one, with at most
+  # two blocks per thread in flight. Without fmt the blocks are written as
+  # they are, holes as zeroes. With checksum the image is hashed as its
+  # blocks are written. Returns a dictionary of statistics.
+  started = time.monotonic()
+  if fmt == None:
+    compress = lambda data, level: data
   else:
-    while (True):
-      # Reread configfile if it has changed
-      if os.stat(configfile).st_mtime != configfile_mtime:
-        configfile, configfile_mtime = conffile_mtime()
-        global_config, backups = parse_config(configfile)
+    compress = COMPRESSORS[fmt]['compress']
+    if level == None:
+      level = COMPRESSORS[fmt]['level']
+  stats = { "bytes" : 0, "written" : 0, "skipped" : 0, "seconds" : 0.0,
+            "cpu_seconds" : 0.0, "method" : fmt or "stream", "level" : level }
+  tree = None
+  if checksum:
+    tree = TreeHash()
+
+  def compress_block(fd, offset, length):
+    if throttle != None:
+      throttle.read(length)
+    data = os.pread(fd, length, offset)
+    cpu = time.thread_time()
+    frame = compress(data, level)
+    return data, frame, time.thread_time() - cpu
+
+  fdin = os.open(inf, os.O_RDONLY)
+  try:
+    size = os.fstat(fdin).st_size
+    blocks = set()
+    for start, length in data_extents(fdin, size):
+      blocks.update(range(start // COMPRESS_BLOCK,
+                          (start + length - 1) // COMPRESS_BLOCK + 1))
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+      window = deque()
+
+      def write_block():
+        offset, length, future = window.popleft()
+        if future == None:
+          if fmt == None:
+            frame = COMPRESS_ZERO[:length]
+          else:
+            frame = zero_frame(fmt, level, length)
+          stats['skipped'] += length
+        else:
+          data, frame, cpu = future.result()
+          stats['bytes'] += length
+          stats['cpu_seconds'] += cpu
+          if tree != None:
+            tree.update(offset, data)
+        if throttle != None:
+          throttle.write(len(frame))
+        out.write(frame)
+        stats['written'] += len(frame)
+
+      for offset in range(0, size, COMPRESS_BLOCK):
+        length = min(COMPRESS_BLOCK, size - offset)
+        future = None
+        if offset // COMPRESS_BLOCK in blocks:
+          future = executor.submit(compress_block, fdin, offset, length)
+        window.append((offset, length, future))
+        while len(window) > threads * 2:
+          write_block()
+      while len(window) > 0:
+        write_block()
+  finally:
+    os.close(fdin)
+
+  if tree != None:
+    stats['checksum'] = tree.digest(size)
+    stats['segments'] = tree.segments
+  stats['seconds'] = time.monotonic() - started
+  return stats
+
+def decompressed_blocks(path):
+  # Yield (offset, data) of the image in a compressed file, streamed a
+  # block at a time
+  with open(path, "rb") as f:
+    if path.endswith(COMPRESSORS['gzip']['suffix']):
+      reader = gzip.GzipFile(fileobj=f)
+    elif zstandard == None:
+      raise IOError("Python module zstandard is needed to decompress {path}".format(
+                    path=path))
+    else:
+      reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+    with reader:
+      offset = 0
+      while True:
+        data = reader.read(COMPRESS_BLOCK)
+        if not data:
+          return
+        yield offset, data
+        offset += len(data)
+
+def decompress_file(inf, outf):
+  # Write the image of a compressed file to outf, leaving pages of zeroes
+  # as holes. Returns the size of the image.
+  size = 0
+  fd = os.open(outf, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+  try:
+    for offset, data in decompressed_blocks(inf):
+      if data != COMPRESS_ZERO[:len(data)]:
+        write_sparse(fd, data, offset)
+      size = offset + len(data)
+    os.ftruncate(fd, size)
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+  return size
+
+def hash_compressed(path):
+  # Hash the image in a compressed file. Returns (size, segments).
+  tree = TreeHash()
+  size = 0
+  for offset, data in decompressed_blocks(path):
+    if data != COMPRESS_ZERO[:len(data)]:
+      tree.update(offset, data)
+    size = offset + len(data)
+  tree.digest(size)
+  return size, tree.segments
+
+# Parameters of the content defined chunking used by the chunkstore backup
+# format. Chunk boundaries are only considered at block boundaries, where
+# a checksum of the first bytes of the block decides whether to cut. This
+# makes boundaries follow the content while keeping them aligned to what
+# the guest filesystem writes.
+CHUNK_BLOCK = 4096
+CHUNK_MIN = 256 * 1024
+CHUNK_MAX = 4 * 1024 * 1024
+CHUNK_MASK = (1 << 8) - 1
+CHUNK_ZERO = bytes(CHUNK_MAX)
+
+# Set when retention has removed chunkstore manifests, so that unreferenced
+# chunks are garbage collected once the running backups have finished.
+chunkstore_gc_pending = threading.Event()
+
+def chunkstore_dir(backup_dir):
+  return os.path.join(backup_dir, ".chunks")
+
+def chunkstore_lock(store, exclusive = False):
+  # Backups hold a shared lock on the store while adding chunks and garbage
+  # collection an exclusive one, so that a chunk found to already exist is
+  # not removed before the manifest referring to it has been written.
+  # Returns the locked file descriptor or None if the store is busy.
+  os.makedirs(store, exist_ok=True)
+  fd = os.open(os.path.join(store, ".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+  try:
+    if exclusive:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+      fcntl.flock(fd, fcntl.LOCK_SH)
+  except OSError:
+    os.close(fd)
+    return None
+  return fd
+
+def chunk_length(data, final):
+  # Find where to cut the next chunk off the start of data
+  limit = min(len(data), CHUNK_MAX)
+  if limit < CHUNK_MAX and not final:
+    raise ValueError("Not enough data to cut a chunk")
+  for pos in range(CHUNK_MIN, limit, CHUNK_BLOCK):
+    if zlib.crc32(data[pos:pos + 64]) & CHUNK_MASK == 0:
+      return pos
+  return limit
+
+def read_chunks(fd, offset, length, throttle = None):
+  # Yield (offset, data) of content defined chunks of a region of a file
+  end = offset + length
+  buf = bytearray()
+  head = 0
+  pos = offset
+  while True:
+    if len(buf) - head < CHUNK_MAX and offset < end:
+      del buf[:head]
+      head = 0
+      while len(buf) < 2 * CHUNK_MAX and offset < end:
+        if throttle != None:
+          throttle.read(min(COPY_BUFSIZE, end - offset))
+        data = os.pread(fd, min(COPY_BUFSIZE, end - offset), offset)
+        if not data:
+          end = offset
+          break
+        buf += data
+        offset += len(data)
+    if head == len(buf):
+      return
+    view = memoryview(buf)
+    cut = chunk_length(view[head:], offset >= end)
+    data = bytes(view[head:head + cut])
+    view.release()
+    yield pos, data
+    head += cut
+    pos += cut
+
+def store_chunk(store, digest, data):
+  # Add a chunk to the store unless already present. Returns True if the
+  # chunk was written.
+  path = os.path.join(store, digest[:2], digest)
+  if os.path.exists(path):
+    return False
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp = "{path}.{pid}.{tid}.tmp".format(path=path, pid=os.getpid(),
+                                        tid=threading.get_ident())
+  with open(tmp, "wb") as f:
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+  os.rename(tmp, path)
+  return True
+
+def chunk_file(inf, manifest, store, throttle = None, checksum = False):
+  # Split a disk image into content defined chunks, add those not already
+  # in the store and write a manifest describing how to put the image back
+  # together. Holes and chunks of zeroes are left out of the manifest. With
+  # checksum the image is hashed from the chunks as they pass.
+  # Returns a dictionary of statistics.
+  started = time.monotonic()
+  stats = { "bytes" : 0, "written" : 0, "chunks" : 0, "new_chunks" : 0,
+            "skipped" : 0, "seconds" : 0.0, "method" : "chunkstore" }
+  chunks = []
+  tree = None
+  if checksum:
+    tree = TreeHash()
+
+  lock = chunkstore_lock(store)
+  try:
+    fd = os.open(inf, os.O_RDONLY)
+    try:
+      size = os.fstat(fd).st_size
+      for start, length in data_extents(fd, size):
+        for offset, data in read_chunks(fd, start, length, throttle):
+          stats['bytes'] += len(data)
+          if data == CHUNK_ZERO[:len(data)]:
+            continue
+          if tree != None:
+            tree.update(offset, data)
+          digest = hashlib.blake2b(data, digest_size=32).hexdigest()
+          chunks.append([offset, len(data), digest])
+          stats['chunks'] += 1
+          if throttle != None and not os.path.exists(os.path.join(store, digest[:2], digest)):
+            throttle.write(len(data))
+          if store_chunk(store, digest, data):
+            stats['new_chunks'] += 1
+            stats['written'] += len(data)
+    finally:
+      os.close(fd)
+
+    with open(manifest + ".tmp", "w") as f:
+      json.dump({ "version" : 1, "name" : os.path.basename(inf),
+                  "size" : size, "chunks" : chunks }, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(manifest + ".tmp", manifest)
+  finally:
+    os.close(lock)
+
+  stats['skipped'] = size - stats['bytes']
+  if tree != None:
+    stats['checksum'] = tree.digest(size)
+    stats['segments'] = tree.segments
+  stats['seconds'] = time.monotonic() - started
+  return stats
+
+def unchunk_file(manifest, store, outf, threads = 1):
+  # Put a disk image back together from its manifest, leaving holes where
+  # the image had holes or zeroes. The chunks are read and written by the
+  # given number of threads, each taking its own stretch of the image.
+  with open(manifest) as f:
+    info = json.load(f)
+
+  def write_chunks(chunks):
+    for offset, length, digest in chunks:
+      with open(os.path.join(store, digest[:2], digest), "rb") as chunk:
+        data = chunk.read()
+      if len(data) != length:
+        raise IOError("Chunk {digest} is damaged".format(digest=digest))
+      write_sparse(fd, data, offset)
+
+  fd = os.open(outf, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+  try:
+    step = max(1, (len(info['chunks']) + threads - 1) // threads)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+      for future in [executor.submit(write_chunks, info['chunks'][start:start + step])
+                     for start in range(0, len(info['chunks']), step)]:
+        future.result()
+    os.ftruncate(fd, info['size'])
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+  return sum(length for offset, length, digest in info['chunks'])
+
+def chunkstore_gc(backup_dir, logfile):
+  # Remove every chunk not referenced by any manifest of any vm. Skipped
+  # if a backup currently adds chunks to the store. Besides the sets, the
+  # manifests of backups not yet committed count: those in the directory
+  # of a vm, which is also where the journal of an interrupted backup has
+  # them, and those of interrupted commits.
+  store = chunkstore_dir(backup_dir)
+  if not os.path.isdir(store):
+    chunkstore_gc_pending.clear()
+    return
+
+  lock = chunkstore_lock(store, exclusive = True)
+  if lock == None:
+    tprint("Chunkstore is busy, postponing garbage collection", logfile)
+    return
+  try:
+    chunkstore_gc_pending.clear()
+    refs = {}
+    manifests = glob(os.path.join(backup_dir, "*", "*", "*.manifest")) + \
+                glob(os.path.join(backup_dir, "*", "*.manifest")) + \
+                glob(os.path.join(backup_dir, "*", ".commit-*", "*.manifest"))
+    for manifest in manifests:
+      with open(manifest) as f:
+        for offset, length, digest in json.load(f)['chunks']:
+          refs[digest] = refs.get(digest, 0) + 1
+
+    removed = 0
+    freed = 0
+    for path in glob(os.path.join(store, "??", "*")):
+      name = os.path.basename(path)
+      if name in refs:
+        continue
+      freed += os.path.getsize(path)
+      os.remove(path)
+      removed += 1
+
+    tprint("Chunkstore garbage collection removed {removed} chunk(s), freeing "
+           "{freed:.0f} MiB. {chunks} chunk(s) with {refs} reference(s) "
+           "remain".format(removed=removed, freed=freed / 1048576.,
+           chunks=len(refs), refs=sum(refs.values())), logfile)
+  finally:
+    os.close(lock)
+
+def copy_disk(global_config, inf, outf, logfile, fmt = None, chained = None,
+              throttle = None, offset = 0, progress = None, level = None, target = None):
+  # Copy a backing file to the backup directory. Same format copies of raw
+  # and qcow2 images use the native copy engine, anything else is handed
+  # to qemu-img convert. With the chunkstore format the image is added to
+  # the chunkstore and a manifest written in place of the copy. With
+  # compress, native copies are compressed at the given level into a file
+  # named after compress_format and qemu-img writes compressed qcow2.
+  # Images that themselves have a backing file are flattened by qemu-img.
+  # The format and whether the image has a backing file are looked up with
+  # qemu-img unless given. Copies are held to the limits of the throttle,
+  # qemu-img through its cgroup. Uncompressed native copies resume from
+  # offset and report progress, the others always start over. Unless
+  # disabled, the checksum of the image is stored next to the copy,
+  # computed on the fly except for images written by qemu-img. With target,
+  # which opens a writer of a file of the set in a sink that streams, native
+  # copies are streamed there in place of outf and always start over.
+  # Returns a dictionary of statistics, with the file written as output, or
+  # None if the copy failed.
+  if fmt == None or chained == None:
+    info = qemu_img_info(inf)
+    fmt = info.get("format", "qcow2")
+    chained = "backing-filename" in info
+  native = (global_config['copy_engine'] == "native" and fmt in ["qcow2", "raw"] and
+            not chained)
+  checksum = global_config['checksum'] != "none"
+  limits = ""
+  if throttle != None and throttle.describe() != "":
+    limits = " (limited to {limits})".format(limits=throttle.describe())
+
+  if global_config['backup_format'] == "chunkstore":
+    src = inf
+    if chained:
+      src = outf + ".flat"
+      if run_helper(global_config, "qemu-img convert -q -f {fmt} -O qcow2 {inf} "
+                    "{outf}".format(fmt=fmt, inf=inf, outf=src), throttle, [inf], [src]) != 0:
+        tprint("Error: qemu-img convert of {inf} failed".format(inf=inf), logfile)
+        return None
+    try:
+      stats = chunk_file(src, outf + ".manifest",
+                         chunkstore_dir(global_config['backup_dir']), throttle, checksum)
+      if checksum:
+        write_checksum(outf, os.path.getsize(src), stats.pop("segments"))
+    finally:
+      if src != inf:
+        os.remove(src)
+    tprint("Stored {inf}: {mib:.0f} MiB in {secs:.1f}s ({rate:.1f} MiB/s), "
+           "{new} of {chunks} chunk(s) new, {written:.0f} MiB written{limits}".format(
+           inf=inf, mib=stats['bytes'] / 1048576., secs=stats['seconds'],
+           rate=stats['bytes'] / 1048576. / max(stats['seconds'], 0.001),
+           new=stats['new_chunks'], chunks=stats['chunks'],
+           written=stats['written'] / 1048576., limits=limits), logfile)
+    stats['output'] = outf + ".manifest"
+    return stats
+
+  if native and target != None:
+    fmt = global_config['compress'] and global_config['compress_format'] or None
+    size = os.path.getsize(inf)
+    out = target(os.path.basename(outf) + (fmt and COMPRESSORS[fmt]['suffix'] or ""), size)
+    try:
+      stats = compress_stream(inf, out, fmt, level, global_config['compress_threads'],
+                              throttle, checksum)
+      out.close()
+    except:
+      out.abort()
+      raise
+    if checksum:
+      write_checksum(outf, size, stats.pop("segments"))
+    tprint("Streamed {inf} to {dest}: {mib:.0f} MiB in {secs:.1f}s ({rate:.1f} MiB/s{limits}) "
+           "using {method}, {written:.0f} MiB written".format(inf=inf, dest=out.key,
+           mib=stats['bytes'] / 1048576., secs=stats['seconds'],
+           rate=stats['bytes'] / 1048576. / max(stats['seconds'], 0.001),
+           method=stats['method'], written=stats['written'] / 1048576.,
+           limits=limits), logfile)
+    stats['output'] = out.key
+    stats['size'] = stats['written']
+    return stats
+
+  if native and global_config['compress']:
+    # A plain copy left by an interrupted backup is not resumed
+    if os.path.exists(outf):
+      os.remove(outf)
+    fmt = global_config['compress_format']
+    stats = compress_file(inf, outf + COMPRESSORS[fmt]['suffix'], fmt, level,
+                          global_config['compress_threads'], throttle, checksum)
+    if checksum:
+      write_checksum(outf, os.path.getsize(inf), stats.pop("segments"))
+    tprint("Compressed {inf}: {mib:.0f} MiB in {secs:.1f}s ({rate:.1f} MiB/s{limits}) "
+           "using {method} level {level}, ratio {ratio:.2f} in {cpu:.1f} CPU-seconds, "
+           "{skipped:.0f} MiB of holes skipped".format(inf=inf,
+           mib=stats['bytes'] / 1048576., secs=stats['seconds'],
+           rate=stats['bytes'] / 1048576. / max(stats['seconds'], 0.001),
+           method=stats['method'], level=stats['level'],
+           ratio=stats['bytes'] / float(max(stats['written'], 1)),
+           cpu=stats['cpu_seconds'], skipped=stats['skipped'] / 1048576.,
+           limits=limits), logfile)
+    return stats
+
+  if native:
+    if offset > 0:
+      tprint("Resuming copy of {inf} at {mib:.0f} MiB".format(inf=inf,
+             mib=offset / 1048576.), logfile)
+    stats = copy_file(inf, outf, offset, throttle, progress, checksum)
+    if checksum:
+      write_checksum(outf, os.path.getsize(outf), stats.pop("segments"))
+    tprint("Copied {inf}: {mib:.0f} MiB in {secs:.1f}s ({rate:.1f} MiB/s{limits}) "
+           "using {method}, {skipped:.0f} MiB of holes skipped".format(inf=inf,
+           mib=stats['bytes'] / 1048576., secs=stats['seconds'],
+           rate=stats['bytes'] / 1048576. / max(stats['seconds'], 0.001),
+           method=stats['method'], skipped=stats['skipped'] / 1048576.,
+           limits=limits), logfile)
+    stats['output'] = outf
+    return stats
+
+  started = time.monotonic()
+  ret = run_helper(global_config, "qemu-img convert -q {compress}-f {fmt} -O qcow2 {inf} "
+                   "{outf}".format(compress=global_config['compress'] and "-c " or "",
+                   fmt=fmt, inf=inf, outf=outf), throttle, [inf], [outf])
+  if ret != 0:
+    tprint("Error: qemu-img convert of {inf} failed with {ret}".format(inf=inf, ret=ret),
+           logfile)
+    return None
+  size = os.path.getsize(outf)
+  return { "bytes" : size, "written" : size, "skipped" : 0,
+           "seconds" : time.monotonic() - started, "method" : "qemu-img",
+           "checksum" : checksum_file(global_config, outf), "output" : outf }
+
+# Serializes updates of journals, which disks of a job update in parallel
+journal_lock = threading.Lock()
+
+def journal_path(backup_dir, vm):
+  # Hidden so that it is left behind when the backup is moved into its set
+  return "{dir}/{vm}/.journal".format(dir=backup_dir, vm=vm)
 
-      # Feed the variables back into the function, avoiding global variables
-      # The content of 'backups' can change whereas 'global_config' cannot
-      backups = do_backup(global_config, backups)
-      time.sleep(60)
+def boot_id():
+  try:
+    with open("/proc/sys/kernel/random/boot_id") as f:
+      return f.read().strip()
+  except OSError:
+    return ""
+
+def journal_read(backup_dir, vm):
+  try:
+    with open(journal_path(backup_dir, vm)) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+def journal_update(global_config, job, device = None, **changes):
+  # Apply changes to the journal of a job, or to one of its disks, and
+  # write it to disk atomically
+  with journal_lock:
+    journal = job['journal']
+    if device == None:
+      journal.update(changes)
+    else:
+      journal['disks'][device].update(changes)
+    path = journal_path(global_config['backup_dir'], job['vm'])
+    with open(path + ".tmp", "w") as f:
+      json.dump(journal, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(path + ".tmp", path)
+
+def journal_start(global_config, job):
+  # Start the journal of a backup with api libvirt. It follows the backup
+  # through its phases so that recover_job() can finish or undo it, should
+  # it be interrupted.
+  if not os.path.isdir("{dir}/{vm}".format(dir=global_config['backup_dir'], vm=job['vm'])):
+    os.mkdir("{dir}/{vm}".format(dir=global_config['backup_dir'], vm=job['vm']))
+  # Disks streamed to the sink go straight into their set, which is named
+  # up front
+  if global_config['sink'].streams:
+    job['set'] = datetime.now().strftime("%F_%H-%M-%S")
+  job['journal'] = { "id" : job['id'],
+                     "set" : job.get("set"),
+                     "method" : job['method'],
+                     "pid" : os.getpid(),
+                     "boot_id" : boot_id(),
+                     "started" : job['started'],
+                     "phase" : "prepare",
+                     "compress_level" : job.get("compress_level"),
+                     "stopped" : False,
+                     "disks" : {} }
+  journal_update(global_config, job)
+
+def journal_finish(global_config, job):
+  # Remove the journal of a job, unless it left a snapshot behind that is
+  # still to be committed. Returns True if the journal was removed.
+  if "journal" not in job:
+    return True
+  pending = [device for device, disk in job['journal']['disks'].items()
+             if disk['state'] in ["copying", "copied"]]
+  if len(pending) > 0:
+    tprint("Keeping journal of {vm}, the snapshot of {devices} is still to be "
+           "committed".format(vm=job['vm'], devices=", ".join(sorted(pending))),
+           global_config['logfile'])
+    return False
+  os.remove(journal_path(global_config['backup_dir'], job['vm']))
+  return True
+
+def libvirt_snapshot(global_config, conn, vm, job):
+  # For every disk of the VM, create an external snapshot. The overlays are
+  # named like virsh would name them and recorded in the journal before
+  # they are created. Returns a list of (disk, overlay) tuples, or None if
+  # the snapshot failed.
+  logfile = global_config['logfile']
+  name = datetime.now().strftime("%F_%H-%M-%S")
+  overlays = []
+  disks = {}
+  snapshot_xml = "<domainsnapshot><name>{name}</name><disks>".format(name=name)
+  for disk in get_disks(conn, vm):
+    tprint("Snapshotting {disk}".format(disk=disk.file), logfile)
+    overlay = "{base}.{name}".format(base=os.path.splitext(disk.file)[0], name=name)
+    overlays.append((disk, overlay))
+    disks[disk.device] = { "file" : disk.file,
+                           "format" : disk.format,
+                           "backing" : disk.backing,
+                           "overlay" : overlay,
+                           "state" : "pending",
+                           "offset" : 0 }
+    snapshot_xml += ("<disk name='{device}' snapshot='external'>"
+                     "<source file='{file}'/></disk>".format(device=disk.device,
+                     file=overlay))
+  snapshot_xml += "</disks></domainsnapshot>"
+  journal_update(global_config, job, phase="snapshot", disks=disks)
+
+  try:
+    get_domain(conn, vm)['dom'].snapshotCreateXML(snapshot_xml,
+      libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY |
+      libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC |
+      libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA)
+  except libvirt.libvirtError as err:
+    tprint("Error: Snapshot of {vm} failed: {err}".format(vm=vm, err=err), logfile)
+    return None
+  for disk in disks.values():
+    disk['state'] = "copying"
+  journal_update(global_config, job, phase="copy")
+  return overlays
+
+# Seconds to wait for a block job event before polling the job instead
+BLOCK_JOB_POLL = 5
+
+# Seconds a block job that has caught up may take to become ready
+BLOCK_JOB_READY_TIMEOUT = 120
+
+def block_job_ready(dom, device):
+  # Whether the domain XML shows the block job of a disk as ready to pivot
+  root = ElementTree.fromstring(dom.XMLDesc(0))
+  for disk in root.findall("./devices/disk"):
+    target = disk.find("target")
+    mirror = disk.find("mirror")
+    if target != None and target.attrib.get("dev") == device and mirror != None:
+      return mirror.attrib.get("ready") == "yes"
+  return False
+
+def block_commit(conn, vm, device, logfile):
+  # Merge the active overlay of a disk back into its backing file and pivot
+  # the domain onto it. The domain is only pivoted once the job is ready,
+  # as told by the block job event, or by the domain XML when the job is
+  # polled because no event arrived for a while. The job having copied all
+  # there is does not make it ready. A job that does not become ready in
+  # time after catching up is cancelled. Returns True if the domain was
+  # pivoted, the overlay is still in use otherwise.
+  dom = get_domain(conn, vm)['dom']
+  key = (dom.UUIDString(), device)
+  waiter = { "status" : None, "event" : threading.Event() }
+  with lifecycle_lock:
+    block_job_waiters[key] = waiter
+
+  try:
+    try:
+      dom.blockCommit(device, None, None, 0, libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE)
+    except libvirt.libvirtError as err:
+      tprint("Error: Blockcommit of {device} on {vm} failed: {err}".format(device=device,
+             vm=vm, err=err), logfile)
+      return False
+
+    logged = time.monotonic()
+    caught_up = None
+    while waiter['status'] != libvirt.VIR_DOMAIN_BLOCK_JOB_READY:
+      if waiter['status'] in [libvirt.VIR_DOMAIN_BLOCK_JOB_FAILED,
+                              libvirt.VIR_DOMAIN_BLOCK_JOB_CANCELED]:
+        tprint("Error: Blockcommit of {device} on {vm} {outcome}".format(device=device,
+               vm=vm, outcome=waiter['status'] == libvirt.VIR_DOMAIN_BLOCK_JOB_FAILED and
+               "failed" or "was cancelled"), logfile)
+        return False
+      if waiter['event'].wait(BLOCK_JOB_POLL):
+        waiter['event'].clear()
+        continue
+
+      try:
+        info = dom.blockJobInfo(device, 0)
+        ready = info and block_job_ready(dom, device)
+      except (libvirt.libvirtError, ElementTree.ParseError) as err:
+        tprint("Error: Lost blockcommit of {device} on {vm}: {err}".format(device=device,
+               vm=vm, err=err), logfile)
+        return False
+      if not info:
+        tprint("Error: Blockcommit of {device} on {vm} ended before it was "
+               "ready".format(device=device, vm=vm), logfile)
+        return False
+      if ready:
+        break
+      if info['end'] > 0 and info['cur'] == info['end']:
+        if caught_up == None:
+          caught_up = time.monotonic()
+        elif time.monotonic() - caught_up >= BLOCK_JOB_READY_TIMEOUT:
+          tprint("Error: Blockcommit of {device} on {vm} did not become ready, "
+                 "cancelling it".format(device=device, vm=vm), logfile)
+          try:
+            dom.blockJobAbort(device, 0)
+          except libvirt.libvirtError:
+            pass
+          return False
+      if time.monotonic() - logged >= 30:
+        tprint("Blockcommit of {device} on {vm} at {percent:.0f}%".format(device=device,
+               vm=vm, percent=100. * info['cur'] / max(info['end'], 1)), logfile)
+        logged = time.monotonic()
+
+    try:
+      dom.blockJobAbort(device, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+    except libvirt.libvirtError as err:
+      tprint("Error: Pivot of {device} on {vm} failed: {err}".format(device=device,
+             vm=vm, err=err), logfile)
+      # Leave the domain running on the overlay rather than a job in limbo
+      try:
+        dom.blockJobAbort(device, 0)
+      except libvirt.libvirtError:
+        pass
+      return False
+    return True
+  finally:
+    with lifecycle_lock:
+      del block_job_waiters[key]
+
+def commit_overlay(global_config, conn, vm, device, overlay, job):
+  # Commit the snapshot of a disk and remove it. Returns True on success.
+  logfile = global_config['logfile']
+  tprint("Committing {file}".format(file=overlay), logfile)
+  if block_commit(conn, vm, device, logfile):
+    tprint("Removing snapshot {file}".format(file=overlay), logfile)
+    os.remove(overlay)
+    journal_update(global_config, job, device, state="committed")
+    return True
+  tprint("Error: Keeping snapshot {file} which {vm} still runs "
+         "on".format(file=overlay, vm=vm), logfile)
+  return False
+
+def libvirt_backup(global_config, conn, vm, overlays, job):
+  # Back up the disks of a snapshotted domain. Returns True if every disk
+  # was copied. The snapshots are committed either way.
+  logfile = global_config['logfile']
+  backup_dir = global_config['backup_dir']
+
+  if overlays == None:
+    return False
+
+  # A resumed backup keeps the xml saved the first time around
+  if not os.path.exists("{dir}/{vm}/{vm}.xml".format(dir=backup_dir, vm=vm)):
+    save_xml(conn, vm, logfile, "{dir}/{vm}/{vm}.xml".format(dir=backup_dir, vm=vm))
+
+  # Copy the backing file(s) away as the backup, then merge the snapshot of
+  # the disk back and delete it. Up to max_disk_jobs disks are handled at
+  # the same time, each committed as soon as its copy is done. Disks
+  # already copied by an interrupted run are only committed, partial
+  # copies are resumed where the journal says.
+  slots = threading.Semaphore(global_config['max_disk_jobs'])
+  results = [None] * len(overlays)
+
+  def backup_disk(i, disk, overlay):
+    result = { "disk" : None }
+    inf = disk.file
+    outf = "{dir}/{vm}/{basename}".format(dir=backup_dir, vm=vm,
+                                          basename=os.path.basename(inf))
+    journaled = job['journal']['disks'][disk.device]
+
+    def progress(offset):
+      journal_update(global_config, job, disk.device, offset=offset)
+
+    # Sinks that stream get native copies straight into the set
+    target = None
+    if global_config['sink'].streams:
+      target = lambda file, size: global_config['sink'].stream(vm, job['set'], file, size)
+
+    # Only the copy takes a slot, the commit starts right after it
+    stats = None
+    if journaled['state'] == "copied":
+      result['disk'] = journaled['record']
+    else:
+      with slots, log_context(vm=vm, phase="copy"):
+        tprint("Copying {inf}".format(inf=inf), logfile)
+        started = time.monotonic()
+        try:
+          stats = copy_disk(global_config, inf, outf, logfile, disk.format, disk.backing,
+                            job['throttle'], journaled['offset'], progress,
+                            job.get("compress_level"), target)
+        except Exception as err:
+          tprint("Error: Copy of {inf} failed: {err}".format(inf=inf, err=err), logfile)
+        result['copy'] = (started, time.monotonic())
+    if stats != None:
+      # Streamed images have no local file to look at
+      if "size" not in stats:
+        stats['size'] = os.stat(stats['output']).st_blocks * 512
+      result['disk'] = { "device" : disk.device,
+                         "source" : inf,
+                         "file" : os.path.basename(stats['output']),
+                         "method" : stats['method'],
+                         "bytes" : stats['bytes'],
+                         "written" : stats['written'],
+                         "size" : stats['size'],
+                         "seconds" : stats['seconds'],
+                         "cpu_seconds" : stats.get("cpu_seconds"),
+                         "checksum" : stats.get("checksum") }
+      journal_update(global_config, job, disk.device, state="copied", record=result['disk'])
+
+    started = time.monotonic()
+    with log_context(vm=vm, phase="blockcommit"):
+      commit_overlay(global_config, conn, vm, disk.device, overlay, job)
+    result['blockcommit'] = (started, time.monotonic())
+    results[i] = result
+
+  threads = [threading.Thread(target=backup_disk, args=(i, disk, overlay),
+                              name="{vm}:{device}".format(vm=vm, device=disk.device))
+             for i, (disk, overlay) in enumerate(overlays)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  # Phases are accounted as wall time from the first disk entering it to
+  # the last one leaving it, as the disks overlap
+  for phase in ["copy", "blockcommit"]:
+    spans = [result[phase] for result in results if result != None and phase in result]
+    if len(spans) > 0:
+      job['phases'][phase] = job['phases'].get(phase, 0.0) + \
+        max(end for start, end in spans) - min(start for start, end in spans)
+
+  total = { "bytes" : 0, "written" : 0 }
+  for result in results:
+    if result != None and result['disk'] != None:
+      job['disks'].append(result['disk'])
+      total['bytes'] += result['disk']['bytes']
+      total['written'] += result['disk']['written']
+
+  tprint("Backup of {vm} read {read:.0f} MiB and wrote {written:.0f} MiB, "
+         "dedup ratio {ratio:.2f}".format(vm=vm, read=total['bytes'] / 1048576.,
+         written=total['written'] / 1048576.,
+         ratio=total['bytes'] / float(max(total['written'], 1))), logfile)
+  return all(result != None and result['disk'] != None for result in results)
+
+# Prefix of the names of checkpoints created by incremental backups
+CHECKPOINT_PREFIX = "virt-backup-"
+
+def backup_sets(backup_dir, vm):
+  # Sorted list of the names of the backup sets of a vm, oldest first
+  if not os.path.isdir("{dir}/{vm}".format(dir=backup_dir, vm=vm)):
+    return []
+  return sorted(fnmatch.filter(os.listdir("{dir}/{vm}".format(dir=backup_dir, vm=vm)),
+                "[0-9]*-[0-9]*-[0-9]*_[0-9]*-[0-9]*-[0-9]*"))
+
+def set_info(set_dir):
+  # Read the description of how a backup set was made. Sets made without
+  # one are plain full backups.
+  try:
+    with open(os.path.join(set_dir, "backup.json")) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return { "type" : "full" }
+
+def wait_for_job(dom, vm, logfile):
+  # Wait for the running job of the domain to finish. Returns True if it
+  # completed successfully.
+  reported = time.monotonic()
+  while True:
+    info = dom.jobStats()
+    if info.get("type", libvirt.VIR_DOMAIN_JOB_NONE) == libvirt.VIR_DOMAIN_JOB_NONE:
+      break
+    if time.monotonic() - reported >= 60 and info.get("data_total", 0) > 0:
+      tprint("Backup job of {vm} at {pct:.0f}%".format(vm=vm,
+             pct=100. * info.get("data_processed", 0) / info['data_total']), logfile)
+      reported = time.monotonic()
+    time.sleep(1)
+
+  info = dom.jobStats(libvirt.VIR_DOMAIN_JOB_STATS_COMPLETED)
+  return info.get("type") == libvirt.VIR_DOMAIN_JOB_COMPLETED
+
+def libvirt_incremental_backup(global_config, conn, vm, v, job):
+  # Back up a running vm through the libvirt backup API. Each backup
+  # creates a checkpoint (a persistent dirty bitmap per disk) so that the
+  # next backup only needs to copy the blocks changed since. Every
+  # full_interval backups a new full backup starts a new chain.
+  logfile = global_config['logfile']
+  backup_dir = global_config['backup_dir']
+
+  try:
+    dom = get_domain(conn, vm)['dom']
+  except libvirt.libvirtError:
+    tprint("{vm} does not exist".format(vm=vm), logfile)
+    return False
+  if dom.state()[0] != libvirt.VIR_DOMAIN_RUNNING:
+    tprint("{vm} is not running, cannot do an incremental backup".format(vm=vm), logfile)
+    return False
+
+  if not os.path.isdir("{dir}/{name}".format(dir=backup_dir, name=vm)):
+    os.mkdir("{dir}/{name}".format(dir=backup_dir, name=vm))
+
+  # Find out whether to continue the chain of the latest backup set
+  checkpoints = [c.getName() for c in dom.listAllCheckpoints()
+                 if c.getName().startswith(CHECKPOINT_PREFIX)]
+  sets = backup_sets(backup_dir, vm)
+  parent = None
+  if len(sets) > 0:
+    info = set_info("{dir}/{vm}/{name}".format(dir=backup_dir, vm=vm, name=sets[-1]))
+    if (info.get("checkpoint") in checkpoints and
+        info.get("chain_length", 1) < v['full_interval']):
+      parent = sets[-1]
+      chain_length = info['chain_length'] + 1
+      incremental = info['checkpoint']
+  if parent == None:
+    # A full backup starts a new chain, older checkpoints are of no use
+    for name in checkpoints:
+      dom.checkpointLookupByName(name).delete()
+    chain_length = 1
+
+  checkpoint = CHECKPOINT_PREFIX + datetime.now().strftime("%F_%H-%M-%S")
+  disks = {}
+  backup_xml = "<domainbackup mode='push'>"
+  if parent != None:
+    backup_xml += "<incremental>{name}</incremental>".format(name=incremental)
+  backup_xml += "<disks>"
+  checkpoint_xml = "<domaincheckpoint><name>{name}</name><disks>".format(name=checkpoint)
+  for disk in get_disks(conn, vm):
+    if disk.format != "qcow2":
+      tprint("Error: {file} is not qcow2, cannot do an incremental backup".format(
+             file=disk.file), logfile)
+      return False
+    disks[disk.device] = "{vm}-{device}.qcow2".format(vm=vm, device=disk.device)
+    backup_xml += ("<disk name='{device}' backup='yes' type='file'>"
+                   "<target file='{dir}/{vm}/{file}'/><driver type='qcow2'/>"
+                   "</disk>".format(device=disk.device, dir=backup_dir, vm=vm,
+                   file=disks[disk.device]))
+    checkpoint_xml += "<disk name='{device}' checkpoint='bitmap'/>".format(device=disk.device)
+  backup_xml += "</disks></domainbackup>"
+  checkpoint_xml += "</disks></domaincheckpoint>"
+
+  journal_update(global_config, job, phase="incremental", checkpoint=checkpoint,
+                 files=list(disks.values()))
+  save_xml(conn, vm, logfile, "{dir}/{vm}/{vm}.xml".format(dir=backup_dir, vm=vm))
+  tprint("Starting {type} backup of {vm}".format(vm=vm,
+         type=parent == None and "full" or "incremental"), logfile)
+
+  started = time.monotonic()
+  try:
+    with timed_phase(job, "backup"):
+      dom.backupBegin(backup_xml, checkpoint_xml, 0)
+      completed = wait_for_job(dom, vm, logfile)
+  except libvirt.libvirtError as err:
+    tprint("Error: Backup job of {vm} failed: {err}".format(vm=vm, err=err), logfile)
+    completed = False
+
+  if not completed:
+    tprint("Backup job of {vm} did not complete".format(vm=vm), logfile)
+    try:
+      dom.checkpointLookupByName(checkpoint).delete()
+    except libvirt.libvirtError:
+      pass
+    # Remove the status indicator and any partial output
+    os.remove("{dir}/{vm}/{vm}.xml".format(dir=backup_dir, vm=vm))
+    for file in disks.values():
+      if os.path.exists("{dir}/{vm}/{file}".format(dir=backup_dir, vm=vm, file=file)):
+        os.remove("{dir}/{vm}/{file}".format(dir=backup_dir, vm=vm, file=file))
+    return False
+
+  # Only the newest checkpoint is needed for the next incremental
+  if parent != None:
+    dom.checkpointLookupByName(incremental).delete()
+
+  job['type'] = parent == None and "full" or "incremental"
+  for disk in get_disks(conn, vm):
+    path = "{dir}/{vm}/{file}".format(dir=backup_dir, vm=vm, file=disks[disk.device])
+    size = os.stat(path).st_blocks * 512
+    job['disks'].append({ "device" : disk.device,
+                          "source" : disk.file,
+                          "file" : disks[disk.device],
+                          "method" : "backup-api",
+                          "bytes" : size,
+                          "written" : size,
+                          "size" : size,
+                          "seconds" : time.monotonic() - started,
+                          # Written by qemu, so hashed afterwards
+                          "checksum" : checksum_file(global_config, path) })
+
+  with open("{dir}/{vm}/backup.json".format(dir=backup_dir, vm=vm), "w") as f:
+    json.dump({ "type" : job['type'],
+                "checkpoint" : checkpoint,
+                "parent" : parent,
+                "chain_length" : chain_length,
+                "disks" : disks }, f)
+  return True
+
+def rebuild_image(chain, outf, logfile):
+  # Write a full image from a full backup followed by its incrementals,
+  # oldest first. The incrementals are stacked on top of each other with
+  # qemu-img without touching the files of the backup sets.
+  spec = None
+  for file in chain:
+    layer = { "driver" : "qcow2",
+              "file" : { "driver" : "file", "filename" : file } }
+    if spec != None:
+      layer['backing'] = spec
+    spec = layer
+
+  try:
+    ret = call(["qemu-img", "convert", "-q", "-O", "qcow2", "json:" + json.dumps(spec), outf])
+  except OSError as err:
+    ret = err
+  if ret != 0:
+    tprint("Error: Rebuilding {outf} failed with {ret}".format(outf=outf, ret=ret), logfile)
+    return False
+  return True
+
+def rebuild_set(global_config, vm, name, dest_dir):
+  # Write the full disk images of a backup set to dest_dir, whatever format
+  # the set is in, named after the disks they were backed up from.
+  # Defaults to the latest set of the vm.
+  logfile = global_config['logfile']
+
+  sets = backup_sets(global_config['backup_dir'], vm)
+  if name == None and len(sets) > 0:
+    name = sets[-1]
+  if name not in sets:
+    tprint("Error: No backup set {name} of {vm}".format(name=name, vm=vm), logfile)
+    return False
+  try:
+    root, disks = set_disks(global_config, vm, name)
+  except (OSError, ValueError, ElementTree.ParseError) as err:
+    tprint("Error: Cannot rebuild {vm} from {name}: {err}".format(vm=vm, name=name,
+           err=err), logfile)
+    return False
+  if not os.path.isdir(dest_dir):
+    os.makedirs(dest_dir)
+
+  for disk in disks:
+    outf = os.path.join(dest_dir, os.path.basename(disk['path']))
+    tprint("Rebuilding {outf}".format(outf=outf), logfile)
+    try:
+      restore_disk(global_config, disk, outf)
+    except (OSError, ValueError) as err:
+      tprint("Error: Rebuilding {outf} failed: {err}".format(outf=outf, err=err), logfile)
+      return False
+  return True
+
+def image_format(path):
+  # Tell qcow2 images from raw ones by their magic
+  with open(path, "rb") as f:
+    return f.read(4) == b"QFI\xfb" and "qcow2" or "raw"
+
+def set_disks(global_config, vm, name):
+  # Work out which image of a backup set belongs to which disk of the saved
+  # domain XML. Returns the parsed XML and a list of dictionaries with the
+  # device, the path it had when backed up, its format, and either the
+  # "file", "compressed" file or "manifest" in the set, or the "chain" of
+  # files back to the full backup for incremental sets. Raises ValueError if a disk has no
+  # image in the set.
+  backup_dir = global_config['backup_dir']
+  set_dir = "{dir}/{vm}/{name}".format(dir=backup_dir, vm=vm, name=name)
+  root = ElementTree.parse("{dir}/{vm}.xml".format(dir=set_dir, vm=vm)).getroot()
+  info = set_info(set_dir)
+
+  disks = []
+  for element in root.findall("./devices/disk[@device='disk']"):
+    source = element.find("source")
+    target = element.find("target")
+    if source == None or target == None or "file" not in source.attrib:
+      continue
+    device = target.attrib['dev']
+    driver = element.find("driver")
+    disk = { "device" : device,
+             "path" : source.attrib['file'],
+             "format" : driver != None and driver.attrib.get("type", "raw") or "raw" }
+
+    if "disks" in info:
+      # Incremental sets, follow the chain of parents to the full backup
+      if device not in info['disks']:
+        raise ValueError("No image of {device} in {dir}".format(device=device, dir=set_dir))
+      disk['chain'] = []
+      disk['format'] = "qcow2"
+      current = name
+      while current != None:
+        current_dir = "{dir}/{vm}/{name}".format(dir=backup_dir, vm=vm, name=current)
+        if not os.path.isdir(current_dir):
+          raise ValueError("Backup set {name} of {vm} is missing from the chain".format(
+                           name=current, vm=vm))
+        current_info = set_info(current_dir)
+        disk['chain'].insert(0, os.path.join(current_dir, current_info['disks'][device]))
+        current = current_info.get("parent")
+    else:
+      # The XML is saved before the snapshot is taken and points at the
+      # image backed up. Sets saved the XML after the snapshot before, where
+      # the image is the backing file of what the XML points at.
+      candidates = [(disk['path'], disk['format'])]
+      backing = element.find("backingStore")
+      if backing != None and backing.find("source") != None:
+        fmt = backing.find("format")
+        candidates.append((backing.find("source").attrib.get("file"),
+                           fmt != None and fmt.attrib.get("type", "raw") or "raw"))
+      for path, fmt in candidates:
+        if path == None:
+          continue
+        image = os.path.join(set_dir, os.path.basename(path))
+        if os.path.isfile(image):
+          disk.update({ "path" : path, "format" : fmt, "file" : image })
+          break
+        if os.path.isfile(image + ".manifest"):
+          disk.update({ "path" : path, "format" : fmt, "manifest" : image + ".manifest" })
+          break
+        if compressed_image(image) != None:
+          disk.update({ "path" : path, "format" : fmt, "compressed" : compressed_image(image) })
+          break
+      else:
+        raise ValueError("No image of {device} in {dir}".format(device=device, dir=set_dir))
+    disks.append(disk)
+  return root, disks
+
+def disk_bytes(disk):
+  # How much data restoring a disk has to move
+  if "chain" in disk:
+    return sum(os.stat(file).st_blocks * 512 for file in disk['chain'])
+  if "manifest" in disk:
+    with open(disk['manifest']) as f:
+      return sum(length for offset, length, digest in json.load(f)['chunks'])
+  if "compressed" in disk:
+    return os.path.getsize(disk['compressed'])
+  return os.stat(disk['file']).st_blocks * 512
+
+def restore_rate(global_config, vm):
+  # Estimate the restore rate in bytes per second from earlier restores,
+  # or failing that from how fast the backups of the vm were read.
+  # Returns (rate, what it is based on), or (None, None) if nothing is known.
+  with catalog_transaction(global_config) as db:
+    row = db.execute("SELECT SUM(bytes), SUM(seconds), COUNT(*) FROM (SELECT bytes, "
+                     "seconds FROM restores ORDER BY started DESC LIMIT 20)").fetchone()
+    if row[2] > 0 and row[1] > 0:
+      return row[0] / row[1], "{count} earlier restore(s)".format(count=row[2])
+    row = db.execute("SELECT SUM(bytes), SUM(seconds), COUNT(*) FROM (SELECT disks.bytes, "
+                     "disks.seconds FROM disks JOIN backup_sets ON disks.set_id = "
+                     "backup_sets.id WHERE backup_sets.vm = ? AND disks.seconds > 0 "
+                     "ORDER BY backup_sets.started DESC LIMIT 20)", (vm,)).fetchone()
+    if row[2] > 0 and row[1] > 0:
+      return row[0] / row[1], "{count} earlier disk backup(s)".format(count=row[2])
+  return None, None
+
+def restore_disk(global_config, disk, outf):
+  # Write the full image of a disk to outf, keeping it sparse. Returns the
+  # number of bytes moved.
+  if "chain" in disk:
+    if len(disk['chain']) > 1:
+      if not rebuild_image(disk['chain'], outf, global_config['logfile']):
+        raise IOError("Rebuilding {outf} failed".format(outf=outf))
+      return disk_bytes(disk)
+    return copy_file(disk['chain'][0], outf, sparse = True)['bytes']
+  if "manifest" in disk:
+    return unchunk_file(disk['manifest'], chunkstore_dir(global_config['backup_dir']),
+                        outf, os.cpu_count() or 1)
+  if "compressed" in disk:
+    decompress_file(disk['compressed'], outf)
+    return disk_bytes(disk)
+  return copy_file(disk['file'], outf, sparse = True)['bytes']
+
+def restore_set(global_config, vm, name = None, dest_dir = None, dry_run = False,
+                uri = "qemu:///system"):
+  # Restore the disks of a backup set, the latest unless name is given,
+  # and define the domain from the saved XML pointing at them. The disks
+  # go back where they were unless dest_dir is given, and are written in
+  # parallel. With dry_run only the plan and an estimate of how long it
+  # would take are shown. Returns True on success.
+  logfile = global_config['logfile']
+  sets = backup_sets(global_config['backup_dir'], vm)
+  if name == None and len(sets) > 0:
+    name = sets[-1]
+  if name not in sets:
+    tprint("Error: No backup set {name} of {vm}".format(name=name, vm=vm), logfile)
+    return False
+  try:
+    root, disks = set_disks(global_config, vm, name)
+  except (OSError, ValueError, ElementTree.ParseError) as err:
+    tprint("Error: Cannot restore {vm} from {name}: {err}".format(vm=vm, name=name,
+           err=err), logfile)
+    return False
+
+  for disk in disks:
+    disk['target'] = disk['path']
+    if dest_dir != None:
+      disk['target'] = os.path.join(dest_dir, os.path.basename(disk['path']))
+    disk['bytes'] = disk_bytes(disk)
+
+  if dry_run:
+    rate, basis = restore_rate(global_config, vm)
+    for disk in disks:
+      print("{device:<6} {size:>10.0f} MiB  {source} -> {target}".format(
+            device=disk['device'], size=disk['bytes'] / 1048576.,
+            source=disk.get("file", disk.get("manifest", disk.get("compressed",
+                            disk.get("chain", [""])[-1]))),
+            target=disk['target']))
+    total = sum(disk['bytes'] for disk in disks)
+    if rate == None:
+      print("Restoring {mib:.0f} MiB of {vm} from {name}, no throughput recorded to "
+            "estimate the time from".format(mib=total / 1048576., vm=vm, name=name))
+    else:
+      print("Restoring {mib:.0f} MiB of {vm} from {name} would take about {secs:.0f}s at "
+            "{rate:.0f} MiB/s, as measured by {basis}".format(mib=total / 1048576., vm=vm,
+            name=name, secs=total / rate, rate=rate / 1048576., basis=basis))
+    return True
+
+  conn = get_connection(uri)
+  try:
+    if get_domain(conn, vm)['dom'].isActive():
+      tprint("Error: {vm} is running, shut it down before restoring it".format(vm=vm), logfile)
+      return False
+  except libvirt.libvirtError:
+    pass
+
+  tprint("Restoring {count} disk(s) of {vm} from {name}".format(count=len(disks), vm=vm,
+         name=name), logfile)
+  started = time.monotonic()
+  stamp = time.time()
+  with ThreadPoolExecutor(max_workers=max(1, len(disks))) as executor:
+    futures = []
+    for disk in disks:
+      if not os.path.isdir(os.path.dirname(disk['target'])):
+        os.makedirs(os.path.dirname(disk['target']))
+      futures.append(executor.submit(restore_disk, global_config, disk, disk['target']))
+    moved = 0
+    failed = False
+    for disk, future in zip(disks, futures):
+      try:
+        moved += future.result()
+        tprint("Restored {target}".format(target=disk['target']), logfile)
+      except (OSError, ValueError) as err:
+        tprint("Error: Restoring {target} failed: {err}".format(target=disk['target'],
+               err=err), logfile)
+        failed = True
+  if failed:
+    return False
+  seconds = time.monotonic() - started
+
+  # Point the saved XML at the restored images, which stand on their own
+  for element in root.findall("./devices/disk[@device='disk']"):
+    target = element.find("target")
+    for disk in disks:
+      if target != None and target.attrib['dev'] == disk['device']:
+        element.find("source").attrib['file'] = disk['target']
+        if element.find("driver") != None:
+          element.find("driver").attrib['type'] = image_format(disk['target'])
+        for backing in element.findall("backingStore"):
+          element.remove(backing)
+  try:
+    conn.defineXML(ElementTree.tostring(root, encoding="unicode"))
+  except libvirt.libvirtError as err:
+    tprint("Error: Defining {vm} failed: {err}".format(vm=vm, err=err), logfile)
+    return False
+  forget_domain(conn, name = vm)
+
+  with catalog_transaction(global_config) as db:
+    db.execute("INSERT INTO restores (vm, name, started, seconds, bytes) VALUES "
+               "(?, ?, ?, ?, ?)", (vm, name, stamp, seconds, moved))
+  tprint("Restored {vm} from {name}: {mib:.0f} MiB in {secs:.1f}s ({rate:.1f} MiB/s)".format(
+         vm=vm, name=name, mib=moved / 1048576., secs=seconds,
+         rate=moved / 1048576. / max(seconds, 0.001)), logfile)
+  return True
+
+def verify_sets(global_config, vms, name = None):
+  # Hash the images of backup sets anew and compare them with the checksums
+  # stored along with them. Segments of all images are hashed in parallel
+  # by verify_threads threads. Verifies the latest set of each vm unless
+  # name is given, which may be "all". Returns False if any image is
+  # damaged or could not be verified.
+  logfile = global_config['logfile']
+  backup_dir = global_config['backup_dir']
+  store = chunkstore_dir(backup_dir)
+  started = time.monotonic()
+  intact = True
+  images = 0
+  total = 0
+
+  def hash_image(image, executor):
+    # Returns a function that waits for (size, segments, damaged chunks,
+    # bytes read)
+    if os.path.exists(image):
+      result = hash_file(image, executor)
+      read = os.stat(image).st_blocks * 512
+      return lambda: result() + ([], read)
+    if compressed_image(image) != None:
+      future = executor.submit(hash_compressed, compressed_image(image))
+      read = os.path.getsize(compressed_image(image))
+      return lambda: future.result() + ([], read)
+    future = executor.submit(hash_manifest, image + ".manifest", store)
+    def result():
+      size, segments, damaged = future.result()
+      return size, segments, damaged, size
+    return result
+
+  with ThreadPoolExecutor(max_workers=global_config['verify_threads']) as executor:
+    pending = []
+    for vm in vms:
+      sets = backup_sets(backup_dir, vm)
+      if name == "all":
+        chosen = sets
+      elif name == None:
+        chosen = sets[-1:]
+      elif name in sets:
+        chosen = [name]
+      else:
+        tprint("Error: No backup set {name} of {vm}".format(name=name, vm=vm), logfile)
+        intact = False
+        continue
+
+      for set_name in chosen:
+        set_dir = "{dir}/{vm}/{name}".format(dir=backup_dir, vm=vm, name=set_name)
+        checksums = sorted(glob(os.path.join(set_dir, "*.checksum")))
+        if len(checksums) == 0:
+          tprint("Backup set {dir} has no checksums".format(dir=set_dir), logfile)
+        for checksum in checksums:
+          image = checksum[:-len(".checksum")]
+          with open(checksum) as f:
+            expected = json.load(f)
+          if expected.get("segment_size") != CHECKSUM_SEGMENT:
+            tprint("Error: Unknown checksum format of {image}".format(image=image), logfile)
+            intact = False
+          elif not os.path.exists(image) and not os.path.exists(image + ".manifest") and \
+               compressed_image(image) == None:
+            tprint("Error: {image} is missing".format(image=image), logfile)
+            intact = False
+          else:
+            pending.append((image, expected, hash_image(image, executor)))
+
+    for image, expected, result in pending:
+      try:
+        size, segments, damaged, read = result()
+      except (OSError, ValueError) as err:
+        tprint("Error: Cannot verify {image}: {err}".format(image=image, err=err), logfile)
+        intact = False
+        continue
+      images += 1
+      total += read
+      bad = [index for index, (found, wanted) in
+             enumerate(zip(segments, expected['segments'])) if found != wanted]
+      if size != expected['size'] or len(segments) != len(expected['segments']) or \
+         len(bad) > 0 or len(damaged) > 0 or \
+         tree_digest(size, segments) != expected['checksum']:
+        details = []
+        if size != expected['size']:
+          details.append("size {size} where {expected} was expected".format(size=size,
+                         expected=expected['size']))
+        if len(bad) > 0:
+          details.append("{count} damaged segment(s) from {offset:.0f} MiB".format(
+                         count=len(bad), offset=bad[0] * CHECKSUM_SEGMENT / 1048576.))
+        if len(damaged) > 0:
+          details.append("{count} damaged chunk(s)".format(count=len(damaged)))
+        tprint("Error: {image} is corrupt: {details}".format(image=image,
+               details=", ".join(details) or "checksum mismatch"), logfile)
+        intact = False
+      else:
+        tprint("{image} is intact".format(image=image), logfile)
+
+  seconds = time.monotonic() - started
+  tprint("Verified {images} image(s), read {gib:.1f} GiB in {secs:.1f}s "
+         "({rate:.2f} GiB/s){result}".format(images=images, gib=total / 1073741824.,
+         secs=seconds, rate=total / 1073741824. / max(seconds, 0.001),
+         result=not intact and ", problems found" or ""), logfile)
+  return intact
+
+# Open catalogs keyed by path. One connection is shared by all workers and
+# serialized by a lock, since every write is a short transaction.
+catalogs = {}
+catalogs_lock = threading.Lock()
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS backup_sets (
+  id INTEGER PRIMARY KEY,
+  vm TEXT NOT NULL,
+  name TEXT,
+  method TEXT,
+  format TEXT,
+  type TEXT,
+  outcome TEXT NOT NULL,
+  started REAL NOT NULL,
+  finished REAL,
+  seconds REAL,
+  bytes INTEGER NOT NULL DEFAULT 0,
+  written INTEGER NOT NULL DEFAULT 0,
+  size INTEGER NOT NULL DEFAULT 0,
+  deleted REAL
+);
+CREATE INDEX IF NOT EXISTS backup_sets_vm ON backup_sets (vm, outcome, name);
+CREATE INDEX IF NOT EXISTS backup_sets_outcome ON backup_sets (outcome, started);
+CREATE INDEX IF NOT EXISTS backup_sets_seconds ON backup_sets (seconds);
+CREATE TABLE IF NOT EXISTS disks (
+  set_id INTEGER NOT NULL REFERENCES backup_sets (id),
+  device TEXT,
+  source TEXT,
+  file TEXT,
+  method TEXT,
+  bytes INTEGER NOT NULL DEFAULT 0,
+  written INTEGER NOT NULL DEFAULT 0,
+  size INTEGER NOT NULL DEFAULT 0,
+  seconds REAL,
+  cpu_seconds REAL,
+  checksum TEXT
+);
+CREATE INDEX IF NOT EXISTS disks_set ON disks (set_id);
+CREATE TABLE IF NOT EXISTS phases (
+  set_id INTEGER NOT NULL REFERENCES backup_sets (id),
+  phase TEXT NOT NULL,
+  seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS phases_set ON phases (set_id);
+CREATE TABLE IF NOT EXISTS restores (
+  id INTEGER PRIMARY KEY,
+  vm TEXT NOT NULL,
+  name TEXT NOT NULL,
+  started REAL NOT NULL,
+  seconds REAL NOT NULL,
+  bytes INTEGER NOT NULL
+);
+"""
+
+def catalog_open(global_config):
+  # Return the catalog of the configuration, creating it if needed
+  path = global_config['catalog']
+  with catalogs_lock:
+    if path not in catalogs:
+      db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+      db.execute("PRAGMA journal_mode=WAL")
+      db.executescript(CATALOG_SCHEMA)
+      # Catalogs created before disks recorded the CPU time of compression
+      if "cpu_seconds" not in [row[1] for row in db.execute("PRAGMA table_info(disks)")]:
+        db.execute("ALTER TABLE disks ADD COLUMN cpu_seconds REAL")
+      db.commit()
+      catalogs[path] = { "db" : db, "lock" : threading.Lock() }
+    return catalogs[path]
+
+@contextmanager
+def catalog_transaction(global_config):
+  catalog = catalog_open(global_config)
+  with catalog['lock']:
+    with catalog['db']:
+      yield catalog['db']
+
+@contextmanager
+def timed_phase(job, phase):
+  # Add the time spent in the block to the named phase of the job, and tag
+  # what is logged meanwhile with it
+  started = time.monotonic()
+  try:
+    with log_context(vm=job['vm'], phase=phase):
+      yield
+  finally:
+    job['phases'][phase] = job['phases'].get(phase, 0.0) + time.monotonic() - started
+
+def disk_usage(path):
+  # Bytes allocated by the files below path
+  size = 0
+  for root, dirs, files in os.walk(path):
+    for file in files:
+      try:
+        size += os.lstat(os.path.join(root, file)).st_blocks * 512
+      except OSError:
+        pass
+  return size
+
+def catalog_begin(global_config, vm, method):
+  # Record that a backup has started and return a job to collect its results
+  job = { "vm" : vm,
+          "method" : method,
+          "type" : "full",
+          "started" : time.time(),
+          "monotonic" : time.monotonic(),
+          "disks" : [],
+          "phases" : {},
+          "throttle" : Throttle(global_config, vm) }
+  with catalog_transaction(global_config) as db:
+    job['id'] = db.execute("INSERT INTO backup_sets (vm, method, format, outcome, started) "
+                           "VALUES (?, ?, ?, 'running', ?)", (vm, method,
+                           global_config['backup_format'], job['started'])).lastrowid
+  return job
+
+def catalog_finish(global_config, job, name, outcome):
+  # Record the outcome of a backup along with its disks and phase timings.
+  # The guest downtime is recorded as a phase of its own.
+  job['name'] = name
+  job['outcome'] = outcome
+  job['finished'] = time.time()
+  job['seconds'] = time.monotonic() - job['monotonic']
+  phases = dict(job['phases'])
+  if "downtime" in job:
+    phases['downtime'] = job['downtime']
+  if "frozen" in job:
+    phases['frozen'] = job['frozen']
+  size = 0
+  if name != None:
+    if "size" in job:
+      size = job['size']
+    else:
+      size = disk_usage("{dir}/{vm}/{name}".format(dir=global_config['backup_dir'],
+                        vm=job['vm'], name=name))
+    # Chunks written to the chunkstore are accounted to the set adding them
+    size += sum(disk['written'] for disk in job['disks'] if disk['method'] == "chunkstore")
+
+  with catalog_transaction(global_config) as db:
+    # A recovered backup replaces what was recorded when it was interrupted
+    db.execute("DELETE FROM disks WHERE set_id = ?", (job['id'],))
+    db.execute("DELETE FROM phases WHERE set_id = ?", (job['id'],))
+    db.execute("UPDATE backup_sets SET name = ?, type = ?, outcome = ?, finished = ?, "
+               "seconds = ?, bytes = ?, written = ?, size = ? WHERE id = ?",
+               (name, job['type'], outcome, job['finished'], job['seconds'],
+                sum(disk['bytes'] for disk in job['disks']),
+                sum(disk['written'] for disk in job['disks']), size, job['id']))
+    db.executemany("INSERT INTO disks (set_id, device, source, file, method, bytes, "
+                   "written, size, seconds, cpu_seconds, checksum) VALUES (?, ?, ?, ?, ?, "
+                   "?, ?, ?, ?, ?, ?)",
+                   [(job['id'], disk['device'], disk['source'], disk['file'],
+                     disk['method'], disk['bytes'], disk['written'], disk['size'],
+                     disk['seconds'], disk.get("cpu_seconds"), disk.get("checksum"))
+                    for disk in job['disks']])
+    db.executemany("INSERT INTO phases (set_id, phase, seconds) VALUES (?, ?, ?)",
+                   [(job['id'], phase, seconds) for phase, seconds in phases.items()])
+
+def catalog_sets(global_config, vm):
+  # List (name, type, size) of the backup sets of a vm that exist, oldest
+  # first
+  with catalog_transaction(global_config) as db:
+    return db.execute("SELECT name, type, size FROM backup_sets WHERE vm = ? AND "
+                      "outcome = 'success' ORDER BY name", (vm,)).fetchall()
+
+def catalog_delete(global_config, vm, name):
+  # Mark a backup set as deleted. The record is kept for its history.
+  with catalog_transaction(global_config) as db:
+    db.execute("UPDATE backup_sets SET outcome = 'deleted', deleted = ? WHERE vm = ? "
+               "AND name = ? AND outcome = 'success'", (time.time(), vm, name))
+
+def catalog_sync(global_config, vms):
+  # Bring the catalog in line with the backup sets in the sink. Sets made
+  # before there was a catalog are added and sets removed by hand are
+  # marked as deleted. Backups interrupted by a restart are marked failed.
+  # Only local sets can have been made without the catalog.
+  backup_dir = global_config['backup_dir']
+  with catalog_transaction(global_config) as db:
+    db.execute("UPDATE backup_sets SET outcome = 'failed' WHERE outcome = 'running'")
+
+  for vm in vms:
+    on_disk = global_config['sink'].sets(vm)
+    known = [name for name, type, size in catalog_sets(global_config, vm)]
+    for name in set(known) - set(on_disk):
+      catalog_delete(global_config, vm, name)
+    if global_config['sink'].streams:
+      continue
+
+    for name in sorted(set(on_disk) - set(known)):
+      set_dir = "{dir}/{vm}/{name}".format(dir=backup_dir, vm=vm, name=name)
+      started = time.mktime(datetime.strptime(name, "%Y-%m-%d_%H-%M-%S").timetuple())
+      if glob(os.path.join(set_dir, "*.manifest")):
+        fmt = "chunkstore"
+      else:
+        fmt = "files"
+      with catalog_transaction(global_config) as db:
+        db.execute("INSERT INTO backup_sets (vm, name, format, type, outcome, started, "
+                   "size) VALUES (?, ?, ?, ?, 'success', ?, ?)", (vm, name, fmt,
+                   set_info(set_dir).get("type", "full"), started, disk_usage(set_dir)))
+
+# Upper bounds of the histogram buckets of durations, in seconds
+METRICS_BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200, 14400]
+
+# Metrics collected since the daemon started, exported by write_metrics()
+metrics = { "phases" : {}, "downtime" : None, "last" : {}, "run" : {} }
+metrics_lock = threading.Lock()
+
+def observe(histogram, value):
+  if histogram == None:
+    histogram = { "buckets" : [0] * len(METRICS_BUCKETS), "sum" : 0.0, "count" : 0 }
+  for i, bound in enumerate(METRICS_BUCKETS):
+    if value <= bound:
+      histogram['buckets'][i] += 1
+  histogram['sum'] += value
+  histogram['count'] += 1
+  return histogram
+
+def record_metrics(job):
+  # Add a finished job to the histograms and the last run gauges
+  with metrics_lock:
+    for phase, seconds in job['phases'].items():
+      metrics['phases'][phase] = observe(metrics['phases'].get(phase), seconds)
+    if "downtime" in job:
+      metrics['downtime'] = observe(metrics['downtime'], job['downtime'])
+    metrics['last'][job['vm']] = { "success" : job['outcome'] == "success" and 1 or 0,
+                                   "timestamp" : job['finished'],
+                                   "duration" : job['seconds'],
+                                   "downtime" : job.get("downtime", 0.0),
+                                   "bytes" : sum(disk['bytes'] for disk in job['disks']),
+                                   "written" : sum(disk['written'] for disk in job['disks']),
+                                   "phases" : dict(job['phases']) }
+
+def format_histogram(name, histogram, labels = ""):
+  # labels is either empty or a comma separated list of labels without braces
+  lines = []
+  for bound, count in zip(METRICS_BUCKETS + ["+Inf"],
+                          histogram['buckets'] + [histogram['count']]):
+    lines.append('{name}_bucket{{{labels}le="{bound}"}} {count}'.format(name=name,
+                 labels=labels and labels + "," or "", bound=bound, count=count))
+  labels = labels and "{" + labels + "}" or ""
+  lines.append("{name}_sum{labels} {sum}".format(name=name, labels=labels, sum=histogram['sum']))
+  lines.append("{name}_count{labels} {count}".format(name=name, labels=labels,
+               count=histogram['count']))
+  return lines
+
+def write_metrics(global_config):
+  # Write all metrics in the Prometheus text format for the textfile
+  # collector of node_exporter. The file is replaced atomically.
+  if global_config['metrics_file'] == None:
+    return
+
+  lines = []
+  with metrics_lock:
+    lines.append("# HELP virt_backup_phase_seconds Time spent in each phase of a backup")
+    lines.append("# TYPE virt_backup_phase_seconds histogram")
+    for phase, histogram in sorted(metrics['phases'].items()):
+      lines += format_histogram("virt_backup_phase_seconds", histogram,
+                                'phase="{phase}"'.format(phase=phase))
+    if metrics['downtime'] != None:
+      lines.append("# HELP virt_backup_downtime_seconds Time guests were paused or shut off")
+      lines.append("# TYPE virt_backup_downtime_seconds histogram")
+      lines += format_histogram("virt_backup_downtime_seconds", metrics['downtime'])
+
+    for metric, key, text in [("success", "success", "Whether the last backup succeeded"),
+                              ("timestamp_seconds", "timestamp", "When the last backup finished"),
+                              ("duration_seconds", "duration", "Duration of the last backup"),
+                              ("downtime_seconds", "downtime", "Guest downtime of the last backup"),
+                              ("read_bytes", "bytes", "Bytes read by the last backup"),
+                              ("written_bytes", "written", "Bytes written by the last backup")]:
+      lines.append("# HELP virt_backup_last_{metric} {text}".format(metric=metric, text=text))
+      lines.append("# TYPE virt_backup_last_{metric} gauge".format(metric=metric))
+      for vm, last in sorted(metrics['last'].items()):
+        lines.append('virt_backup_last_{metric}{{vm="{vm}"}} {value}'.format(metric=metric,
+                     vm=vm, value=last[key]))
+
+    lines.append("# HELP virt_backup_last_phase_seconds Time spent in each phase of the last backup")
+    lines.append("# TYPE virt_backup_last_phase_seconds gauge")
+    for vm, last in sorted(metrics['last'].items()):
+      for phase, seconds in sorted(last['phases'].items()):
+        lines.append('virt_backup_last_phase_seconds{{vm="{vm}",phase="{phase}"}} '
+                     '{value}'.format(vm=vm, phase=phase, value=seconds))
+
+    for metric, text in [("wall_seconds", "Wall time of the last backup run"),
+                         ("serial_seconds", "Summed time of the backups of the last run"),
+                         ("vms", "Number of vms in the last backup run")]:
+      if metric in metrics['run']:
+        lines.append("# HELP virt_backup_run_{metric} {text}".format(metric=metric, text=text))
+        lines.append("# TYPE virt_backup_run_{metric} gauge".format(metric=metric))
+        lines.append("virt_backup_run_{metric} {value}".format(metric=metric,
+                     value=metrics['run'][metric]))
+
+  tmp = "{file}.{pid}.tmp".format(file=global_config['metrics_file'], pid=os.getpid())
+  try:
+    with open(tmp, "w") as f:
+      f.write("\n".join(lines) + "\n")
+    os.rename(tmp, global_config['metrics_file'])
+  except OSError as err:
+    tprint("Error: Cannot write metrics to {file}: {err}".format(
+           file=global_config['metrics_file'], err=err), global_config['logfile'])
+
+def write_summary(global_config, results, wall, serial):
+  # Write a JSON summary of a backup run. The filename supports strftime(3).
+  if global_config['summary_file'] == None:
+    return
+  hosts = {}
+  for job in results:
+    host = hosts.setdefault(job.get("host"), { "vms" : 0, "succeeded" : 0, "failed" : 0,
+                                                "seconds" : 0.0, "bytes" : 0, "written" : 0 })
+    host['vms'] += 1
+    host[job['outcome'] == "success" and "succeeded" or "failed"] += 1
+    host['seconds'] += job['seconds']
+    host['bytes'] += sum(disk['bytes'] for disk in job['disks'])
+    host['written'] += sum(disk['written'] for disk in job['disks'])
+  summary = { "started" : time.time() - wall,
+              "wall_seconds" : wall,
+              "serial_seconds" : serial,
+              "hosts" : hosts,
+              "backups" : [{ "vm" : job['vm'],
+                             "host" : job.get("host"),
+                             "set" : job.get("name"),
+                             "outcome" : job['outcome'],
+                             "type" : job['type'],
+                             "started" : job['started'],
+                             "finished" : job['finished'],
+                             "seconds" : job['seconds'],
+                             "downtime_seconds" : job.get("downtime"),
+                             "phases" : job['phases'],
+                             "bytes" : sum(disk['bytes'] for disk in job['disks']),
+                             "written" : sum(disk['written'] for disk in job['disks']),
+                             "disks" : job['disks'] } for job in results] }
+  try:
+    with open(datetime.now().strftime(global_config['summary_file']), "w") as f:
+      json.dump(summary, f, indent=2)
+  except OSError as err:
+    tprint("Error: Cannot write summary: {err}".format(err=err), global_config['logfile'])
+
+def storage_device(path):
+  # Identify the block device a path lives on as "major:minor"
+  try:
+    dev = os.stat(path).st_dev
+  except OSError:
+    return None
+  return "{major}:{minor}".format(major=os.major(dev), minor=os.minor(dev))
+
+def job_resources(global_config, conn, vm, uri):
+  # Work out which limited resources a backup of the vm will occupy, as a
+  # list of (key, limit) tuples. Storage keys are only known when using the
+  # libvirt api since it is then we know where the disks reside.
+  resources = []
+
+  if global_config['max_jobs_per_host'] > 0 and global_config['api'] == "libvirt":
+    resources.append((("host", uri), global_config['max_jobs_per_host']))
+
+  if global_config['max_jobs_per_storage'] > 0 and conn != None:
+    try:
+      devices = set(storage_device(disk.file) for disk in get_disks(conn, vm))
+    except libvirt.libvirtError:
+      devices = set()
+    for device in sorted(filter(None, devices)):
+      resources.append((("storage", device), global_config['max_jobs_per_storage']))
+
+  if global_config['max_jobs_per_backup_dir'] > 0:
+    device = storage_device(global_config['backup_dir'])
+    if device != None:
+      resources.append((("backup_dir", device), global_config['max_jobs_per_backup_dir']))
+
+  return resources
+
+def unreachable_disks(conn, vm):
+  # The disk images of a vm that cannot be found on this host. Images and
+  # their snapshots are read, converted and removed here through the paths
+  # the hypervisor reports, so a remote one has to share its storage at the
+  # same paths.
+  try:
+    return [disk.file for disk in get_disks(conn, vm) if not os.path.exists(disk.file)]
+  except libvirt.libvirtError:
+    return []
+
+def estimate_backup(global_config, conn, k, v):
+  # Estimate the space the next backup of a vm takes in backup_dir. Goes by
+  # the largest of the last few sets made with the same method, or failing
+  # that by what the disks of the vm have allocated. Returns None if
+  # nothing is known.
+  with catalog_transaction(global_config) as db:
+    row = db.execute("SELECT MAX(size), COUNT(*) FROM (SELECT size FROM backup_sets "
+                     "WHERE vm = ? AND method = ? AND outcome IN ('success', 'deleted') "
+                     "AND size > 0 ORDER BY started DESC LIMIT 3)", (k, v['method'])).fetchone()
+  if row[1] > 0:
+    return row[0]
+  if conn == None:
+    return None
+  try:
+    dom = get_domain(conn, k)['dom']
+    return sum(dom.blockInfo(disk.device)[1] for disk in get_disks(conn, k))
+  except libvirt.libvirtError:
+    return None
+
+def free_space(path):
+  stat = os.statvfs(path)
+  return stat.f_bavail * stat.f_frsize
+
+def backup_vm(global_config, conn, k, v, scheduled = False):
+  job = catalog_begin(global_config, k, v['method'])
+  job['host'] = v['uri']
+  try:
+    name = run_backup(global_config, conn, k, v, job, scheduled)
+  except:
+    catalog_finish(global_config, job, None, "failed")
+    record_metrics(job)
+    raise
+  catalog_finish(global_config, job, name, name != None and "success" or "failed")
+  record_metrics(job)
+  # After an exception the journal is left for recover_job()
+  journal_finish(global_config, job)
+  tprint("Backup of {vm} took {seconds:.1f}s with {downtime:.3f}s of guest downtime "
+         "({phases})".format(vm=k, seconds=job['seconds'], downtime=job.get("downtime", 0.0),
+         phases=", ".join("{phase} {seconds:.3f}s".format(phase=phase, seconds=seconds)
+                          for phase, seconds in job['phases'].items())), global_config['logfile'])
+  return job
+
+def run_backup(global_config, conn, k, v, job, scheduled = False):
+  # Do the actual backup of a client. Returns the name of the resulting
+  # backup set, or None if the backup failed.
+
+  # Then handle retention. The sets are only renamed here and removed by
+  # the reaper while the backup runs.
+  with timed_phase(job, "retention"):
+    for name, size in retention_sets(global_config, k, v, True):
+      tprint("Removing {dir}/{vm}/{name} due to retention".format(
+             dir=global_config['backup_dir'], vm=k, name=name), global_config['logfile'])
+      reaper.remove(global_config, k, name, size)
+      catalog_delete(global_config, k, name)
+
+  # Then do the backup
+  tprint("Running backup for {vm}".format(vm=k), global_config['logfile'])
+
+  if global_config['api'] == "libvirt":
+    # Finish what an interrupted backup left behind before starting anew
+    if not recover_job(global_config, conn, k):
+      tprint("Backup failed for {vm}. An interrupted backup could not be "
+             "recovered".format(vm=k), global_config['logfile'])
+      return None
+    job['compress_level'] = v['compress_level']
+    journal_start(global_config, job)
+
+  # Set to False when a disk could not be copied
+  copied = True
+  method = v['method']
+  if method == "quiesce":
+    if global_config['api'] == "libvirt":
+      # The guest keeps running while its filesystems are frozen for as
+      # long as it takes to snapshot the disks
+      down = time.monotonic()
+      with timed_phase(job, "freeze"):
+        frozen = freeze_vm(conn, k, global_config['logfile'])
+      if frozen:
+        journal_update(global_config, job, stopped=True)
+        try:
+          with timed_phase(job, "snapshot"):
+            overlays = libvirt_snapshot(global_config, conn, k, job)
+        finally:
+          with timed_phase(job, "thaw"):
+            thawed = thaw_vm(conn, k, global_config['logfile'])
+        job['frozen'] = job['downtime'] = time.monotonic() - down
+        tprint("{vm} was frozen for {ms:.0f} ms".format(vm=k, ms=job['frozen'] * 1000.),
+               global_config['logfile'])
+        if thawed:
+          journal_update(global_config, job, stopped=False)
+        copied = libvirt_backup(global_config, conn, k, overlays, job)
+      elif frozen == None:
+        tprint("Suspending {vm} instead".format(vm=k), global_config['logfile'])
+        method = "suspend"
+    else:
+      tprint("Error: Method quiesce requires api libvirt", global_config['logfile'])
+
+  if method == "shutdown":
+    if global_config['api'] == "virt-backup":
+      with timed_phase(job, "backup"):
+        run_helper(global_config, "{cmd} --vm={vm} --shutdown --shutdown-timeout={timeout}".format(
+                   cmd=global_config['backup_command'], vm=k,
+                   timeout=global_config['shutdown_timeout']), job['throttle'],
+                   write_paths = [global_config['backup_dir']])
+    elif global_config['api'] == "libvirt":
+      # The guest is down from the shutdown request until it is started
+      down = time.monotonic()
+      with timed_phase(job, "shutdown"):
+        stopped = shutdown_vm(conn, k, global_config['logfile'],
+                              global_config['shutdown_timeout'])
+      if stopped:
+        journal_update(global_config, job, stopped=True)
+        with timed_phase(job, "snapshot"):
+          overlays = libvirt_snapshot(global_config, conn, k, job)
+        with timed_phase(job, "start"):
+          start_vm(conn, k, global_config['logfile'])
+        journal_update(global_config, job, stopped=False)
+        job['downtime'] = time.monotonic() - down
+        copied = libvirt_backup(global_config, conn, k, overlays, job)
+  elif method == "suspend":
+    if global_config['api'] == "virt-backup":
+      with timed_phase(job, "backup"):
+        run_helper(global_config, "{cmd} --vm={vm}".format(cmd=global_config['backup_command'],
+                   vm=k), job['throttle'], write_paths = [global_config['backup_dir']])
+    elif global_config['api'] == "libvirt":
+      down = time.monotonic()
+      with timed_phase(job, "suspend"):
+        stopped = suspend_vm(conn, k, global_config['logfile'])
+      if stopped:
+        journal_update(global_config, job, stopped=True)
+        with timed_phase(job, "snapshot"):
+          overlays = libvirt_snapshot(global_config, conn, k, job)
+        with timed_phase(job, "resume"):
+          resume_vm(conn, k, global_config['logfile'])
+        journal_update(global_config, job, stopped=False)
+        job['downtime'] = time.monotonic() - down
+        copied = libvirt_backup(global_config, conn, k, overlays, job)
+  elif method == "incremental":
+    if global_config['api'] == "libvirt":
+      libvirt_incremental_backup(global_config, conn, k, v, job)
+    else:
+      tprint("Error: Method incremental requires api libvirt", global_config['logfile'])
+
+  # The disks of the domain have changed back and forth, have the next
+  # backup look at it anew
+  if conn != None:
+    forget_domain(conn, name = k)
+
+  # A set missing a disk is never committed
+  if not copied:
+    tprint("Backup failed for {vm}. Not every disk could be copied".format(vm=k),
+           global_config['logfile'])
+    abandon_set(global_config, k, job)
+    return None
+
+  # Move the resulting xml and disk image file(s) to retention dir
+  name = move_set(global_config, k, job)
+  if name != None:
+    # Next scheduled backup only exists when running in daemon mode
+    if scheduled and v['next_backup'] != None:
+      tprint("Backup finished for {vm}. Scheduling next for {datetime}".format(vm=k,
+             datetime=v['next_backup'].ctime()), global_config['logfile'])
+    else:
+      tprint("Backup finished for {vm}.".format(vm=k), global_config['logfile'])
+    return name
+  else:
+    tprint("Backup failed for {vm}. Cannot find an xml dumpfile".format(vm=k),
+           global_config['logfile'])
+    abandon_set(global_config, k, job)
+    return None
+
+def retention_sets(global_config, k, v, verbose = False):
+  # List (name, size) of the backup sets of a vm that retention removes
+  # before its next backup
+  matches = catalog_sets(global_config, k)
+  remove = []
+  # As long as there are more than set number of backups, remove the
+  # oldest. Since this will create an additional set (the backup that
+  # this run will create), we need to check for greater or equality.
+  # Thus we will momentarily while this run be one under the set
+  # retention.
+  while len(matches) >= v['retention']:
+    # Incremental backups need every set back to their full backup, so
+    # the oldest set is kept as long as the next one builds upon it.
+    if len(matches) > 1 and matches[1][1] == "incremental":
+      if verbose:
+        tprint("Keeping {dir}/{vm}/{name} until a new full backup exists".format(
+               dir=global_config['backup_dir'], vm=k, name=matches[0][0]),
+               global_config['logfile'])
+      break
+    remove.append((matches[0][0], matches[0][2]))
+    matches.pop(0)
+  return remove
+
+class Reaper:
+  # Removes backup sets in a thread of its own, so that backups do not wait
+  # for large sets to be deleted. Sets are first taken out of sight by the
+  # sink, for local sets by renaming them to a hidden name, and are then
+  # deleted one after the other. Keeps count of the space they still hold.
+  def __init__(self):
+    self.queue = SimpleQueue()
+    self.pending = {}
+    self.cond = threading.Condition()
+    self.thread = None
+
+  def remove(self, global_config, vm, name, size = None):
+    path = global_config['sink'].discard(vm, name)
+    if path == None:
+      return
+    self.add(global_config['sink'], path, size, global_config['logfile'])
+
+  def add(self, sink, path, size, logfile):
+    if not size:
+      size = sink.usage(path)
+    with self.cond:
+      self.pending[path] = size
+      if self.thread == None:
+        self.thread = threading.Thread(target=self.run, name="reaper", daemon=True)
+        self.thread.start()
+    self.queue.put((sink, path, logfile))
+
+  def resume(self, global_config, vms):
+    # Pick up sets whose removal was interrupted, and what backups that
+    # will not be recovered left in the sink
+    journals = dict((vm, journal_read(global_config['backup_dir'], vm)) for vm in vms)
+    for path in global_config['sink'].discarded(dict((vm, journal) for vm, journal
+                                                     in journals.items() if journal != None)):
+      self.add(global_config['sink'], path, None, global_config['logfile'])
+
+  def run(self):
+    while True:
+      sink, path, logfile = self.queue.get()
+      started = time.monotonic()
+      try:
+        sink.delete(path)
+        removed = True
+      except Exception as err:
+        tprint("Error: Cannot remove {path}: {err}".format(path=path, err=err), logfile)
+        removed = False
+      with self.cond:
+        size = self.pending.pop(path, 0)
+        self.cond.notify_all()
+      if removed:
+        tprint("Removed {path}, freeing {gib:.1f} GiB in {secs:.1f}s".format(path=path,
+               gib=size / 1073741824., secs=time.monotonic() - started), logfile)
+
+  def reclaimable(self):
+    # Bytes held by sets that are still to be removed
+    with self.cond:
+      return sum(self.pending.values())
+
+  def wait(self):
+    with self.cond:
+      while len(self.pending) > 0:
+        self.cond.wait()
+
+reaper = Reaper()
+
+# Name of the manifest of a backup set. A set exists once its manifest does.
+SET_MANIFEST = "set.json"
+
+def set_manifest(vm, name, job, files):
+  # Describe a backup set and the files in it, given as (name, size)
+  return json.dumps({ "vm" : vm,
+                      "name" : name,
+                      "method" : job['method'],
+                      "type" : job['type'],
+                      "created" : time.time(),
+                      "files" : [{ "name" : file, "size" : size } for file, size in files],
+                      "disks" : job['disks'] }, indent=2)
+
+class LocalSink:
+  # Keeps backup sets as directories in backup_dir. A backup is written to
+  # the directory of its vm and committed by moving its files into a hidden
+  # directory along with the manifest, which is then renamed to the name of
+  # the set in one step. An interrupted commit is finished by committing
+  # again.
+  streams = False
+
+  def __init__(self, backup_dir):
+    self.backup_dir = backup_dir
+
+  def location(self, vm, name):
+    return "{dir}/{vm}/{name}".format(dir=self.backup_dir, vm=vm, name=name)
+
+  def sets(self, vm):
+    return backup_sets(self.backup_dir, vm)
+
+  def committing(self, vm, name):
+    # Whether a commit of the set was interrupted
+    return os.path.isdir("{dir}/{vm}/.commit-{name}".format(dir=self.backup_dir, vm=vm,
+                                                             name=name))
+
+  def commit(self, vm, name, job):
+    # Returns the size of the set, or None if it was already committed
+    src_dir = "{dir}/{vm}".format(dir=self.backup_dir, vm=vm)
+    if os.path.isdir(self.location(vm, name)):
+      return None
+    tmp_dir = "{dir}/.commit-{name}".format(dir=src_dir, name=name)
+    if not self.committing(vm, name):
+      os.mkdir(tmp_dir)
+    for file in filter(os.path.isfile, glob("{dir}/*".format(dir=src_dir))):
+      os.rename(file, os.path.join(tmp_dir, os.path.basename(file)))
+    files = [(file, os.path.getsize(os.path.join(tmp_dir, file)))
+             for file in sorted(os.listdir(tmp_dir)) if file != SET_MANIFEST]
+    with open(os.path.join(tmp_dir, SET_MANIFEST), "w") as f:
+      f.write(set_manifest(vm, name, job, files))
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp_dir, self.location(vm, name))
+    fd = os.open(src_dir, os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+    return disk_usage(self.location(vm, name))
+
+  def discard(self, vm, name):
+    # Take a set out of sight at once, returning what is left to delete or
+    # None if there is no such set
+    set_dir = self.location(vm, name)
+    if not os.path.isdir(set_dir):
+      return None
+    # Chunks only referenced by the set are collected once it is gone
+    if glob(os.path.join(set_dir, "*.manifest")):
+      chunkstore_gc_pending.set()
+    path = "{dir}/{vm}/.deleted-{name}".format(dir=self.backup_dir, vm=vm, name=name)
+    os.rename(set_dir, path)
+    return path
+
+  def discarded(self, journals):
+    # Sets whose removal was interrupted, and interrupted commits of backups
+    # that are not going to be recovered
+    paths = glob("{dir}/*/.deleted-*".format(dir=self.backup_dir))
+    for path in glob("{dir}/*/.commit-*".format(dir=self.backup_dir)):
+      vm = os.path.basename(os.path.dirname(path))
+      if journals.get(vm, {}).get("name") != os.path.basename(path)[len(".commit-"):]:
+        paths.append(path)
+    return sorted(paths)
+
+  def usage(self, path):
+    return disk_usage(path)
+
+  def delete(self, path):
+    shutil.rmtree(path, ignore_errors=True)
+
+class MultipartUpload:
+  # Write an object to S3 as it is produced, in parts uploaded by a pool of
+  # threads while the next part is filled. At most threads parts are in
+  # flight besides the one being filled, which bounds the memory used to
+  # about threads + 1 parts. Objects smaller than a part are put at once.
+  def __init__(self, client, bucket, key, part_size, threads):
+    self.client = client
+    self.bucket = bucket
+    self.key = key
+    self.part_size = part_size
+    self.threads = threads
+    self.buffer = bytearray()
+    self.size = 0
+    self.upload_id = None
+    self.inflight = deque()
+    self.parts = []
+    self.executor = ThreadPoolExecutor(max_workers=threads)
+
+  def write(self, data):
+    self.buffer += data
+    self.size += len(data)
+    while len(self.buffer) >= self.part_size:
+      self.upload(bytes(self.buffer[:self.part_size]))
+      del self.buffer[:self.part_size]
+
+  def upload(self, data):
+    if self.upload_id == None:
+      self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket,
+                                                           Key=self.key)['UploadId']
+    number = len(self.parts) + len(self.inflight) + 1
+    self.inflight.append((number, self.executor.submit(self.upload_part, number, data)))
+    while len(self.inflight) > self.threads:
+      self.finish_part()
+
+  def upload_part(self, number, data):
+    return self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                   PartNumber=number, Body=data)['ETag']
+
+  def finish_part(self):
+    number, future = self.inflight.popleft()
+    self.parts.append({ "PartNumber" : number, "ETag" : future.result() })
+
+  def close(self):
+    # Complete the object and return its size
+    try:
+      if self.upload_id == None:
+        self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+      else:
+        if len(self.buffer) > 0:
+          self.upload(bytes(self.buffer))
+        while len(self.inflight) > 0:
+          self.finish_part()
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                              UploadId=self.upload_id,
+                                              MultipartUpload={ "Parts" : self.parts })
+    finally:
+      self.executor.shutdown()
+    self.buffer = bytearray()
+    return self.size
+
+  def abort(self):
+    # Throw away the parts uploaded so far
+    self.executor.shutdown()
+    if self.upload_id != None:
+      self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                         UploadId=self.upload_id)
+
+class S3Sink:
+  # Keeps backup sets as objects below a prefix of an S3 bucket, one prefix
+  # per set. Disk images are streamed there while they are copied, the
+  # files a backup leaves in the directory of its vm are uploaded when it
+  # is committed. A set is committed by putting its manifest last, sets
+  # without one are incomplete or being deleted.
+  streams = True
+
+  # S3 does not allow more parts than this
+  MAX_PARTS = 10000
+
+  def __init__(self, url, backup_dir, endpoint, region, access_key, secret_key,
+               part_size, threads):
+    self.bucket, _, self.prefix = url[len("s3://"):].partition("/")
+    self.prefix = self.prefix.strip("/")
+    self.backup_dir = backup_dir
+    self.part_size = part_size
+    self.threads = threads
+    self.client = boto3.client("s3", endpoint_url=endpoint, region_name=region,
+                               aws_access_key_id=access_key,
+                               aws_secret_access_key=secret_key)
+
+  def key(self, *parts):
+    return "/".join([part for part in (self.prefix,) + parts if part])
+
+  def location(self, vm, name):
+    return "s3://{bucket}/{key}".format(bucket=self.bucket, key=self.key(vm, name))
+
+  def objects(self, prefix):
+    # Yield (key, size) of the objects below prefix
+    paginator = self.client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+      for item in page.get("Contents", []):
+        yield item['Key'], item['Size']
+
+  def sets(self, vm):
+    prefix = self.key(vm) + "/"
+    return sorted(key[len(prefix):-len(SET_MANIFEST) - 1] for key, size in self.objects(prefix)
+                  if key.endswith("/" + SET_MANIFEST) and key.count("/", len(prefix)) == 1)
+
+  def committing(self, vm, name):
+    # Whether a commit of the set was interrupted after uploading the xml
+    return len(list(self.objects(self.key(vm, name, vm + ".xml")))) > 0
+
+  def stream(self, vm, name, file, size):
+    # Writer of a file of a set. The part size grows with the size of the
+    # image so that it fits in the number of parts allowed.
+    part_size = max(self.part_size, -(-size * 11 // 10 // self.MAX_PARTS))
+    return MultipartUpload(self.client, self.bucket, self.key(vm, name, file), part_size,
+                           self.threads)
+
+  def commit(self, vm, name, job):
+    # Upload what the backup left in the directory of the vm, remove it and
+    # put the manifest. Returns the size of the set, or None if it was
+    # already committed.
+    if len(list(self.objects(self.key(vm, name, SET_MANIFEST)))) > 0:
+      return None
+    for file in filter(os.path.isfile, glob("{dir}/{vm}/*".format(dir=self.backup_dir, vm=vm))):
+      upload = self.stream(vm, name, os.path.basename(file), os.path.getsize(file))
+      try:
+        with open(file, "rb") as f:
+          for data in iter(lambda: f.read(COMPRESS_BLOCK), b""):
+            upload.write(data)
+        upload.close()
+      except:
+        upload.abort()
+        raise
+      os.remove(file)
+    prefix = self.key(vm, name) + "/"
+    files = [(key[len(prefix):], size) for key, size in self.objects(prefix)]
+    self.client.put_object(Bucket=self.bucket, Key=self.key(vm, name, SET_MANIFEST),
+                           Body=set_manifest(vm, name, job, files).encode())
+    return sum(size for file, size in files)
+
+  def discard(self, vm, name):
+    # Removing the manifest takes the set out of sight at once
+    if len(list(self.objects(self.key(vm, name, SET_MANIFEST)))) == 0:
+      return None
+    self.client.delete_object(Bucket=self.bucket, Key=self.key(vm, name, SET_MANIFEST))
+    return self.key(vm, name) + "/"
+
+  def discarded(self, journals):
+    # Prefixes of sets without a manifest, except those of backups that
+    # are to be recovered
+    prefixes = {}
+    base = self.prefix and self.prefix + "/" or ""
+    for key, size in self.objects(base):
+      parts = key[len(base):].split("/")
+      if len(parts) == 3:
+        prefix = self.key(parts[0], parts[1]) + "/"
+        prefixes[prefix] = prefixes.get(prefix, False) or parts[2] == SET_MANIFEST
+    recovering = set(self.key(vm, journal.get("set")) + "/" for vm, journal in journals.items())
+    return sorted(prefix for prefix, committed in prefixes.items()
+                  if not committed and prefix not in recovering)
+
+  def usage(self, path):
+    return sum(size for key, size in self.objects(path))
+
+  def delete(self, path):
+    keys = [key for key, size in self.objects(path)]
+    for i in range(0, len(keys), 1000):
+      self.client.delete_objects(Bucket=self.bucket, Delete={ "Objects" : [{ "Key" : key }
+                                 for key in keys[i:i + 1000]], "Quiet" : True })
+
+def abandon_set(global_config, vm, job):
+  # Remove what a failed backup left in the directory of the vm, and have
+  # the reaper remove what it streamed to the sink
+  for file in filter(os.path.isfile, glob("{dir}/{vm}/*".format(dir=global_config['backup_dir'],
+                                                                vm=vm))):
+    os.remove(file)
+  if job.get("set") != None and global_config['sink'].streams:
+    reaper.add(global_config['sink'], global_config['sink'].key(vm, job['set']) + "/", 0,
+               global_config['logfile'])
+
+def move_set(global_config, vm, job, name = None):
+  # Commit the xml and disk image file(s) of a backup to the sink as a set
+  # of their own, named after the current time unless given or chosen when
+  # the backup started. Returns the name of the set, or None if there is
+  # no xml dumpfile.
+  sink = global_config['sink']
+  if name == None:
+    name = job.get("set") or datetime.now().strftime("%F_%H-%M-%S")
+
+  # Check if xml dumpfile exists. This is a status indicator. A recovered
+  # commit may already have put it in the set, or have been interrupted
+  # after moving it.
+  if not os.path.exists("{dir}/{vm}/{vm}.xml".format(dir=global_config['backup_dir'], vm=vm)) \
+     and name not in sink.sets(vm) and not sink.committing(vm, name):
+    return None
+
+  if "journal" in job:
+    journal_update(global_config, job, phase="move", name=name)
+  with timed_phase(job, "move"):
+    size = sink.commit(vm, name, job)
+  if size != None:
+    job['size'] = size
+  if "journal" in job:
+    journal_update(global_config, job, phase="done")
+  return name
+
+def pid_alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+def recover_job(global_config, conn, vm):
+  # Finish or roll back a backup of vm that was interrupted, going by its
+  # journal. A guest left paused or shut off is brought back, partial
+  # copies are resumed from their last synced offset and the set moved
+  # into place. Backups that cannot be finished, because a disk was
+  # committed before its copy was done or the libvirt backup job was lost,
+  # are rolled back. Left over snapshots are committed either way.
+  # Returns False if the journal belongs to a backup still running or
+  # snapshots remain to be committed.
+  logfile = global_config['logfile']
+  backup_dir = global_config['backup_dir']
+  journal = journal_read(backup_dir, vm)
+  if journal == None:
+    return True
+  if journal['boot_id'] == boot_id() and journal['pid'] != os.getpid() and \
+     pid_alive(journal['pid']):
+    tprint("Backup of {vm} is still running as pid {pid}".format(vm=vm,
+           pid=journal['pid']), logfile)
+    return False
+
+  phase = journal['phase']
+  tprint("Recovering backup of {vm} interrupted in phase {phase}".format(vm=vm,
+         phase=phase), logfile)
+  journal['pid'] = os.getpid()
+  journal['boot_id'] = boot_id()
+  job = { "vm" : vm,
+          "method" : journal['method'],
+          "type" : "full",
+          "started" : journal['started'],
+          "monotonic" : time.monotonic(),
+          "disks" : [],
+          "phases" : {},
+          "throttle" : Throttle(global_config, vm),
+          "id" : journal['id'],
+          "compress_level" : journal.get("compress_level"),
+          "set" : journal.get("set"),
+          "journal" : journal }
+
+  forget_domain(conn, name = vm)
+  try:
+    dom = get_domain(conn, vm)['dom']
+    active = dict((disk.device, disk.file) for disk in get_disks(conn, vm))
+  except libvirt.libvirtError:
+    tprint("Error: {vm} does not exist, leaving its journal".format(vm=vm), logfile)
+    return False
+
+  if journal['stopped']:
+    # Quiesced backups fall back to suspending the guest
+    if journal['method'] in ["suspend", "quiesce"] and \
+       dom.state()[0] == libvirt.VIR_DOMAIN_PAUSED:
+      resume_vm(conn, vm, logfile)
+    elif journal['method'] == "quiesce" and dom.state()[0] == libvirt.VIR_DOMAIN_RUNNING:
+      thaw_vm(conn, vm, logfile)
+    elif journal['method'] == "shutdown" and dom.state()[0] == libvirt.VIR_DOMAIN_SHUTOFF:
+      start_vm(conn, vm, logfile)
+    journal_update(global_config, job, stopped=False)
+
+  # Snapshots the domain still runs on, and disks whose copy cannot be
+  # finished since their snapshot is gone
+  overlays = []
+  lost = []
+  for device, disk in journal['disks'].items():
+    if active.get(device) == disk['overlay']:
+      overlays.append((DiskInfo(device, disk['file'], disk['format'], disk['backing']),
+                       disk['overlay']))
+    else:
+      if disk['state'] in ["pending", "copying"]:
+        lost.append(device)
+      if disk['state'] != "pending":
+        journal_update(global_config, job, device, state="committed")
+      if os.path.exists(disk['overlay']):
+        os.remove(disk['overlay'])
+
+  if len(overlays) > 0 and dom.state()[0] not in [libvirt.VIR_DOMAIN_RUNNING,
+                                                 libvirt.VIR_DOMAIN_PAUSED]:
+    tprint("Error: {vm} has to run for its snapshots to be committed".format(vm=vm), logfile)
+    return False
+
+  name = None
+  if phase in ["snapshot", "copy"] and len(journal['disks']) > 0 and \
+     len(lost) == 0:
+    # The disks committed before the interruption were copied in full
+    for device, disk in journal['disks'].items():
+      if device not in [d.device for d, overlay in overlays] and "record" in disk:
+        job['disks'].append(disk['record'])
+    if len(overlays) > 0:
+      libvirt_backup(global_config, conn, vm, overlays, job)
+    if len(job['disks']) == len(journal['disks']):
+      name = move_set(global_config, vm, job)
+  elif phase in ["move", "done"]:
+    name = move_set(global_config, vm, job, journal['name'])
+    for device, disk in journal['disks'].items():
+      if "record" in disk:
+        job['disks'].append(disk['record'])
+    if journal['method'] == "incremental" and name != None:
+      job['type'] = set_info("{dir}/{vm}/{name}".format(dir=backup_dir, vm=vm,
+                             name=name)).get("type", "full")
+  else:
+    if phase == "incremental":
+      try:
+        if dom.jobInfo()[0] != libvirt.VIR_DOMAIN_JOB_NONE:
+          dom.abortJob()
+      except libvirt.libvirtError:
+        pass
+      try:
+        dom.checkpointLookupByName(journal['checkpoint']).delete()
+      except libvirt.libvirtError:
+        pass
+    tprint("Rolling back backup of {vm}".format(vm=vm), logfile)
+
+  # Whatever was not moved into a set is removed, along with the
+  # snapshots that are still around
+  if name == None:
+    abandon_set(global_config, vm, job)
+  for disk, overlay in overlays:
+    if journal['disks'][disk.device]['state'] != "committed":
+      commit_overlay(global_config, conn, vm, disk.device, overlay, job)
+
+  if phase != "done":
+    catalog_finish(global_config, job, name, name != None and "success" or "failed")
+    tprint("Recovery of backup of {vm} {outcome}".format(vm=vm,
+           outcome=name != None and "finished set " + name or "failed"), logfile)
+  forget_domain(conn, name = vm)
+  return journal_finish(global_config, job)
+
+class Dispatcher:
+  # Runs backups in a pool of worker threads. Jobs are added as they become
+  # due and are started whenever a job slot frees up, so that a long backup
+  # does not hold back the ones due after it. The hosts take turns, the
+  # host running the fewest backups going next, and the jobs of a host go
+  # in order of due time and then priority. A job whose storage is busy, or whose backup does not fit
+  # in backup_dir, may be passed by a later one, but never when the pool
+  # itself is full. Jobs are admitted before their VM is touched if their
+  # estimated size fits in the free space, less what the running jobs are
+  # estimated to take and min_free_space, plus what the reaper and the
+  # retention of the vm are about to free. A job that cannot fit even when
+  # nothing else runs is failed. The vms may run on several hosts, all
+  # sharing the job slots and I/O limits of the backup target. Pending jobs
+  # are kept in a heap per host of (due, priority, vm, uri, resources,
+  # estimate). A run lasts from the first job added until the pool is idle again, and is
+  # logged and summarised as a whole.
+  def __init__(self, global_config, backups, scheduled = False):
+    self.global_config = global_config
+    self.backups = backups
+    self.scheduled = scheduled
+    self.cond = threading.Condition()
+    self.pool = { "running" : 0, "busy" : {}, "serial" : 0.0, "reserved" : 0,
+                  "deferred" : set(), "hosts" : {} }
+    self.pending = {}
+    self.retained = {}
+    self.vms = set()
+    self.results = []
+    self.threads = []
+    self.count = 0
+    self.changed = False
+    self.run_started = None
+
+  def configure(self, global_config, backups):
+    # Start the jobs still pending with the reread configfile. Jobs of vms
+    # that are no longer configured are dropped.
+    with self.cond:
+      for heap in self.pending.values():
+        jobs = []
+        for due, priority, k, uri, resources, estimate in heap:
+          if k not in backups:
+            tprint("Dropping backup of {vm}, it is no longer configured".format(vm=k),
+                   global_config['logfile'])
+            self.vms.discard(k)
+            self.pool['hosts'][uri]['total'] -= 1
+            self.count -= 1
+          else:
+            jobs.append((due, backups[k]['priority'], k, uri, resources, estimate))
+        heapq.heapify(jobs)
+        heap[:] = jobs
+      self.global_config = global_config
+      self.backups = backups
+
+  def add(self, jobs, due):
+    # Queue backups of the given vms, due at the given time. A vm whose
+    # previous backup is still pending or running is skipped.
+    for k in jobs:
+      uri = self.backups[k]['uri']
+      with self.cond:
+        if k in self.vms:
+          tprint("Skipping backup of {vm} due {due}, its previous backup has not "
+                 "finished".format(vm=k, due=due.ctime()), self.global_config['logfile'])
+          continue
+        if self.run_started == None:
+          self.run_started = time.monotonic()
+        self.vms.add(k)
+        self.count += 1
+        host = self.pool['hosts'].setdefault(uri, { "total" : 0, "done" : 0,
+                                                    "failed" : 0, "running" : 0 })
+        host['total'] += 1
+
+      conn = None
+      if self.global_config['api'] == "libvirt":
+        try:
+          conn = get_connection(uri)
+        except libvirt.libvirtError as err:
+          with self.cond:
+            self.fail(k, uri, "{uri} cannot be reached: {err}".format(uri=uri, err=err))
+          continue
+        # The test driver makes up the paths of its disks
+        missing = not uri.startswith("test:") and unreachable_disks(conn, k) or []
+        if len(missing) > 0:
+          with self.cond:
+            self.fail(k, uri, "{paths} of {uri} not found on this host, which needs its "
+                      "storage at the same paths".format(paths=", ".join(missing), uri=uri))
+          continue
+      job = (due, self.backups[k]['priority'], k, uri,
+             job_resources(self.global_config, conn, k, uri),
+             estimate_backup(self.global_config, conn, k, self.backups[k]))
+      with self.cond:
+        heapq.heappush(self.pending.setdefault(uri, []), job)
+
+  def fail(self, k, uri, reason):
+    # Record a job that is not going to run. Called with the lock held.
+    tprint("Error: Skipping backup of {vm}, {reason}".format(vm=k, reason=reason),
+           self.global_config['logfile'])
+    job = catalog_begin(self.global_config, k, self.backups[k]['method'])
+    job['host'] = uri
+    catalog_finish(self.global_config, job, None, "failed")
+    record_metrics(job)
+    self.results.append(job)
+    self.vms.discard(k)
+    host = self.pool['hosts'][uri]
+    host['done'] += 1
+    host['failed'] += 1
+
+  def runnable(self, resources):
+    for key, limit in resources:
+      if self.pool['busy'].get(key, 0) >= limit:
+        return False
+    return True
+
+  def fits(self, k, estimate):
+    # Streamed backups take no room in backup_dir
+    global_config = self.global_config
+    if estimate == None or global_config['sink'].streams:
+      return True
+    # What retention frees is looked up once per pass of dispatch()
+    if k not in self.retained:
+      self.retained[k] = sum(size or 0 for name, size in retention_sets(global_config, k,
+                                                                       self.backups[k]))
+    available = free_space(global_config['backup_dir']) - self.pool['reserved'] - \
+                global_config['min_free_space'] + reaper.reclaimable() + self.retained[k]
+    if estimate <= available:
+      return True
+    if k not in self.pool['deferred']:
+      tprint("Deferring backup of {vm}, it needs about {need:.1f} GiB where "
+             "{available:.1f} GiB are available".format(vm=k, need=estimate / 1073741824.,
+             available=max(0, available) / 1073741824.), global_config['logfile'])
+      self.pool['deferred'].add(k)
+    return False
+
+  def dispatch(self):
+    # Start as many pending jobs as there are free slots for, and finish
+    # the run once the pool has become idle
+    with self.cond:
+      self.changed = False
+      self.retained = {}
+      passed = []
+      while self.pool['running'] < self.global_config['max_jobs']:
+        heads = [(self.pool['hosts'][uri]['running'], heap[0])
+                 for uri, heap in self.pending.items() if len(heap) > 0]
+        if len(heads) == 0:
+          break
+        job = heapq.heappop(self.pending[min(heads)[1][3]])
+        due, priority, k, uri, resources, estimate = job
+        if not self.runnable(resources) or not self.fits(k, estimate):
+          passed.append(job)
+          continue
+
+        for key, limit in resources:
+          self.pool['busy'][key] = self.pool['busy'].get(key, 0) + 1
+        self.pool['reserved'] += estimate or 0
+        self.pool['running'] += 1
+        self.pool['hosts'][uri]['running'] += 1
+        self.backups[k]['last_backup'] = datetime.now()
+        thread = threading.Thread(target=self.worker, args=(self.global_config, k,
+                                  self.backups[k], uri, resources, estimate),
+                                  name="backup-{vm}".format(vm=k))
+        thread.start()
+        self.threads.append(thread)
+      for job in passed:
+        heapq.heappush(self.pending[job[3]], job)
+
+      # With nothing running, every pending job was passed for want of
+      # space, and nothing running or being removed is going to free any
+      if self.pool['running'] == 0 and reaper.reclaimable() == 0:
+        for heap in self.pending.values():
+          for due, priority, k, uri, resources, estimate in sorted(heap):
+            self.fail(k, uri, "{dir} does not have room for it".format(
+                      dir=self.global_config['backup_dir']))
+          del heap[:]
+
+      finished = self.run_started != None and self.pool['running'] == 0 and \
+                 sum(len(heap) for heap in self.pending.values()) == 0
+    if finished:
+      self.finish()
+
+  def worker(self, global_config, k, v, uri, resources, estimate):
+    started = time.monotonic()
+    job = None
+    with log_context(vm=k):
+      try:
+        conn = None
+        if global_config['api'] == "libvirt":
+          conn = get_connection(uri)
+        job = backup_vm(global_config, conn, k, v, self.scheduled)
+      except Exception as err:
+        tprint("Backup failed for {vm}: {err}".format(vm=k, err=err),
+               global_config['logfile'])
+    elapsed = time.monotonic() - started
+    write_metrics(global_config)
+
+    with self.cond:
+      for key, limit in resources:
+        self.pool['busy'][key] -= 1
+      self.pool['reserved'] -= estimate or 0
+      self.pool['serial'] += elapsed
+      self.vms.discard(k)
+      host = self.pool['hosts'][uri]
+      host['running'] -= 1
+      host['done'] += 1
+      if job != None:
+        self.results.append(job)
+      if job == None or job['outcome'] != "success":
+        host['failed'] += 1
+      if len(self.pool['hosts']) > 1:
+        tprint("Progress of {uri}: {done} of {total} backup(s) done, {failed} failed, "
+               "{running} running".format(uri=uri, **host), global_config['logfile'])
+      self.changed = True
+      self.cond.notify_all()
+
+    # Keep the job slot occupied during the delay between backups
+    time.sleep(int(global_config['delay']))
+
+    with self.cond:
+      self.pool['running'] -= 1
+      self.changed = True
+      self.cond.notify_all()
+
+  def wait(self, timeout):
+    # Sleep until a job slot frees up or for at most timeout seconds
+    with self.cond:
+      if not self.changed:
+        self.cond.wait(timeout)
+    reload_limits(self.global_config, self.backups)
+
+  def active(self):
+    # Whether a run is going on
+    with self.cond:
+      return self.run_started != None
+
+  def finish(self):
+    # Log and summarise a run that has come to an end
+    for thread in self.threads:
+      thread.join()
+    global_config = self.global_config
+
+    if chunkstore_gc_pending.is_set():
+      chunkstore_gc(global_config['backup_dir'], global_config['logfile'])
+
+    with self.cond:
+      wall = time.monotonic() - self.run_started
+      serial = self.pool['serial']
+      count = self.count
+      results = self.results
+      self.run_started = None
+      self.pool['serial'] = 0.0
+      self.pool['deferred'] = set()
+      self.pool['hosts'] = {}
+      self.results = []
+      self.threads = []
+      self.count = 0
+
+    tprint("Backup run of {count} vm(s) took {wall:.0f}s wall time against "
+           "{serial:.0f}s serial time".format(count=count, wall=wall,
+           serial=serial), global_config['logfile'])
+
+    with metrics_lock:
+      metrics['run'] = { "wall_seconds" : wall,
+                         "serial_seconds" : serial,
+                         "vms" : count }
+    write_metrics(global_config)
+    write_summary(global_config, results, wall, serial)
+
+def do_backup(global_config, backups, vms, scheduled = False):
+  # Back up the given clients in order of priority and wait for them to
+  # finish. Unknown names are silently ignored.
+  jobs = [k for k, v in sorted(backups.items(), key=lambda item: (item[1]['priority'],
+          item[0])) if k in vms]
+
+  if len(jobs) > 0:
+    dispatcher = Dispatcher(global_config, backups, scheduled)
+    dispatcher.add(jobs, datetime.now())
+    dispatcher.dispatch()
+    while dispatcher.active():
+      dispatcher.wait(5)
+      dispatcher.dispatch()
+
+  return backups
+
+def print_next_runs(backups, vms):
+  # List the upcoming backups in the order the scheduler will run them
+  # The host is only shown when the vms run on more than one
+  hosts = len(set(v['uri'] for v in backups.values())) > 1
+  queue = schedule_queue(backups, datetime.now())
+  while len(queue) > 0:
+    due, priority, k = heapq.heappop(queue)
+    if len(vms) > 0 and k not in vms:
+      continue
+    print("{due}  {prio:>2}  {vm:<20} {method:<11} {uri}".format(due=due.strftime("%a %F %H:%M"),
+          prio=priority, vm=k, method=backups[k]['method'],
+          uri=hosts and backups[k]['uri'] or "").rstrip())
+  for k, v in sorted(backups.items()):
+    if v['next_backup'] == None and (len(vms) == 0 or k in vms):
+      print("{due:<20}  {prio:>2}  {vm:<20} {method:<11} {uri}".format(due="never",
+            prio=v['priority'], vm=k, method=v['method'],
+            uri=hosts and v['uri'] or "").rstrip())
+
+def main():
+  options, vms = parse_cmdline()
+  configfile, configfile_mtime = conffile_mtime()
+  global_config, backups = parse_config(configfile)
+  log_writer.configure(global_config['log_format'])
+  apply_limits(global_config, backups)
+
+  if options['next_runs']:
+    print_next_runs(backups, vms)
+    return
+
+  # Everything else works on backup_dir and the catalog kept in it
+  if not os.path.isdir(global_config['backup_dir']):
+    sys.exit("backup_dir {dir} does not exist".format(dir=global_config['backup_dir']))
+
+  # Sets in a sink that streams have to be fetched into backup_dir first
+  if (options['rebuild'] != None or options['restore'] or options['verify']) and \
+     global_config['sink'].streams:
+    print("Error: --rebuild, --restore and --verify work on sets in backup_dir, "
+          "copy the set there from the sink first")
+    sys.exit(1)
+
+  # Write full disk images of a backup set, rebuilding incremental chains
+  if options['rebuild'] != None:
+    for vm in vms:
+      rebuild_set(global_config, vm, options['set'], options['rebuild'])
+    return
+
+  # Put vms back as they were in a backup set
+  if options['restore']:
+    if not options['dry_run']:
+      catalog_sync(global_config, backups.keys())
+    restored = True
+    for vm in vms:
+      uri = vm in backups and backups[vm]['uri'] or global_config['uri']
+      restored = restore_set(global_config, vm, options['set'], options['to'],
+                             options['dry_run'], uri) and restored
+    sys.exit(not restored and 1 or 0)
+
+  # Check backup sets against their checksums, the exit status tells
+  if options['verify']:
+    if len(vms) == 0:
+      vms = sorted(backups.keys())
+    sys.exit(not verify_sets(global_config, vms, options['set']) and 1 or 0)
+
+  catalog_sync(global_config, backups.keys())
+
+  # Allow for manual backups of specified vms on command line
+  if len(vms) > 0:
+    backups = do_backup(global_config, backups, vms)
+    reaper.wait()
+  else:
+    reaper.resume(global_config, backups.keys())
+
+    # Finish or roll back backups interrupted by a crash or restart, rather
+    # than leaving their snapshots until their next scheduled backup
+    if global_config['api'] == "libvirt":
+      for vm in sorted(backups.keys()):
+        if journal_read(global_config['backup_dir'], vm) != None:
+          with log_context(vm=vm, phase="recover"):
+            try:
+              conn = get_connection(backups[vm]['uri'])
+            except libvirt.libvirtError as err:
+              tprint("Error: Cannot recover backup of {vm}, {uri} cannot be reached: "
+                     "{err}".format(vm=vm, uri=backups[vm]['uri'], err=err),
+                     global_config['logfile'])
+              continue
+            recover_job(global_config, conn, vm)
+
+    # One dispatcher runs the backups for as long as the daemon lives, taking
+    # them off the queue as they become due
+    dispatcher = Dispatcher(global_config, backups, scheduled = True)
+    queue = schedule_queue(backups, datetime.now())
+    while (True):
+      # Reread configfile if it has changed
+      if os.stat(configfile).st_mtime != configfile_mtime:
+        configfile, configfile_mtime = conffile_mtime()
+        global_config, backups = parse_config(configfile)
+        log_writer.configure(global_config['log_format'])
+        apply_limits(global_config, backups)
+        catalog_sync(global_config, backups.keys())
+        dispatcher.configure(global_config, backups)
+        queue = schedule_queue(backups, datetime.now())
+
+      # Work out when the backups are due next as they are handed to the
+      # dispatcher, so that the schedule does not drift by the time the
+      # backups take
+      now = datetime.now()
+      while len(queue) > 0 and queue[0][0] <= now:
+        due, priority, k = heapq.heappop(queue)
+        backups[k]['next_backup'] = next_run(backups[k]['schedule'],
+                                             now + timedelta(minutes=1))
+        if backups[k]['next_backup'] != None:
+          heapq.heappush(queue, (backups[k]['next_backup'], backups[k]['priority'], k))
+        dispatcher.add([k], due)
+      dispatcher.dispatch()
+
+      # Sleep until the next backup is due or a job slot frees up, but wake
+      # up once a minute to see if the configfile has changed, and more
+      # often while backups run to pick up changed I/O limits
+      if len(queue) > 0:
+        wait = (queue[0][0] - now).total_seconds()
+      else:
+        wait = 60
+      if dispatcher.active():
+        wait = min(5, wait)
+      dispatcher.wait(max(0.1, min(60, wait)))
 
 if __name__ == "__main__":
   main()